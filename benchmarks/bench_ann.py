@@ -0,0 +1,79 @@
+"""
+Recall@k and latency of the IVF index against the exact search of `utils.top_n_similarity`.
+
+    python benchmarks/bench_ann.py --chunks 200000 --nprobe 1 4 8 16 32
+
+Random vectors have no structure for k-means to find, so the corpus is drawn around
+random topics, with the queries drawn like the documents.
+"""
+import argparse
+import os
+import sys
+import time
+
+import numpy as np
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+from docs_chat_bot import utils
+from docs_chat_bot.embedding_index import EmbeddingIndex
+
+
+def normalize(vectors: np.ndarray) -> np.ndarray:
+    return vectors / np.linalg.norm(vectors, axis=1, keepdims=True)
+
+
+def clustered_vectors(count: int, centers: np.ndarray, spread: float, rng) -> np.ndarray:
+    topics, dim = centers.shape
+    labels = rng.integers(0, topics, count)
+    vectors = np.empty((count, dim), dtype=np.float32)
+    for start in range(0, count, 65536):
+        end = min(start + 65536, count)
+        noise = rng.standard_normal((end - start, dim)).astype(np.float32) * spread / np.sqrt(dim)
+        vectors[start:end] = normalize(centers[labels[start:end]] + noise)
+    return vectors
+
+
+def main():
+    parser = argparse.ArgumentParser(description="IVF index recall benchmark")
+    parser.add_argument("--chunks", type=int, default=100000, help="The number of indexed vectors, default to 100000")
+    parser.add_argument("--dim", type=int, default=1536, help="The vector dimension, default to 1536")
+    parser.add_argument("--topics", type=int, default=1000, help="The number of clusters the vectors are drawn around, default to 1000")
+    parser.add_argument("--spread", type=float, default=1.0, help="The noise added around every topic, default to 1.0")
+    parser.add_argument("--lists", type=int, default=0, help="The number of IVF lists, default to about 4 * sqrt(chunks)")
+    parser.add_argument("--queries", type=int, default=100, help="The number of queries, default to 100")
+    parser.add_argument("-k", type=int, default=utils.max_context_chunks, help=f"The number of results compared, default to {utils.max_context_chunks}")
+    parser.add_argument("--nprobe", type=int, nargs='+', default=[1, 2, 4, 8, 16, 32, 64], help="The nprobe values to measure")
+    args = parser.parse_args()
+
+    rng = np.random.default_rng(0)
+    centers = normalize(rng.standard_normal((args.topics, args.dim)).astype(np.float32))
+    vectors = clustered_vectors(args.chunks, centers, args.spread, rng)
+    index = EmbeddingIndex(vectors, [str(i) for i in range(args.chunks)], ids=[str(i) for i in range(args.chunks)], version='bench')
+    queries = clustered_vectors(args.queries, centers, args.spread, rng)
+
+    # the exact results are taken before the IVF index is built, `search` uses it afterwards
+    start = time.perf_counter()
+    exact = [{text for _, text in utils.top_n_similarity(query, index, args.k)} for query in queries]
+    exact_ms = (time.perf_counter() - start) / len(queries) * 1000
+    print(f'exact search: {exact_ms:.2f} ms/query')
+
+    start = time.perf_counter()
+    index.build_ivf(args.lists)
+    print(f'built {index.ivf.nlist} lists for {args.chunks} vectors in {time.perf_counter() - start:.1f}s')
+
+    print(f'{"nprobe":>8} {"recall@" + str(args.k):>10} {"ms/query":>10} {"speedup":>8}')
+    for nprobe in args.nprobe:
+        index.nprobe = nprobe
+        found = 0
+        start = time.perf_counter()
+        results = [index.search(query, args.k) for query in queries]
+        ms = (time.perf_counter() - start) / len(queries) * 1000
+        for expected, result in zip(exact, results):
+            found += len(expected & {index.texts[i] for _, i in result})
+        recall = found / (len(queries) * args.k)
+        print(f'{nprobe:>8} {recall:>10.3f} {ms:>10.2f} {exact_ms / ms:>7.1f}x')
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,68 @@
+"""
+Latency of the BM25 search over a synthetic corpus.
+
+    python benchmarks/bench_bm25.py --chunks 100000
+
+Chunk words are drawn from a Zipf distribution over the vocabulary like natural text, questions
+mix a few frequent words with rarer ones the way pasted identifiers and error messages do.
+"""
+import argparse
+import os
+import sys
+import time
+
+import numpy as np
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+from docs_chat_bot.bm25 import BM25Index
+
+
+def word(i: int) -> str:
+    letters = ''
+    while True:
+        i, r = divmod(i, 26)
+        letters += chr(ord('a') + r)
+        if not i:
+            return letters
+
+
+def main():
+    parser = argparse.ArgumentParser(description="BM25 search benchmark")
+    parser.add_argument("--chunks", type=int, default=100000, help="The number of indexed chunks, default to 100000")
+    parser.add_argument("--words", type=int, default=300, help="The number of words per chunk, default to 300")
+    parser.add_argument("--vocabulary", type=int, default=100000, help="The number of distinct words, default to 100000")
+    parser.add_argument("--queries", type=int, default=1000, help="The number of queries, default to 1000")
+    parser.add_argument("-k", type=int, default=10, help="The number of results per query, default to 10")
+    args = parser.parse_args()
+
+    rng = np.random.default_rng(0)
+    # every seventh word is a snake_case identifier, indexed with its parts
+    vocabulary = [word(i) if i % 7 else f'{word(i)}_{word(i // 7)}' for i in range(args.vocabulary)]
+    # zipf ranks beyond the vocabulary are folded back into it
+    ranks = (rng.zipf(1.1, args.chunks * args.words) - 1) % args.vocabulary
+    texts = [' '.join(vocabulary[r] for r in ranks[i * args.words:(i + 1) * args.words]) for i in range(args.chunks)]
+
+    start = time.perf_counter()
+    index = BM25Index.build(texts)
+    build = time.perf_counter() - start
+    size = sum(len(data) for _, data in index.blocks())
+    print(f'built {len(index)} terms for {args.chunks} chunks in {build:.1f}s, {size / 1024 / 1024:.1f} MB')
+
+    questions = []
+    for _ in range(args.queries):
+        common = (rng.zipf(1.1, 3) - 1) % 100
+        rare = rng.integers(100, args.vocabulary, 2)
+        questions.append(' '.join(vocabulary[r] for r in np.concatenate([common, rare])))
+
+    latencies = []
+    for question in questions:
+        start = time.perf_counter()
+        index.search(question, args.k)
+        latencies.append((time.perf_counter() - start) * 1000)
+    latencies = np.array(latencies)
+    print(f'ms/query: mean {latencies.mean():.2f}, p50 {np.percentile(latencies, 50):.2f}, p99 {np.percentile(latencies, 99):.2f}')
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,94 @@
+"""
+Memory and time used by the per-conversation state of the bots for many distinct users.
+
+    python benchmarks/bench_conversations.py --users 1000000
+
+Every simulated user asks one question: its rate limit is checked and it is marked as answered.
+The dicts of deques kept by older versions are measured the same way for comparison.
+"""
+import argparse
+import os
+import sys
+import time
+import tracemalloc
+import uuid
+from collections import deque
+
+import numpy as np
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+from docs_chat_bot import chatgpt
+from docs_chat_bot.conversations import ConversationStore
+from docs_chat_bot.embedding_index import EmbeddingIndex
+
+
+class UnboundedState:
+    """
+    The state kept by older versions: a deque of request times and a flag per conversation, never pruned.
+    """
+
+    def __init__(self):
+        self.rate_limits = {}
+        self.users = {}
+
+    def check_rate_limit(self, conversation_id: str):
+        try:
+            request_timestamps = self.rate_limits[conversation_id]
+        except KeyError:
+            request_timestamps = deque(maxlen=chatgpt.rate_limit_size)
+            self.rate_limits[conversation_id] = request_timestamps
+        current_time = time.time()
+        while request_timestamps and current_time - request_timestamps[0] > chatgpt.rate_limit_window_seconds:
+            request_timestamps.popleft()
+        request_timestamps.append(current_time)
+
+    def mark_answered(self, conversation_id: str):
+        self.users[conversation_id] = True
+
+    def __len__(self):
+        return len(self.rate_limits)
+
+
+class BotState:
+    def __init__(self, bot: chatgpt.ChatGPTBot):
+        self.bot = bot
+        self.check_rate_limit = bot.check_rate_limit
+        self.mark_answered = bot.mark_answered
+
+    def __len__(self):
+        return len(self.bot.conversations)
+
+
+def measure(name: str, state, conversation_ids):
+    tracemalloc.start()
+    start = time.perf_counter()
+    for conversation_id in conversation_ids:
+        state.check_rate_limit(conversation_id)
+        state.mark_answered(conversation_id)
+    duration = time.perf_counter() - start
+    size, _ = tracemalloc.get_traced_memory()
+    tracemalloc.stop()
+    kept = len(state)
+    print(f'{name:>24} {kept:>10} {size / 1024 / 1024:>10.1f} {size / max(kept, 1):>10.0f} {duration / len(conversation_ids) * 1e6:>8.2f}')
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Conversation state benchmark")
+    parser.add_argument("--users", type=int, default=1000000, help="The number of distinct users, default to 1000000")
+    parser.add_argument("--max-conversations", type=int, nargs='+', default=[0, 100000], help="The store sizes to measure, 0 for no limit")
+    args = parser.parse_args()
+
+    # conversation ids are uuids, created before the measurements so they are not counted
+    conversation_ids = [str(uuid.UUID(int=int(i))) for i in np.random.default_rng(0).integers(0, 2 ** 63, args.users)]
+    index = EmbeddingIndex.from_embeddings({'doc': np.array([1.0, 0.0])})
+
+    print(f'{"state":>24} {"kept":>10} {"MB":>10} {"bytes/kept":>10} {"us/user":>8}')
+    measure('dicts of deques', UnboundedState(), conversation_ids)
+    for max_size in args.max_conversations:
+        bot = chatgpt.ChatGPTBot('', index, conversations=ConversationStore(max_size))
+        measure(f'store max_size={max_size}', BotState(bot), conversation_ids)
+
+
+if __name__ == '__main__':
+    main()
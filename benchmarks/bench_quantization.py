@@ -0,0 +1,77 @@
+"""
+Size, recall@k and latency of the compressed vectors against exact float search.
+
+    python benchmarks/bench_quantization.py --chunks 100000 --rerank 0 100
+
+The corpus is drawn around random topics like in bench_ann.py. Sizes are bytes per vector
+of the data scanned per query, compared with the float64 vectors of the old pickled index.
+"""
+import argparse
+import os
+import sys
+import time
+
+import numpy as np
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+from bench_ann import clustered_vectors, normalize
+
+from docs_chat_bot import utils
+from docs_chat_bot.embedding_index import EmbeddingIndex
+
+
+def measure(index: EmbeddingIndex, queries: np.ndarray, exact, k: int):
+    found = 0
+    start = time.perf_counter()
+    results = [index.search(query, k) for query in queries]
+    ms = (time.perf_counter() - start) / len(queries) * 1000
+    for expected, result in zip(exact, results):
+        found += len(expected & {index.texts[i] for _, i in result})
+    return found / (len(queries) * k), ms
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Vector compression benchmark")
+    parser.add_argument("--chunks", type=int, default=100000, help="The number of indexed vectors, default to 100000")
+    parser.add_argument("--dim", type=int, default=1536, help="The vector dimension, default to 1536")
+    parser.add_argument("--topics", type=int, default=1000, help="The number of clusters the vectors are drawn around, default to 1000")
+    parser.add_argument("--spread", type=float, default=1.0, help="The noise added around every topic, default to 1.0")
+    parser.add_argument("--queries", type=int, default=100, help="The number of queries, default to 100")
+    parser.add_argument("-k", type=int, default=utils.max_context_chunks, help=f"The number of results compared, default to {utils.max_context_chunks}")
+    parser.add_argument("--pq-subspaces", type=int, nargs='+', default=[96, 192], help="The product quantizer sizes to measure, in bytes per vector")
+    parser.add_argument("--rerank", type=int, nargs='+', default=[0, 100], help="The rerank values to measure")
+    args = parser.parse_args()
+
+    rng = np.random.default_rng(0)
+    centers = normalize(rng.standard_normal((args.topics, args.dim)).astype(np.float32))
+    vectors = clustered_vectors(args.chunks, centers, args.spread, rng)
+    ids = [str(i) for i in range(args.chunks)]
+    index = EmbeddingIndex(vectors, ids, ids=ids, version='bench')
+    queries = clustered_vectors(args.queries, centers, args.spread, rng)
+    exact = [{text for _, text in utils.top_n_similarity(query, index, args.k)} for query in queries]
+    _, float_ms = measure(index, queries, exact, args.k)
+
+    float64_bytes = args.dim * 8
+    print(f'{"vectors":>10} {"rerank":>7} {"bytes":>7} {"vs f64":>7} {"vs f32":>7} {"recall@" + str(args.k):>10} {"ms/query":>9}')
+    print(f'{"float32":>10} {"-":>7} {args.dim * 4:>7} {2:>6.1f}x {1:>6.1f}x {1:>10.3f} {float_ms:>9.2f}')
+    configurations = [('int8', None)] + [('pq', subspaces) for subspaces in args.pq_subspaces]
+    for kind, subspaces in configurations:
+        start = time.perf_counter()
+        if kind == 'pq':
+            index.compress(kind, subspaces)
+            name = f'pq{subspaces}'
+        else:
+            index.compress(kind)
+            name = kind
+        build = time.perf_counter() - start
+        size = index.quantizer.codes.nbytes // args.chunks
+        for rerank in args.rerank:
+            index.rerank = rerank
+            recall, ms = measure(index, queries, exact, args.k)
+            print(f'{name:>10} {rerank:>7} {size:>7} {float64_bytes / size:>6.1f}x {args.dim * 4 / size:>6.1f}x {recall:>10.3f} {ms:>9.2f}')
+        print(f'{"":>10} built in {build:.1f}s')
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,101 @@
+"""
+Load benchmark of the `/chat` endpoint against the local OpenAI stub.
+
+    python benchmarks/bench_server.py --chunks 10000 --latency 0.2 --concurrency 1 8 32 64
+
+Every request uses a distinct question so neither cache is hit. With a non-blocking
+request path the throughput grows with the concurrency until the stub latency is hidden.
+"""
+import argparse
+import asyncio
+import os
+import sys
+import tempfile
+import threading
+import time
+
+import httpx
+import numpy as np
+import openai
+import uvicorn
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+from openai_stub import OpenAIStub
+
+from docs_chat_bot import docs_chat_bot_server, utils
+from docs_chat_bot.cache import AnswerCache, EmbeddingCache
+from docs_chat_bot.embedding_index import EmbeddingIndex
+from docs_chat_bot.index_registry import IndexRegistry
+
+
+def random_index(chunks: int, dim: int) -> EmbeddingIndex:
+    vectors = np.random.standard_normal((chunks, dim)).astype(np.float32)
+    vectors /= np.linalg.norm(vectors, axis=1, keepdims=True)
+    return EmbeddingIndex(vectors, [f'chunk {i} ' + 'lorem ipsum ' * 50 for i in range(chunks)])
+
+
+def start_server(port: int):
+    server = uvicorn.Server(uvicorn.Config(docs_chat_bot_server.app, host='127.0.0.1', port=port, log_level='warning'))
+    threading.Thread(target=server.run, daemon=True).start()
+    while not server.started:
+        time.sleep(0.05)
+    return server
+
+
+async def run_level(url: str, concurrency: int, requests: int, offset: int):
+    latencies = []
+    questions = iter(range(offset, offset + requests))
+
+    async def worker(client: httpx.AsyncClient):
+        for i in questions:
+            start = time.perf_counter()
+            response = await client.post(url, json={'message': f'question {i}'})
+            response.raise_for_status()
+            latencies.append(time.perf_counter() - start)
+
+    start = time.perf_counter()
+    async with httpx.AsyncClient(timeout=60, limits=httpx.Limits(max_connections=concurrency)) as client:
+        await asyncio.gather(*[worker(client) for _ in range(concurrency)])
+    duration = time.perf_counter() - start
+    return {
+        'concurrency': concurrency,
+        'requests': requests,
+        'rps': requests / duration,
+        'p50_ms': float(np.percentile(latencies, 50) * 1000),
+        'p99_ms': float(np.percentile(latencies, 99) * 1000),
+    }
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Chat-bot server load benchmark")
+    parser.add_argument("--chunks", type=int, default=10000, help="The number of chunks in the random index")
+    parser.add_argument("--dim", type=int, default=1536)
+    parser.add_argument("--latency", type=float, default=0.2, help="The stub latency of every openai call")
+    parser.add_argument("--jitter", type=float, default=0.0)
+    parser.add_argument("--requests", type=int, default=200, help="Requests sent at every concurrency level")
+    parser.add_argument("--concurrency", type=int, nargs='+', default=[1, 8, 32, 64])
+    parser.add_argument("--stub-port", type=int, default=8100)
+    parser.add_argument("--port", type=int, default=8101)
+    args = parser.parse_args()
+
+    stub = OpenAIStub(args.dim, args.latency, args.jitter)
+    openai.api_base = stub.start(port=args.stub_port)
+    openai.api_key = 'stub'
+
+    index_path = os.path.join(tempfile.mkdtemp(), 'bench.index')
+    random_index(args.chunks, args.dim).save(index_path)
+    docs_chat_bot_server.indexes = IndexRegistry({'bench': index_path})
+    utils.query_embedding_cache = EmbeddingCache(0)
+    utils.answer_cache = AnswerCache(0)
+    start_server(args.port)
+
+    url = f'http://127.0.0.1:{args.port}/chat'
+    offset = 0
+    for concurrency in args.concurrency:
+        result = asyncio.run(run_level(url, concurrency, args.requests, offset))
+        offset += args.requests
+        print('concurrency {concurrency:4d}  {rps:8.1f} req/s  p50 {p50_ms:8.1f} ms  p99 {p99_ms:8.1f} ms'.format(**result))
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,108 @@
+"""
+Memory and throughput of the server with `--workers`, against the local OpenAI stub.
+
+    python benchmarks/bench_workers.py --chunks 100000 --workers 1 2 4
+
+The server runs as a separate process for every worker count. Its memory is the sum of the
+proportional set sizes of the supervisor and the workers, pages of the memory-mapped index
+shared by n processes counting 1/n in each, so it stays close to one copy of the index when
+the workers share it. The throughput only grows with the workers up to the number of cores.
+"""
+import argparse
+import asyncio
+import os
+import signal
+import subprocess
+import sys
+import tempfile
+import time
+
+import httpx
+
+root = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+sys.path.insert(0, root)
+
+from openai_stub import OpenAIStub
+from bench_server import random_index, run_level
+
+
+def process_tree(pid: int):
+    pids = [pid]
+    for pid in pids:
+        try:
+            with open(f'/proc/{pid}/task/{pid}/children') as f:
+                pids.extend(int(child) for child in f.read().split())
+        except FileNotFoundError:
+            pass
+    return pids
+
+
+def pss_bytes(pid: int) -> int:
+    total = 0
+    for pid in process_tree(pid):
+        try:
+            with open(f'/proc/{pid}/smaps_rollup') as f:
+                for line in f:
+                    if line.startswith('Pss:'):
+                        total += int(line.split()[1]) * 1024
+        except FileNotFoundError:
+            pass
+    return total
+
+
+def wait_ready(url: str, process: subprocess.Popen, timeout: float = 120.0):
+    deadline = time.monotonic() + timeout
+    while time.monotonic() < deadline:
+        if process.poll() is not None:
+            raise RuntimeError(f'server exited with status {process.returncode}')
+        try:
+            httpx.get(url, timeout=1.0)
+            return
+        except httpx.TransportError:
+            time.sleep(0.2)
+    raise TimeoutError(url)
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Multi-worker server benchmark")
+    parser.add_argument("--chunks", type=int, default=100000, help="The number of chunks in the random index, default to 100000")
+    parser.add_argument("--dim", type=int, default=1536)
+    parser.add_argument("--latency", type=float, default=0.05, help="The stub latency of every openai call, default to 0.05")
+    parser.add_argument("--requests", type=int, default=200, help="Requests sent for every worker count, default to 200")
+    parser.add_argument("--concurrency", type=int, default=32, help="Requests in flight, default to 32")
+    parser.add_argument("--workers", type=int, nargs='+', default=[1, 2, 4])
+    parser.add_argument("--stub-port", type=int, default=8100)
+    parser.add_argument("--port", type=int, default=8101)
+    args = parser.parse_args()
+
+    stub = OpenAIStub(args.dim, args.latency)
+    api_base = stub.start(port=args.stub_port)
+    index_path = os.path.join(tempfile.mkdtemp(), 'bench.index')
+    random_index(args.chunks, args.dim).save(index_path)
+    print(f'index {os.path.getsize(index_path) / 1024 / 1024:.1f} MB, {os.cpu_count()} cores')
+
+    env = dict(os.environ, OPENAI_API_BASE=api_base, PYTHONPATH=os.pathsep.join(filter(None, [root, os.environ.get('PYTHONPATH')])))
+    url = f'http://127.0.0.1:{args.port}'
+    offset = 0
+    for workers in args.workers:
+        process = subprocess.Popen([
+            sys.executable, '-m', 'docs_chat_bot.docs_chat_bot_server', '--host', '127.0.0.1', '--port', str(args.port),
+            '--api-key', 'stub', '--indexed-docs', index_path, '--workers', str(workers),
+            '--embedding-cache-size', '0', '--answer-cache-size', '0',
+        ], env=env, stdout=subprocess.DEVNULL, stderr=subprocess.DEVNULL)
+        try:
+            wait_ready(url + '/metrics', process)
+            # every worker answers a few questions first, so the memory is measured in use
+            asyncio.run(run_level(url + '/chat', args.concurrency, args.concurrency * 2, offset))
+            offset += args.concurrency * 2
+            result = asyncio.run(run_level(url + '/chat', args.concurrency, args.requests, offset))
+            offset += args.requests
+            memory = pss_bytes(process.pid)
+            print(f'workers {workers:3d}  {memory / 1024 / 1024:8.1f} MB  {result["rps"]:8.1f} req/s  p50 {result["p50_ms"]:8.1f} ms  p99 {result["p99_ms"]:8.1f} ms')
+        finally:
+            process.send_signal(signal.SIGTERM)
+            process.wait()
+
+
+if __name__ == '__main__':
+    main()
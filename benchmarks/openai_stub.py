@@ -0,0 +1,128 @@
+"""
+A local stand-in for the OpenAI embeddings and chat completions API, used by the benchmarks.
+
+    python benchmarks/openai_stub.py --port 8100 --latency 0.2 --jitter 0.05
+
+Point the openai client at it with `openai.api_base = "http://127.0.0.1:8100/v1"`.
+"""
+import argparse
+import asyncio
+import hashlib
+import json
+import random
+import threading
+import time
+
+import numpy as np
+from aiohttp import web
+
+
+class OpenAIStub:
+    def __init__(self, dim: int = 1536, latency: float = 0.0, jitter: float = 0.0,
+                 completion_tokens: int = 50, token_interval: float = 0.0):
+        self.dim = dim
+        self.latency = latency
+        self.jitter = jitter
+        self.completion_tokens = completion_tokens
+        self.token_interval = token_interval
+        self.requests = 0
+        self.in_flight = 0
+        self.max_in_flight = 0
+
+    def embedding(self, text: str) -> list:
+        seed = int.from_bytes(hashlib.sha1(text.encode()).digest()[:4], 'little')
+        vector = np.random.default_rng(seed).standard_normal(self.dim).astype(np.float32)
+        vector /= np.linalg.norm(vector)
+        return vector.tolist()
+
+    async def wait(self):
+        await asyncio.sleep(max(0.0, self.latency + random.uniform(-self.jitter, self.jitter)))
+
+    async def handle_embeddings(self, request: web.Request):
+        body = await request.json()
+        inputs = body['input']
+        if isinstance(inputs, str):
+            inputs = [inputs]
+        self.requests += 1
+        self.in_flight += 1
+        self.max_in_flight = max(self.max_in_flight, self.in_flight)
+        try:
+            await self.wait()
+        finally:
+            self.in_flight -= 1
+        data = [{'object': 'embedding', 'index': i, 'embedding': self.embedding(text)} for i, text in enumerate(inputs)]
+        return web.json_response({'object': 'list', 'data': data, 'model': body.get('model', ''), 'usage': {'prompt_tokens': 0, 'total_tokens': 0}})
+
+    async def handle_chat(self, request: web.Request):
+        body = await request.json()
+        self.requests += 1
+        self.in_flight += 1
+        self.max_in_flight = max(self.max_in_flight, self.in_flight)
+        try:
+            await self.wait()
+            words = [f'word{i} ' for i in range(self.completion_tokens)]
+            if not body.get('stream'):
+                await asyncio.sleep(self.token_interval * len(words))
+                return web.json_response({
+                    'id': 'chatcmpl-stub',
+                    'object': 'chat.completion',
+                    'created': int(time.time()),
+                    'model': body.get('model', ''),
+                    'choices': [{'index': 0, 'message': {'role': 'assistant', 'content': ''.join(words)}, 'finish_reason': 'stop'}],
+                })
+
+            response = web.StreamResponse(headers={'Content-Type': 'text/event-stream'})
+            await response.prepare(request)
+            for word in words:
+                await asyncio.sleep(self.token_interval)
+                chunk = {'id': 'chatcmpl-stub', 'object': 'chat.completion.chunk', 'choices': [{'index': 0, 'delta': {'content': word}, 'finish_reason': None}]}
+                await response.write(f'data: {json.dumps(chunk)}\n\n'.encode())
+            chunk = {'id': 'chatcmpl-stub', 'object': 'chat.completion.chunk', 'choices': [{'index': 0, 'delta': {}, 'finish_reason': 'stop'}]}
+            await response.write(f'data: {json.dumps(chunk)}\n\n'.encode())
+            await response.write(b'data: [DONE]\n\n')
+            await response.write_eof()
+            return response
+        finally:
+            self.in_flight -= 1
+
+    def app(self) -> web.Application:
+        app = web.Application()
+        app.router.add_post('/v1/embeddings', self.handle_embeddings)
+        app.router.add_post('/v1/chat/completions', self.handle_chat)
+        return app
+
+    def start(self, host: str = '127.0.0.1', port: int = 8100) -> str:
+        """
+        Serves the stub from a background thread, returns the api base url.
+        """
+        started = threading.Event()
+
+        def run():
+            loop = asyncio.new_event_loop()
+            asyncio.set_event_loop(loop)
+            runner = web.AppRunner(self.app())
+            loop.run_until_complete(runner.setup())
+            loop.run_until_complete(web.TCPSite(runner, host, port).start())
+            started.set()
+            loop.run_forever()
+
+        threading.Thread(target=run, daemon=True).start()
+        started.wait()
+        return f'http://{host}:{port}/v1'
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Local OpenAI API stub")
+    parser.add_argument("--host", type=str, default='127.0.0.1')
+    parser.add_argument("--port", type=int, default=8100)
+    parser.add_argument("--dim", type=int, default=1536, help="The embedding dimension")
+    parser.add_argument("--latency", type=float, default=0.2, help="Seconds before each response starts")
+    parser.add_argument("--jitter", type=float, default=0.0, help="Random +/- seconds added to the latency")
+    parser.add_argument("--completion-tokens", type=int, default=50, help="Tokens in each chat completion")
+    parser.add_argument("--token-interval", type=float, default=0.0, help="Seconds between streamed tokens")
+    args = parser.parse_args()
+    stub = OpenAIStub(args.dim, args.latency, args.jitter, args.completion_tokens, args.token_interval)
+    web.run_app(stub.app(), host=args.host, port=args.port)
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,295 @@
+"""
+End-to-end benchmark suite against the local OpenAI stub, writing machine-readable results.
+
+    python benchmarks/run_benchmarks.py --output results.json --baseline previous.json
+
+Measures, with every OpenAI call answered by `openai_stub.py` after `--latency` +/- `--jitter` seconds:
+
+    indexing    chunks per second of `indexing_document` over a generated markdown tree,
+                for a full and for an unchanged incremental run
+    retrieval   `search_context` latency for growing corpus sizes, vector only and hybrid
+    chat        `/chat` requests per second and latency percentiles per concurrency level
+    mixin       time for the Mixin bot to answer many users at once, the Mixin websocket
+                replaced by a recorder with `--mixin-latency` seconds per sent message
+
+`--only` runs a subset. With `--baseline`, every metric is printed next to its value in an earlier
+results file, so a release can be compared with the previous one.
+"""
+import argparse
+import asyncio
+import json
+import os
+import platform
+import shutil
+import subprocess
+import sys
+import tempfile
+import time
+from typing import Any, Dict, List
+
+import numpy as np
+import openai
+import yaml
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+from bench_ann import clustered_vectors, normalize
+from bench_server import random_index, run_level, start_server
+from openai_stub import OpenAIStub
+
+from docs_chat_bot import docs_chat_bot_server, indexing, utils
+from docs_chat_bot.cache import AnswerCache, EmbeddingCache
+from docs_chat_bot.embedding_index import EmbeddingIndex
+from docs_chat_bot.index_registry import IndexRegistry
+
+benchmarks = ['indexing', 'retrieval', 'chat', 'mixin']
+
+words = '''
+account action table contract token transfer balance issue symbol asset permission authority
+deploy compile build test chain block transaction signature key wallet node history query
+index scope payer primary secondary iterator storage memory database api error assert check
+'''.split()
+
+
+def percentiles(seconds: List[float]) -> Dict[str, float]:
+    return {
+        'p50_ms': float(np.percentile(seconds, 50) * 1000),
+        'p99_ms': float(np.percentile(seconds, 99) * 1000),
+    }
+
+
+def sentence(rng, count: int) -> str:
+    return ' '.join(words[i] for i in rng.integers(0, len(words), count))
+
+
+def write_documents(dir: str, files: int, sections: int, rng):
+    for i in range(files):
+        lines = [f'# Document {i}', '']
+        for j in range(sections):
+            lines += [f'## Section {j}', '', sentence(rng, 120), '', '```python', f'@action("act{j}")', f'def act{j}():', '    pass', '```', '', sentence(rng, 80), '']
+        with open(os.path.join(dir, f'doc{i}.md'), 'w') as f:
+            f.write('\n'.join(lines))
+
+
+def bench_indexing(args) -> Dict[str, Any]:
+    rng = np.random.default_rng(0)
+    dir = tempfile.mkdtemp()
+    try:
+        docs = os.path.join(dir, 'docs')
+        os.mkdir(docs)
+        write_documents(docs, args.files, args.sections, rng)
+        output = os.path.join(dir, 'docs.index')
+        start = time.perf_counter()
+        indexing.indexing_document(docs, output)
+        full = time.perf_counter() - start
+        chunks = len(EmbeddingIndex.load(output))
+        start = time.perf_counter()
+        indexing.indexing_document(docs, output, incremental=True)
+        incremental = time.perf_counter() - start
+    finally:
+        shutil.rmtree(dir)
+    return {
+        'files': args.files,
+        'chunks': chunks,
+        'seconds': full,
+        'chunks_per_second': chunks / full,
+        'incremental_seconds': incremental,
+    }
+
+
+def bench_retrieval(args) -> Dict[str, Any]:
+    rng = np.random.default_rng(0)
+    results = {}
+    for size in args.corpus_sizes:
+        centers = normalize(rng.standard_normal((max(size // 100, 1), args.dim)).astype(np.float32))
+        index = EmbeddingIndex(clustered_vectors(size, centers, 1.0, rng), [sentence(rng, 30) for _ in range(size)])
+        start = time.perf_counter()
+        index.build_lexical()
+        lexical_build = time.perf_counter() - start
+        queries = clustered_vectors(args.queries, centers, 1.0, rng)
+        questions = [sentence(rng, 6) for _ in range(args.queries)]
+        result = {'lexical_build_seconds': lexical_build}
+        for mode in ['vector', 'hybrid']:
+            latencies = []
+            for query, question in zip(queries, questions):
+                start = time.perf_counter()
+                utils.search_context(index, query, question if mode == 'hybrid' else None)
+                latencies.append(time.perf_counter() - start)
+            result[mode] = percentiles(latencies)
+        results[str(size)] = result
+        print(f'retrieval {size:>8} chunks  vector p50 {result["vector"]["p50_ms"]:.2f} ms  hybrid p50 {result["hybrid"]["p50_ms"]:.2f} ms')
+    return results
+
+
+def bench_chat(args) -> Dict[str, Any]:
+    dir = tempfile.mkdtemp()
+    try:
+        index_path = os.path.join(dir, 'bench.index')
+        random_index(args.chat_chunks, args.dim).save(index_path)
+        docs_chat_bot_server.indexes = IndexRegistry({'bench': index_path})
+        server = start_server(args.port)
+        url = f'http://127.0.0.1:{args.port}/chat'
+        results = {}
+        offset = 0
+        for concurrency in args.concurrency:
+            result = asyncio.run(run_level(url, concurrency, args.requests, offset))
+            offset += args.requests
+            results[f'concurrency_{concurrency}'] = {key: value for key, value in result.items() if key != 'concurrency'}
+            print('chat concurrency {concurrency:4d}  {rps:8.1f} req/s  p99 {p99_ms:8.1f} ms'.format(**result))
+        server.should_exit = True
+    finally:
+        shutil.rmtree(dir)
+    return results
+
+
+def bench_mixin(args) -> Dict[str, Any]:
+    from pymixin.mixin_ws_api import MixinWSApi
+
+    from docs_chat_bot.mixinbot import MixinBot
+
+    class OfflineTransport(MixinWSApi):
+        """
+        Stands in for the Mixin websocket, nothing is connected and sent messages are recorded.
+        """
+
+        def __init__(self, bot_config, on_message=None):
+            self.ws = None
+            self.sent = []
+
+        async def sendUserText(self, conversation_id, user_id, text):
+            await asyncio.sleep(args.mixin_latency)
+            self.sent.append((time.perf_counter(), user_id, text))
+
+    # the transport comes between MixinBot and MixinWSApi, so MixinBot sends through it
+    class OfflineMixinBot(MixinBot, OfflineTransport):
+        pass
+
+    dir = tempfile.mkdtemp()
+    try:
+        index_path = os.path.join(dir, 'bench.index')
+        random_index(args.chat_chunks, args.dim).save(index_path)
+        config = {
+            'bot_config': {'client_id': 'bench'},
+            'openai_api_keys': ['stub'] * args.mixin_keys,
+            'openai_limits': {'max_in_flight': 64, 'requests_per_minute': 10 ** 6, 'tokens_per_minute': 10 ** 9},
+            'indexed_docs': index_path,
+            'index_reload_interval': 0,
+            'embedding_cache': {'size': 0},
+            'answer_cache': {'size': 0},
+        }
+        config_file = os.path.join(dir, 'config.yaml')
+        with open(config_file, 'w') as f:
+            yaml.safe_dump(config, f)
+
+        async def run():
+            bot = OfflineMixinBot(config_file)
+            await bot.init()
+            start = time.perf_counter()
+            await asyncio.gather(*[bot.handle_message(f'conversation{i}', f'user{i}', f'question {i}') for i in range(args.mixin_users)])
+            duration = time.perf_counter() - start
+            await bot.close()
+            return bot.sent, start, duration
+
+        sent, start, duration = asyncio.run(run())
+    finally:
+        shutil.rmtree(dir)
+    first: Dict[str, float] = {}
+    done: Dict[str, float] = {}
+    for at, user_id, text in sent:
+        first.setdefault(user_id, at - start)
+        if text == '[END]':
+            done[user_id] = at - start
+    result = {
+        'users': args.mixin_users,
+        'answered': len(done),
+        'messages_sent': len(sent),
+        'seconds': duration,
+        'answers_per_second': len(done) / duration,
+        'first_message': percentiles(list(first.values())),
+        'answer': percentiles(list(done.values()) or [duration]),
+    }
+    print(f'mixin {args.mixin_users} users  {result["answers_per_second"]:.1f} answers/s  answer p99 {result["answer"]["p99_ms"]:.1f} ms')
+    return result
+
+
+def flatten(results: Dict[str, Any], prefix: str = '') -> Dict[str, float]:
+    values = {}
+    for key, value in results.items():
+        if isinstance(value, dict):
+            values.update(flatten(value, f'{prefix}{key}.'))
+        elif isinstance(value, (int, float)):
+            values[prefix + key] = value
+    return values
+
+
+def compare(results: Dict[str, Any], baseline: Dict[str, Any]):
+    old = flatten(baseline['results'])
+    print(f'{"metric":<50} {"baseline":>12} {"current":>12} {"change":>8}')
+    for key, value in flatten(results).items():
+        if key in old and old[key]:
+            print(f'{key:<50} {old[key]:>12.2f} {value:>12.2f} {(value / old[key] - 1) * 100:>7.1f}%')
+
+
+def git_commit() -> str:
+    try:
+        return subprocess.run(['git', 'rev-parse', 'HEAD'], cwd=os.path.dirname(os.path.abspath(__file__)),
+                              capture_output=True, text=True, check=True).stdout.strip()
+    except (OSError, subprocess.CalledProcessError):
+        return ''
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Chat-bot benchmark suite")
+    parser.add_argument("--output", type=str, default='benchmark_results.json', help="The results file, default to benchmark_results.json")
+    parser.add_argument("--baseline", type=str, default='', help="An earlier results file to compare the results with")
+    parser.add_argument("--only", type=str, nargs='+', choices=benchmarks, default=benchmarks, help="The benchmarks to run, default to all")
+    parser.add_argument("--dim", type=int, default=1536, help="The embedding dimension, default to 1536")
+    parser.add_argument("--latency", type=float, default=0.05, help="Seconds before the stub answers every openai call, default to 0.05")
+    parser.add_argument("--jitter", type=float, default=0.01, help="Random +/- seconds added to the stub latency, default to 0.01")
+    parser.add_argument("--token-interval", type=float, default=0.0, help="Seconds between the tokens streamed by the stub, default to 0")
+    parser.add_argument("--files", type=int, default=200, help="The number of generated markdown files to index, default to 200")
+    parser.add_argument("--sections", type=int, default=5, help="The number of sections of every generated file, default to 5")
+    parser.add_argument("--corpus-sizes", type=int, nargs='+', default=[1000, 10000, 100000], help="The corpus sizes of the retrieval benchmark")
+    parser.add_argument("--queries", type=int, default=200, help="The number of queries per corpus size, default to 200")
+    parser.add_argument("--chat-chunks", type=int, default=10000, help="The number of chunks of the index served to /chat and the Mixin bot, default to 10000")
+    parser.add_argument("--requests", type=int, default=200, help="The number of /chat requests per concurrency level, default to 200")
+    parser.add_argument("--concurrency", type=int, nargs='+', default=[1, 8, 32], help="The /chat concurrency levels")
+    parser.add_argument("--mixin-users", type=int, default=100, help="The number of users asking the Mixin bot at once, default to 100")
+    parser.add_argument("--mixin-keys", type=int, default=4, help="The number of openai api keys of the Mixin bot, default to 4")
+    parser.add_argument("--mixin-latency", type=float, default=0.01, help="Seconds to send a message to Mixin, default to 0.01")
+    parser.add_argument("--stub-port", type=int, default=8100)
+    parser.add_argument("--port", type=int, default=8101)
+    args = parser.parse_args()
+
+    stub = OpenAIStub(args.dim, args.latency, args.jitter, token_interval=args.token_interval)
+    openai.api_base = stub.start(port=args.stub_port)
+    openai.api_key = 'stub'
+    # every question is new, so the benchmarks measure the openai calls and not the caches
+    utils.query_embedding_cache = EmbeddingCache(0)
+    utils.answer_cache = AnswerCache(0)
+
+    results = {}
+    for name in args.only:
+        start = time.perf_counter()
+        results[name] = globals()[f'bench_{name}'](args)
+        print(f'{name} done in {time.perf_counter() - start:.1f}s')
+
+    report = {
+        'timestamp': time.strftime('%Y-%m-%dT%H:%M:%S%z'),
+        'commit': git_commit(),
+        'python': platform.python_version(),
+        'platform': platform.platform(),
+        'cpus': os.cpu_count(),
+        'options': vars(args),
+        'results': results,
+    }
+    with open(args.output, 'w') as f:
+        json.dump(report, f, indent=2)
+    print(f'results written to {args.output}')
+    if args.baseline:
+        with open(args.baseline) as f:
+            compare(results, json.load(f))
+
+
+if __name__ == '__main__':
+    main()
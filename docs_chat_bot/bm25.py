@@ -0,0 +1,168 @@
+import re
+from array import array
+from collections import Counter
+from typing import Dict, Iterable, List, Sequence, Tuple
+
+import numpy as np
+from pymixin import log
+
+logger = log.get_logger(__name__)
+logger.addHandler(log.handler)
+
+default_k1 = 1.2
+default_b = 0.75
+# constant of reciprocal rank fusion, a position at rank r scores 1 / (rrf_k + r)
+rrf_k = 60
+
+# identifiers are kept whole: `@action`, `eosio.token`, `get_embedding`, `std::vector`
+_word = re.compile(r'@?\w+(?:(?:\.|::)\w+)*')
+# parts of an identifier: snake_case, camelCase, dotted names and numbers
+_part = re.compile(r'[A-Z]+(?![a-z])|[A-Z]?[a-z]+|\d+')
+
+stop_words = frozenset('''
+a an and are as at be but by can do does for from how i if in is it my of on or so
+that the then this to was we what when where which who why will with you your
+'''.split())
+
+
+def tokenize(text: str) -> List[str]:
+    """
+    Lowercased words of `text`. An identifier is kept whole and its parts are added after it,
+    so `getEmbedding` matches both `getembedding` and `embedding`.
+    """
+    tokens = []
+    for match in _word.finditer(text):
+        word = match.group()
+        lower = word.lower()
+        if lower in stop_words:
+            continue
+        tokens.append(lower)
+        parts = _part.findall(word)
+        if len(parts) > 1:
+            tokens.extend(part.lower() for part in parts)
+    return tokens
+
+
+class BM25Index:
+    """
+    Inverted index of the chunk texts scored with BM25. The vocabulary is sorted so a term is
+    found with a binary search, and the postings of a term hold the positions of the chunks
+    containing it with their precomputed term frequency weight, so a query only sums
+    idf * weight over the postings of its terms.
+    """
+
+    def __init__(self, term_offsets: np.ndarray, terms: np.ndarray, offsets: np.ndarray, positions: np.ndarray, weights: np.ndarray, count: int):
+        # term i is terms[term_offsets[i]:term_offsets[i + 1]], utf-8 encoded
+        self.term_offsets = term_offsets
+        self.terms = terms
+        # postings of term i are positions[offsets[i]:offsets[i + 1]] and the same slice of weights
+        self.offsets = offsets
+        self.positions = positions
+        self.weights = weights
+        self.count = count
+
+    @classmethod
+    def build(cls, texts: Iterable[str], k1: float = default_k1, b: float = default_b) -> 'BM25Index':
+        vocabulary: Dict[str, int] = {}
+        term_ids = array('I')
+        positions = array('I')
+        frequencies = array('I')
+        lengths = array('I')
+        for position, text in enumerate(texts):
+            tokens = tokenize(text)
+            lengths.append(len(tokens))
+            for term, frequency in Counter(tokens).items():
+                term_ids.append(vocabulary.setdefault(term, len(vocabulary)))
+                positions.append(position)
+                frequencies.append(frequency)
+        count = len(lengths)
+        # utf-8 keeps the code point order, the sorted strings are sorted bytes
+        terms = sorted(vocabulary)
+        rank = np.empty(len(terms), dtype=np.uint32)
+        rank[np.array([vocabulary[term] for term in terms], dtype=np.int64)] = np.arange(len(terms), dtype=np.uint32)
+        term_ids = rank[np.array(term_ids, dtype=np.uint32)]
+        # stable, the positions of every term stay in increasing order
+        order = np.argsort(term_ids, kind='stable')
+        positions = np.array(positions, dtype=np.uint32)[order]
+        frequencies = np.array(frequencies, dtype=np.float32)[order]
+        lengths = np.array(lengths, dtype=np.float32)
+        average = max(float(lengths.mean()), 1.0) if count else 1.0
+        norms = k1 * (1 - b + b * lengths / average)
+        weights = (frequencies * (k1 + 1) / (frequencies + norms[positions])).astype(np.float32)
+        offsets = np.zeros(len(terms) + 1, dtype=np.uint64)
+        np.cumsum(np.bincount(term_ids, minlength=len(terms)), out=offsets[1:])
+        encoded = [term.encode() for term in terms]
+        term_offsets = np.zeros(len(encoded) + 1, dtype=np.uint64)
+        np.cumsum([len(term) for term in encoded], out=term_offsets[1:])
+        blob = np.frombuffer(b''.join(encoded), dtype=np.uint8)
+        logger.info("built a bm25 index of %s terms and %s postings for %s chunks", len(terms), len(positions), count)
+        return cls(term_offsets, blob, offsets, positions, weights, count)
+
+    def __len__(self):
+        return len(self.term_offsets) - 1
+
+    def _term(self, i: int) -> bytes:
+        return self.terms[self.term_offsets[i]:self.term_offsets[i + 1]].tobytes()
+
+    def find(self, term: str) -> int:
+        """
+        Returns the number of `term` in the vocabulary, -1 when no chunk contains it.
+        """
+        key = term.encode()
+        low, high = 0, len(self)
+        while low < high:
+            middle = (low + high) // 2
+            if self._term(middle) < key:
+                low = middle + 1
+            else:
+                high = middle
+        if low < len(self) and self._term(low) == key:
+            return low
+        return -1
+
+    def search(self, question: str, n: int) -> List[Tuple[float, int]]:
+        """
+        Returns the `n` chunks with the highest BM25 score as (score, position) pairs, best first.
+        Only chunks containing a term of the question are returned.
+        """
+        if n <= 0:
+            return []
+        postings = []
+        weights = []
+        for term in set(tokenize(question)):
+            i = self.find(term)
+            if i < 0:
+                continue
+            start, end = int(self.offsets[i]), int(self.offsets[i + 1])
+            idf = np.log(1 + (self.count - (end - start) + 0.5) / (end - start + 0.5))
+            postings.append(self.positions[start:end])
+            weights.append(self.weights[start:end] * np.float32(idf))
+        if not postings:
+            return []
+        # one pass over all postings, faster than adding the terms one by one
+        scores = np.bincount(np.concatenate(postings), np.concatenate(weights), minlength=self.count)
+        n = min(n, self.count)
+        top = np.argpartition(scores, -n)[-n:] if n < self.count else np.arange(self.count)
+        top = top[np.argsort(scores[top], kind='stable')[::-1]]
+        return [(float(scores[i]), int(i)) for i in top if scores[i] > 0]
+
+    def blocks(self) -> List[Tuple[str, bytes]]:
+        return [
+            ('bm25_term_offsets', np.asarray(self.term_offsets, dtype=np.uint64).tobytes()),
+            ('bm25_terms', np.asarray(self.terms, dtype=np.uint8).tobytes()),
+            ('bm25_offsets', np.asarray(self.offsets, dtype=np.uint64).tobytes()),
+            ('bm25_positions', np.asarray(self.positions, dtype=np.uint32).tobytes()),
+            ('bm25_weights', np.asarray(self.weights, dtype=np.float32).tobytes()),
+        ]
+
+
+def reciprocal_rank_fusion(rankings: Sequence[Sequence[int]], k: int = rrf_k) -> List[Tuple[float, int]]:
+    """
+    Merges rankings of positions, best first. A position scores 1 / (k + rank) in every ranking
+    it appears in, so the scales of the vector and BM25 scores do not matter.
+    """
+    fused: Dict[int, float] = {}
+    for ranking in rankings:
+        for rank, position in enumerate(ranking, 1):
+            fused[position] = fused.get(position, 0.0) + 1.0 / (k + rank)
+    return sorted(((score, position) for position, score in fused.items()), key=lambda item: -item[0])
@@ -0,0 +1,233 @@
+import hashlib
+import sqlite3
+import threading
+import time
+from collections import OrderedDict
+from typing import Dict, List, Optional, Sequence, Tuple
+
+import numpy as np
+from pymixin import log
+
+logger = log.get_logger(__name__)
+logger.addHandler(log.handler)
+
+
+def normalize_question(question: str) -> str:
+    return ' '.join(question.lower().split())
+
+
+class EmbeddingCache:
+    """
+    Maps normalized questions to their embeddings, evicting the least recently used entry
+    beyond `max_size` and expiring entries after `ttl` seconds.
+    With `path`, entries are also written to a SQLite database and survive restarts.
+    """
+
+    def __init__(self, max_size: int = 10000, ttl: float = 24 * 3600, path: Optional[str] = None):
+        self.max_size = max_size
+        self.ttl = ttl
+        self.entries: OrderedDict[str, Tuple[float, np.ndarray]] = OrderedDict()
+        self.hits = 0
+        self.misses = 0
+        self.lock = threading.Lock()
+        self.db = None
+        if path:
+            self.db = sqlite3.connect(path, check_same_thread=False)
+            self.db.execute("CREATE TABLE IF NOT EXISTS embeddings (question TEXT PRIMARY KEY, created REAL, vector BLOB)")
+            self.db.execute("DELETE FROM embeddings WHERE created < ?", (time.time() - ttl,))
+            self.db.commit()
+
+    def get(self, question: str) -> Optional[np.ndarray]:
+        key = normalize_question(question)
+        now = time.time()
+        with self.lock:
+            entry = self.entries.get(key)
+            if entry is None and self.db:
+                row = self.db.execute("SELECT created, vector FROM embeddings WHERE question = ?", (key,)).fetchone()
+                if row:
+                    entry = (row[0], np.frombuffer(row[1], dtype=np.float32))
+                    self._insert(key, entry)
+            if entry is None or now - entry[0] > self.ttl:
+                if entry is not None:
+                    self.entries.pop(key, None)
+                    if self.db:
+                        self.db.execute("DELETE FROM embeddings WHERE question = ?", (key,))
+                        self.db.commit()
+                self.misses += 1
+                return None
+            # an entry read from the database is not kept in memory with `max_size` 0
+            if key in self.entries:
+                self.entries.move_to_end(key)
+            self.hits += 1
+            return entry[1]
+
+    def put(self, question: str, embedding: np.ndarray):
+        key = normalize_question(question)
+        entry = (time.time(), np.asarray(embedding, dtype=np.float32))
+        with self.lock:
+            self._insert(key, entry)
+            if self.db:
+                self.db.execute("INSERT OR REPLACE INTO embeddings VALUES (?, ?, ?)", (key, entry[0], entry[1].tobytes()))
+                self.db.commit()
+
+    def _insert(self, key: str, entry: Tuple[float, np.ndarray]):
+        if self.max_size <= 0:
+            return
+        self.entries[key] = entry
+        self.entries.move_to_end(key)
+        while len(self.entries) > self.max_size:
+            self.entries.popitem(last=False)
+
+    def stats(self) -> Dict[str, float]:
+        total = self.hits + self.misses
+        return {
+            'size': len(self.entries),
+            'max_size': self.max_size,
+            'hits': self.hits,
+            'misses': self.misses,
+            'hit_rate': self.hits / total if total else 0.0,
+        }
+
+    def close(self):
+        if self.db:
+            self.db.close()
+            self.db = None
+
+
+class AnswerCache:
+    """
+    Remembers answers by question embedding. A question is answered from the cache when its
+    cosine similarity to a cached question is at least `threshold` and the same context chunks
+    were retrieved for it. All entries are dropped when the index version changes.
+    """
+
+    def __init__(self, max_size: int = 1000, threshold: float = 0.97, ttl: float = 24 * 3600):
+        self.max_size = max_size
+        self.threshold = threshold
+        self.ttl = ttl
+        self.index_version: Optional[str] = None
+        self.vectors: Optional[np.ndarray] = None
+        self.entries: List[Optional[Tuple[float, Tuple[str, ...], str]]] = [None] * max_size
+        self.next_slot = 0
+        self.hits = 0
+        self.misses = 0
+        self.lock = threading.Lock()
+
+    def _check_version(self, index_version: str):
+        if index_version != self.index_version:
+            if self.index_version is not None:
+                logger.info("index version changed, dropping %s cached answers", len(self))
+            self.index_version = index_version
+            self.vectors = None
+            self.entries = [None] * self.max_size
+            self.next_slot = 0
+
+    def get(self, query_embedding: np.ndarray, chunk_ids: Sequence[str], index_version: str) -> Optional[str]:
+        if self.max_size <= 0:
+            return None
+        chunk_ids = tuple(chunk_ids)
+        now = time.time()
+        with self.lock:
+            self._check_version(index_version)
+            if self.vectors is not None:
+                scores = self.vectors @ np.asarray(query_embedding, dtype=np.float32)
+                candidates = np.flatnonzero(scores >= self.threshold)
+                for slot in candidates[np.argsort(-scores[candidates])]:
+                    entry = self.entries[slot]
+                    if entry and entry[1] == chunk_ids and now - entry[0] <= self.ttl:
+                        self.hits += 1
+                        return entry[2]
+            self.misses += 1
+            return None
+
+    def put(self, query_embedding: np.ndarray, chunk_ids: Sequence[str], index_version: str, answer: str):
+        if self.max_size <= 0:
+            return
+        query_embedding = np.asarray(query_embedding, dtype=np.float32)
+        with self.lock:
+            if self.index_version is not None and index_version != self.index_version:
+                # answered from an index replaced while the answer was generated
+                return
+            self._check_version(index_version)
+            if self.vectors is None:
+                self.vectors = np.zeros((self.max_size, len(query_embedding)), dtype=np.float32)
+            # slots are reused in insertion order
+            slot = self.next_slot
+            self.next_slot = (slot + 1) % self.max_size
+            self.vectors[slot] = query_embedding
+            self.entries[slot] = (time.time(), tuple(chunk_ids), answer)
+
+    def __len__(self):
+        return sum(1 for entry in self.entries if entry)
+
+    def stats(self) -> Dict[str, float]:
+        total = self.hits + self.misses
+        return {
+            'size': len(self),
+            'max_size': self.max_size,
+            'hits': self.hits,
+            'misses': self.misses,
+            'hit_rate': self.hits / total if total else 0.0,
+        }
+
+
+class ChunkEmbeddingStore:
+    """
+    Content-addressed store of document chunk embeddings in a SQLite database, keyed by the
+    hash of the model name and the chunk text. Chunks shared by several indexes, like the
+    pages of two versions of a site, are embedded once for all of them.
+    """
+
+    # rows looked up by one query, below the SQLite limit of query parameters
+    query_size = 500
+
+    def __init__(self, path: str, model: str):
+        self.model = model
+        self.hits = 0
+        self.misses = 0
+        # several indexers may share the database
+        self.db = sqlite3.connect(path, timeout=60)
+        self.db.execute("CREATE TABLE IF NOT EXISTS chunk_embeddings (key BLOB PRIMARY KEY, vector BLOB) WITHOUT ROWID")
+        self.db.commit()
+
+    def key(self, text: str) -> bytes:
+        return hashlib.sha256(f'{self.model}\0{text}'.encode()).digest()
+
+    def get_many(self, texts: Sequence[str]) -> List[Optional[np.ndarray]]:
+        """
+        Returns the stored embedding of every text, None for the texts not stored.
+        """
+        keys = [self.key(text) for text in texts]
+        found = {}
+        for start in range(0, len(keys), self.query_size):
+            part = keys[start:start + self.query_size]
+            query = "SELECT key, vector FROM chunk_embeddings WHERE key IN (%s)" % ', '.join('?' * len(part))
+            for key, vector in self.db.execute(query, part):
+                found[key] = np.frombuffer(vector, dtype=np.float32)
+        vectors = [found.get(key) for key in keys]
+        # a text given twice counts twice
+        hits = sum(key in found for key in keys)
+        self.hits += hits
+        self.misses += len(keys) - hits
+        return vectors
+
+    def put_many(self, texts: Sequence[str], vectors: Sequence[Sequence[float]]):
+        rows = [(self.key(text), np.asarray(vector, dtype=np.float32).tobytes()) for text, vector in zip(texts, vectors)]
+        self.db.executemany("INSERT OR IGNORE INTO chunk_embeddings VALUES (?, ?)", rows)
+        self.db.commit()
+
+    def __len__(self):
+        return self.db.execute("SELECT COUNT(*) FROM chunk_embeddings").fetchone()[0]
+
+    def stats(self) -> Dict[str, float]:
+        total = self.hits + self.misses
+        return {
+            'hits': self.hits,
+            'misses': self.misses,
+            'hit_rate': self.hits / total if total else 0.0,
+        }
+
+    def close(self):
+        if self.db:
+            self.db.close()
+            self.db = None
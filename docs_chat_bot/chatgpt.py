@@ -1,14 +1,19 @@
 import asyncio
 import time
-from collections import deque
-from typing import Any, Dict, List, Optional, Tuple
+from typing import Dict, List, Optional, Tuple
 
 import numpy as np
 import openai
 import tiktoken
 from pymixin import log
 
-from .utils import count_tokens, get_embedding, top_n_similarity
+from .embedding_index import EmbeddingIndex
+from .coalescer import StreamCoalescer
+from .conversations import ConversationStore
+from .limiter import KeyLimiter
+from . import metrics, utils
+from .utils import (aget_query_embedding, context_chunk_ids, count_tokens,
+                    pack_context, prompt_overhead_tokens, search_context)
 
 logger = log.get_logger(__name__)
 logger.addHandler(log.handler)
@@ -17,91 +22,121 @@ logger.addHandler(log.handler)
 max_prompt_token = 3000
 rate_limit_size = 5
 rate_limit_window_seconds = 60
+# tokens reserved for the reply when checking the tokens per minute budget
+completion_token_estimate = 500
 
 gpt_encoding = tiktoken.encoding_for_model("gpt-3.5-turbo")
 
+guide = """
+I want you to act as an AI assistant, adept at analyzing provided text and answering questions based on the given context. When presented with extracted parts of a long document and a question, offer a conversational answer that is accurate and helpful. If the answer cannot be found within the provided context, simply respond with "Hmm, I'm not sure," without adding any speculative or extraneous information. Focus on delivering precise and reliable assistance based on the available information.
+here are some rules to follow:
+1. action name should be less than 12 characters, and only contain the following characters ".12345abcdefghijklmnopqrstuvwxyz"
+for example:
+```python
+@action("hello")
+def hello():
+    print('hello')
+```
+"hello" is less then 12 characters, and only contains characters in ".12345abcdefghijklmnopqrstuvwxyz"
+2. reply with the same language of the latest question.
+
+context:
+"""
+guide_token_count = count_tokens(guide)
+
 class RateLimitExceededError(Exception):
     pass
 
 class ChatGPTBot:
-    def __init__(self, api_key: str, embedding_docs, stream=True):
+    def __init__(self, api_key: str, embedding_docs: EmbeddingIndex, stream=True, max_in_flight: int = 8, requests_per_minute: int = 3500, tokens_per_minute: int = 90000, coalescing: Optional[Dict[str, float]] = None, conversations: Optional[ConversationStore] = None):
         openai.api_key = api_key
-
-        self.standby = False
-        self.users: Dict[str, bool] = {}
-
-        self.lock = asyncio.Lock()
+        self.api_key = api_key
+        self.limiter = KeyLimiter(max_in_flight, requests_per_minute, tokens_per_minute)
         self.stream = stream
-        self.rate_limits: Dict[str, deque] = {}
+        # StreamCoalescer options grouping the streamed tokens into messages
+        self.coalescing = coalescing or {}
+        # rate limit windows and last answers of the conversations, can be shared by several bots
+        if conversations is None:
+            conversations = ConversationStore()
+        self.conversations = conversations
         self.embedding_docs = embedding_docs
 
+    @property
+    def standby(self) -> bool:
+        return self.limiter.standby
+
     async def init(self):
         pass
 
     async def close(self):
         pass
 
-    def generate_prompt(self, conversation_id: str, question: str) -> Optional[List[Dict[str, str]]]:
-        logger.info("+++++++question: %s", question)
-        query_embedding = get_embedding(question)
-        query_embedding = np.array(query_embedding)
-        document_similarities = top_n_similarity(query_embedding, self.embedding_docs, 4)
-        guide = """
-I want you to act as an AI assistant, adept at analyzing provided text and answering questions based on the given context. When presented with extracted parts of a long document and a question, offer a conversational answer that is accurate and helpful. If the answer cannot be found within the provided context, simply respond with "Hmm, I'm not sure," without adding any speculative or extraneous information. Focus on delivering precise and reliable assistance based on the available information.
-here are some rules to follow:
-1. action name should be less than 12 characters, and only contain the following characters ".12345abcdefghijklmnopqrstuvwxyz"
-for example:
-```python
-@action("hello")
-def hello():
-    print('hello')
-```
-"hello" is less then 12 characters, and only contains characters in ".12345abcdefghijklmnopqrstuvwxyz"
-2. reply with the same language of the latest question.
+    async def search_documents(self, question: str, index: Optional[EmbeddingIndex] = None) -> Tuple[Optional[np.array], List[Tuple[float, int]]]:
+        """
+        Returns the embedding of the question and its context candidates. When the question cannot
+        be embedded and the index has a BM25 index, the embedding is None and the candidates are
+        found with the question terms only.
+        """
+        if index is None:
+            index = self.embedding_docs
+        try:
+            query_embedding = await aget_query_embedding(question)
+        except openai.error.OpenAIError as e:
+            if index.lexical is None:
+                raise
+            logger.info("embedding failed: %r, searching the question terms only", e)
+            query_embedding = None
+        # scoring a large index would block the other conversations
+        document_similarities = await asyncio.get_running_loop().run_in_executor(None, search_context, index, query_embedding, question)
+        return query_embedding, document_similarities
 
-context:
-"""
-        token_count = count_tokens(guide)
-
-        tunks = []
-        prompt = ''
-        for similarity, document in document_similarities[:3]:
-            logger.info("similarity: %s, document: %s", similarity, document[:20])
-            if similarity > 0.5:
-                tunks.append(document)
-            content = '\n'.join(tunks)
-            tmp_prompt = f'''
+    @metrics.timer('prompt')
+    def build_prompt(self, question: str, document_similarities: List[Tuple[float, int]], index: Optional[EmbeddingIndex] = None) -> Tuple[Optional[List[Dict[str, str]]], int]:
+        """
+        Packs the most similar chunks that fit in `max_prompt_token` into the prompt,
+        returns the prompt and its number of tokens.
+        `index` is the index `document_similarities` were found in, by default `embedding_docs`.
+        """
+        if index is None:
+            index = self.embedding_docs
+        # the guide is sent twice, as the system message and in the user prompt
+        prompt_tokens = 2 * guide_token_count + count_tokens(question) + prompt_overhead_tokens
+        if prompt_tokens > max_prompt_token:
+            return None, 0
+        positions, used = pack_context(index, document_similarities, max_prompt_token - prompt_tokens)
+        tunks = [index.texts[i] for i in positions]
+        for tunk in tunks:
+            logger.info("document: %s", tunk[:20])
+        content = '\n'.join(tunks)
+        prompt = f'''
 {guide}
 ###
 {content}
 ###
 Question: {question}
 Answer:'''
-            tokens_in_prompt = count_tokens(prompt)
-            if token_count + tokens_in_prompt > max_prompt_token:
-                break
-            token_count += tokens_in_prompt
-            prompt = tmp_prompt
-
-        if not prompt:
-            return "Sorry, prompt too long"
 
         context_messages = []
         context_messages.append({"role": "system", "content":  guide})
         context_messages.append({"role": "user", "content": prompt})
-        return context_messages
+        return context_messages, prompt_tokens + used
 
-    def check_rate_limit(self, conversation_id: str):
-        try:
-            request_timestamps = self.rate_limits[conversation_id]
-        except KeyError:
-            request_timestamps = deque(maxlen=rate_limit_size)
-            self.rate_limits[conversation_id] = request_timestamps
+    async def generate_prompt(self, conversation_id: str, question: str, document_similarities: Optional[List[Tuple[float, int]]] = None) -> Optional[List[Dict[str, str]]]:
+        logger.info("+++++++question: %s", question)
+        if document_similarities is None:
+            _, document_similarities = await self.search_documents(question)
+        prompt, _ = self.build_prompt(question, document_similarities)
+        return prompt
 
+    def check_rate_limit(self, conversation_id: str):
         current_time = time.time()
+        request_timestamps = self.conversations.get(conversation_id, current_time).requests
         # Remove timestamps older than the window
-        while request_timestamps and current_time - request_timestamps[0] > rate_limit_window_seconds:
-            request_timestamps.popleft()
+        expired = 0
+        while expired < len(request_timestamps) and current_time - request_timestamps[expired] > rate_limit_window_seconds:
+            expired += 1
+        if expired:
+            del request_timestamps[:expired]
 
         # Check if the request limit has been reached
         if len(request_timestamps) >= rate_limit_size:
@@ -109,6 +144,9 @@ Answer:'''
 
         request_timestamps.append(current_time)
 
+    def mark_answered(self, conversation_id: str):
+        self.conversations.get(conversation_id).answered = time.time()
+
     async def send_message(self, conversation_id: str, message: str):
         try:
             self.check_rate_limit(conversation_id)
@@ -117,86 +155,150 @@ Answer:'''
             yield str(e)
             return
 
-        async with self.lock:
+        if len(message) == 0:
+            return
+        # `embedding_docs` may be replaced by a reload, the whole question uses this one
+        index = self.embedding_docs
+        query_embedding, document_similarities = await self.search_documents(message, index)
+        answer = None
+        if query_embedding is not None:
+            chunk_ids = context_chunk_ids(index, document_similarities)
+            answer = utils.answer_cache.get(query_embedding, chunk_ids, index.version)
+        if answer is not None:
+            logger.info('++++cached response: %s', answer)
+            self.mark_answered(conversation_id)
+            yield '[BEGIN]'
             if self.stream:
-                async for msg in self._send_message_stream(conversation_id, message):
-                    yield msg
+                for paragraph in answer.split('\n\n'):
+                    if paragraph.strip():
+                        yield paragraph
             else:
-                async for msg in self._send_message(conversation_id, message):
-                    yield msg
+                yield answer
+            return
 
-    async def _send_message(self, conversation_id: str, message: str):
+        if self.stream:
+            async for msg in self._send_message_stream(conversation_id, message, query_embedding, document_similarities, index):
+                yield msg
+        else:
+            async for msg in self._send_message(conversation_id, message, query_embedding, document_similarities, index):
+                yield msg
+
+    def cache_answer(self, query_embedding: Optional[np.array], document_similarities: List[Tuple[float, int]], reply: str, index: Optional[EmbeddingIndex] = None):
+        if not reply or query_embedding is None:
+            return
+        if index is None:
+            index = self.embedding_docs
+        chunk_ids = context_chunk_ids(index, document_similarities)
+        utils.answer_cache.put(query_embedding, chunk_ids, index.version, reply)
+
+    async def _send_message(self, conversation_id: str, message: str, query_embedding: Optional[np.array], document_similarities: List[Tuple[float, int]], index: Optional[EmbeddingIndex] = None):
         if len(message) == 0:
             return
-        self.users[conversation_id] = True
+        self.mark_answered(conversation_id)
 
-        prompt = self.generate_prompt(conversation_id, message)
+        logger.info("+++++++question: %s", message)
+        prompt, prompt_tokens = self.build_prompt(message, document_similarities, index)
         # logger.info('+++prompt:%s', prompt)
         if not prompt:
             yield '[BEGIN]'
             yield 'oops, something went wrong, please try to reduce your worlds.'
             return
+        yield '[BEGIN]'
         try:
-            yield '[BEGIN]'
-            response = await openai.ChatCompletion.acreate(
-                model="gpt-3.5-turbo",
-                messages=prompt
-            )
+            async with self.limiter.slot(prompt_tokens + completion_token_estimate):
+                start_time = time.time()
+                response = await openai.ChatCompletion.acreate(
+                    model="gpt-3.5-turbo",
+                    messages=prompt,
+                    api_key=self.api_key
+                )
+                self.limiter.record_latency(time.time() - start_time)
+                metrics.observe('completion', time.time() - start_time)
+        except openai.error.RateLimitError:
+            self.limiter.record_rate_limit()
+            raise
         except openai.error.InvalidRequestError as e:
             logger.exception(e)
             yield 'Sorry, I am not available now.'
             return
         reply = response['choices'][0]['message']['content']
         logger.info('++++response: %s', reply)
-        self.add_messsage(conversation_id, message, reply)
+        self.cache_answer(query_embedding, document_similarities, reply, index)
         yield reply
         return
 
-    async def _send_message_stream(self, conversation_id: str, message: str):
+    async def _send_message_stream(self, conversation_id: str, message: str, query_embedding: Optional[np.array], document_similarities: List[Tuple[float, int]], index: Optional[EmbeddingIndex] = None):
         if len(message) == 0:
             return
-        self.users[conversation_id] = True
-        prompt = self.generate_prompt(conversation_id, message)
+        self.mark_answered(conversation_id)
+        logger.info("+++++++question: %s", message)
+        prompt, prompt_tokens = self.build_prompt(message, document_similarities, index)
         if not prompt:
             yield '[BEGIN]'
             yield 'oops, something went wrong, please try to reduce your worlds.'
             return
-        start_time = time.time()
-        try:
-            yield '[BEGIN]'
-            response = await openai.ChatCompletion.acreate(
-                model="gpt-3.5-turbo",
-                messages=prompt,
-                stream=True
-            )
-        except openai.error.InvalidRequestError as e:
-            logger.exception(e)
-            yield 'Sorry, I am not available now.'
-            return
-        collected_events = []
-        completion_text = ''
-        tokens: List[str] = []
-
-        async for event in response:
-            collected_events.append(event)  # save the event response
-            # logger.info(event)
-            delta = event['choices'][0]['delta']
-            if not delta:
-                break
-            if not 'content' in delta:
-                continue
-            event_text = delta['content']  # extract the text
-            tokens.append(event_text)
-            if event_text.endswith('\n'):
-                if time.time() - start_time > 3.0:
-                    start_time = time.time()
-                    reply = ''.join(tokens)
-                    reply = reply.strip()
-                    if reply:
-                        yield reply
-                    tokens = []
-            completion_text += event_text  # append the text
-        reply = completion_text
+        yield '[BEGIN]'
+        async with self.limiter.slot(prompt_tokens + completion_token_estimate):
+            start_time = time.time()
+            try:
+                response = await openai.ChatCompletion.acreate(
+                    model="gpt-3.5-turbo",
+                    messages=prompt,
+                    stream=True,
+                    api_key=self.api_key
+                )
+                self.limiter.record_latency(time.time() - start_time)
+            except openai.error.RateLimitError:
+                self.limiter.record_rate_limit()
+                raise
+            except openai.error.InvalidRequestError as e:
+                logger.exception(e)
+                yield 'Sorry, I am not available now.'
+                return
+            coalescer = StreamCoalescer(**self.coalescing)
+            # every piece of the completion, joined once at the end
+            pieces: List[str] = []
+
+            events = response.__aiter__()
+            # the next event is awaited as a task, the buffer is sent when it is due while the
+            # completion stalls, without cancelling the read of the stream
+            next_event = None
+            try:
+                while True:
+                    if next_event is None:
+                        next_event = asyncio.ensure_future(events.__anext__())
+                    done, _ = await asyncio.wait({next_event}, timeout=coalescer.timeout())
+                    if not done:
+                        text = coalescer.poll()
+                        if text:
+                            yield text
+                        continue
+                    try:
+                        event = next_event.result()
+                    except StopAsyncIteration:
+                        break
+                    finally:
+                        next_event = None
+                    delta = event['choices'][0]['delta']
+                    if not delta:
+                        break
+                    if not 'content' in delta:
+                        continue
+                    event_text = delta['content']  # extract the text
+                    if not pieces:
+                        metrics.observe('first_token', time.time() - start_time)
+                    pieces.append(event_text)
+                    text = coalescer.push(event_text)
+                    if text:
+                        yield text
+            finally:
+                if next_event is not None:
+                    next_event.cancel()
+            metrics.observe('completion', time.time() - start_time)
+        reply = ''.join(pieces)
         logger.info('++++response: %s', reply)
-        yield ''.join(tokens)
+        self.cache_answer(query_embedding, document_similarities, reply, index)
+        text = coalescer.flush()
+        if text and not text.isspace():
+            yield text
         return
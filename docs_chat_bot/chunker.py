@@ -0,0 +1,193 @@
+import re
+import unicodedata
+from dataclasses import dataclass
+from typing import Iterator, List, Tuple
+
+from .utils import gpt_encoding
+
+max_chunk_tokens = 500
+chunk_overlap_tokens = 50
+
+# authors used to split files by hand with a line of 100 spaces, it is still a hard break
+manual_separator = ' ' * 100
+
+_heading = re.compile(r'^(#{1,6})\s+(.*?)\s*#*\s*$')
+_fence = re.compile(r'^\s*(```|~~~)')
+
+
+@dataclass
+class Chunk:
+    text: str
+    # path of the source file, relative to the indexed directory
+    source: str
+    # anchor of the heading the chunk belongs to, empty before the first heading
+    anchor: str
+    tokens: int
+
+    @property
+    def location(self) -> str:
+        if self.anchor:
+            return f'{self.source}#{self.anchor}'
+        return self.source
+
+
+def slugify(heading: str) -> str:
+    """
+    Returns the anchor mkdocs generates for a heading, the `slugify` of markdown's toc extension.
+    """
+    slug = unicodedata.normalize('NFKD', heading).encode('ascii', 'ignore').decode('ascii')
+    slug = re.sub(r'[^\w\s-]', '', slug).strip().lower()
+    return re.sub(r'[-\s]+', '-', slug)
+
+
+def markdown_blocks(lines: Iterator[str]) -> Iterator[Tuple[str, str]]:
+    """
+    Splits markdown into (anchor, block) pairs, where a block is a heading, a paragraph or a
+    whole fenced code block, and `anchor` is the one of the heading the block belongs to.
+    An empty block marks a manual separator.
+    """
+    anchor = ''
+    block: List[str] = []
+    fence = None
+    for line in lines:
+        line = line.rstrip('\n')
+        if fence:
+            block.append(line)
+            if line.strip().startswith(fence):
+                fence = None
+                yield anchor, '\n'.join(block)
+                block = []
+            continue
+        match = _fence.match(line)
+        if match:
+            if block:
+                yield anchor, '\n'.join(block)
+            fence = match.group(1)
+            block = [line]
+            continue
+        if line.endswith(manual_separator):
+            if line.strip():
+                block.append(line.rstrip())
+            if block:
+                yield anchor, '\n'.join(block)
+                block = []
+            yield anchor, ''
+            continue
+        match = _heading.match(line)
+        if match:
+            if block:
+                yield anchor, '\n'.join(block)
+                block = []
+            anchor = slugify(match.group(2))
+            yield anchor, line
+            continue
+        if not line.strip():
+            if block:
+                yield anchor, '\n'.join(block)
+                block = []
+            continue
+        block.append(line)
+    if block:
+        yield anchor, '\n'.join(block)
+
+
+def split_tokens(tokens: List[int], max_tokens: int, overlap: int) -> Iterator[List[int]]:
+    step = max(max_tokens - overlap, 1)
+    for start in range(0, len(tokens), step):
+        yield tokens[start:start + max_tokens]
+        if start + max_tokens >= len(tokens):
+            break
+
+
+def pack_blocks(blocks: Iterator[Tuple[str, str]], source: str, max_tokens: int, overlap: int) -> Iterator[Chunk]:
+    """
+    Joins consecutive blocks of one section into chunks of at most `max_tokens` tokens.
+    A chunk starts with the last `overlap` tokens of the previous chunk of the same section,
+    and a block larger than `max_tokens` is cut into overlapping windows.
+    """
+    anchor = ''
+    pieces: List[List[int]] = []
+    size = 0
+    carry: List[int] = []
+
+    def flush():
+        nonlocal pieces, size, carry
+        tokens = [token for piece in pieces for token in piece]
+        pieces = []
+        size = 0
+        text = gpt_encoding.decode(tokens).strip()
+        if not text:
+            return None
+        carry = tokens[-overlap:] if overlap else []
+        # stripping may merge tokens, count the stored text again
+        return Chunk(text, source, anchor, len(gpt_encoding.encode(text)))
+
+    newline = gpt_encoding.encode('\n\n')
+    for block_anchor, block in blocks:
+        if block_anchor != anchor or not block:
+            chunk = flush()
+            if chunk:
+                yield chunk
+            carry = []
+            anchor = block_anchor
+            if not block:
+                continue
+        tokens = gpt_encoding.encode(block)
+        if len(tokens) > max_tokens:
+            chunk = flush()
+            if chunk:
+                yield chunk
+            for window in split_tokens(tokens, max_tokens, overlap):
+                pieces = [window]
+                chunk = flush()
+                if chunk:
+                    yield chunk
+            continue
+        if pieces and size + len(newline) + len(tokens) > max_tokens:
+            chunk = flush()
+            if chunk:
+                yield chunk
+        if not pieces and carry:
+            pieces.append(carry)
+            pieces.append(newline)
+            size = len(carry) + len(newline)
+            # drop the overlap when the block would not fit next to it
+            if size + len(tokens) > max_tokens:
+                pieces = []
+                size = 0
+        elif pieces:
+            pieces.append(newline)
+            size += len(newline)
+        pieces.append(tokens)
+        size += len(tokens)
+    chunk = flush()
+    if chunk:
+        yield chunk
+
+
+def code_blocks(lines: Iterator[str]) -> Iterator[Tuple[str, str]]:
+    """
+    Splits source code on blank lines, `#` starts a comment rather than a heading.
+    """
+    block: List[str] = []
+    for line in lines:
+        line = line.rstrip('\n')
+        if line.strip():
+            block.append(line)
+        elif block:
+            yield '', '\n'.join(block)
+            block = []
+    if block:
+        yield '', '\n'.join(block)
+
+
+def iter_chunks(path: str, source: str, max_tokens: int = max_chunk_tokens, overlap: int = chunk_overlap_tokens) -> Iterator[Chunk]:
+    """
+    Streams the chunks of a markdown or codon file, reading it line by line.
+    """
+    with open(path, 'r') as f:
+        if path.endswith('.md'):
+            blocks = markdown_blocks(f)
+        else:
+            blocks = code_blocks(f)
+        yield from pack_blocks(blocks, source, max_tokens, overlap)
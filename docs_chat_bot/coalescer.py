@@ -0,0 +1,131 @@
+import time
+from typing import List, Optional
+
+# seconds between two messages of one answer, to stay under the messaging rate limits
+default_min_interval = 2.0
+# seconds a piece waits in the buffer before it is sent at the best boundary found so far
+default_max_latency = 0.8
+# buffered bytes sent at the next sentence or paragraph end
+default_target_bytes = 600
+# buffered bytes sent even without a boundary
+default_max_bytes = 4000
+
+_sentence_ends = frozenset('.!?:;')
+# full-width punctuation is not followed by a space
+_cjk_sentence_ends = frozenset('。！？；')
+
+
+def text_size(text: str) -> int:
+    return len(text) if text.isascii() else len(text.encode())
+
+
+class StreamCoalescer:
+    """
+    Groups the pieces of a streamed completion into messages. A message ends at the best
+    boundary in the buffer: a line or sentence end, a space when nothing better was seen.
+    The buffer is sent when it holds `target_bytes` up to a line or sentence end, when its
+    oldest piece waited `max_latency` seconds or when it reaches `max_bytes`, and never
+    sooner than `min_interval` seconds after the previous message.
+    Newlines inside a fenced code block are not line ends, so code is kept together.
+    Whitespace alone is not a message, it is sent at the start of the next one.
+    """
+
+    def __init__(self, min_interval: float = default_min_interval, max_latency: float = default_max_latency, target_bytes: int = default_target_bytes, max_bytes: int = default_max_bytes):
+        self.min_interval = min_interval
+        self.max_latency = max_latency
+        self.target_bytes = target_bytes
+        self.max_bytes = max_bytes
+        self.pieces: List[str] = []
+        self.size = 0
+        # number of buffered pieces up to the last line or sentence end, and up to the last space
+        self.strong = 0
+        self.weak = 0
+        self.in_code = False
+        # whitespace taken without a message, it starts the next one
+        self.blank = ''
+        self.last_char = ''
+        self.started = 0.0
+        self.last_flush = float('-inf')
+
+    def push(self, piece: str, now: Optional[float] = None) -> Optional[str]:
+        """
+        Buffers `piece`, returns the text of a message when one is due.
+        """
+        if not piece:
+            return None
+        if now is None:
+            now = time.monotonic()
+        if not self.pieces:
+            self.started = now
+        # tokens carry the space before their word, a boundary is often found at the next piece
+        if piece[0].isspace():
+            self.weak = len(self.pieces)
+            if self.last_char in _sentence_ends:
+                self.strong = len(self.pieces)
+        elif self.last_char in _cjk_sentence_ends:
+            self.strong = len(self.pieces)
+        self.pieces.append(piece)
+        self.size += text_size(piece)
+        if '```' in piece and piece.count('```') % 2:
+            self.in_code = not self.in_code
+        self.last_char = piece[-1]
+        if self.last_char == '\n' and not self.in_code:
+            self.strong = len(self.pieces)
+        elif self.last_char.isspace():
+            self.weak = len(self.pieces)
+        return self.poll(now)
+
+    def poll(self, now: Optional[float] = None) -> Optional[str]:
+        """
+        Returns the text of a message when one is due, to be called when `timeout` expires
+        without a new piece.
+        """
+        if not self.pieces:
+            return None
+        if now is None:
+            now = time.monotonic()
+        if now - self.last_flush < self.min_interval:
+            return None
+        if self.size >= self.max_bytes:
+            return self._take(len(self.pieces), now)
+        waited = now - self.started >= self.max_latency
+        if self.strong and (waited or self.size >= self.target_bytes):
+            return self._take(self.strong, now)
+        if waited:
+            return self._take(self.weak or len(self.pieces), now)
+        return None
+
+    def timeout(self, now: Optional[float] = None) -> Optional[float]:
+        """
+        Returns the seconds until a message is due if no piece arrives, None for an empty buffer.
+        """
+        if not self.pieces:
+            return None
+        if now is None:
+            now = time.monotonic()
+        due = self.last_flush + self.min_interval
+        if self.size < self.max_bytes and not (self.strong and self.size >= self.target_bytes):
+            due = max(due, self.started + self.max_latency)
+        return max(due - now, 0.0)
+
+    def flush(self) -> str:
+        """
+        Returns the rest of the buffer, at the end of the stream.
+        """
+        text = self._take(len(self.pieces), time.monotonic()) or ''
+        text, self.blank = self.blank + text, ''
+        return text
+
+    def _take(self, count: int, now: float) -> Optional[str]:
+        text = ''.join(self.pieces[:count])
+        del self.pieces[:count]
+        self.size -= text_size(text)
+        self.strong = max(self.strong - count, 0)
+        self.weak = max(self.weak - count, 0)
+        self.started = now
+        if not text or text.isspace():
+            self.blank += text
+            return None
+        text, self.blank = self.blank + text, ''
+        self.last_flush = now
+        return text
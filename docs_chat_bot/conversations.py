@@ -0,0 +1,92 @@
+import time
+from array import array
+from collections import OrderedDict
+from typing import Dict, Optional
+
+default_max_conversations = 100000
+default_conversation_ttl = 3600.0
+
+
+class Conversation:
+    """
+    What the bots keep about one conversation: when it was last seen, the times of its
+    recent requests for the rate limit, oldest first, and when it was last answered.
+    """
+
+    __slots__ = ('last_seen', 'requests', 'answered')
+
+    def __init__(self, now: float):
+        self.last_seen = now
+        self.requests = array('d')
+        self.answered = 0.0
+
+
+class ConversationStore:
+    """
+    Keeps the state of at most `max_size` conversations, evicting the least recently seen one
+    beyond it, 0 meaning no limit. Conversations not seen for `ttl` seconds are expired lazily,
+    when they are accessed and from the least recently seen end when a conversation is added,
+    so no background task is needed. `ttl` should not be shorter than the rate limit window.
+    """
+
+    def __init__(self, max_size: int = default_max_conversations, ttl: float = default_conversation_ttl):
+        self.max_size = max_size
+        self.ttl = ttl
+        # least recently seen first
+        self.entries: OrderedDict[str, Conversation] = OrderedDict()
+        self.evictions = 0
+        self.expirations = 0
+
+    def __len__(self):
+        return len(self.entries)
+
+    def __contains__(self, key: str):
+        return self.peek(key) is not None
+
+    def peek(self, key: str, now: Optional[float] = None) -> Optional[Conversation]:
+        """
+        Returns the state of the conversation if it is kept, without marking it as seen.
+        """
+        entry = self.entries.get(key)
+        if entry is None or (time.time() if now is None else now) - entry.last_seen > self.ttl:
+            return None
+        return entry
+
+    def get(self, key: str, now: Optional[float] = None) -> Conversation:
+        """
+        Returns the state of the conversation, a new one if it was not seen within `ttl`,
+        and marks it as seen.
+        """
+        if now is None:
+            now = time.time()
+        entry = self.entries.get(key)
+        if entry is not None and now - entry.last_seen > self.ttl:
+            del self.entries[key]
+            self.expirations += 1
+            entry = None
+        if entry is not None:
+            entry.last_seen = now
+            self.entries.move_to_end(key)
+            return entry
+        self._expire(now)
+        entry = self.entries[key] = Conversation(now)
+        while self.max_size and len(self.entries) > self.max_size:
+            self.entries.popitem(last=False)
+            self.evictions += 1
+        return entry
+
+    def _expire(self, now: float):
+        while self.entries:
+            key, entry = next(iter(self.entries.items()))
+            if now - entry.last_seen <= self.ttl:
+                break
+            del self.entries[key]
+            self.expirations += 1
+
+    def stats(self) -> Dict[str, int]:
+        return {
+            'size': len(self.entries),
+            'max_size': self.max_size,
+            'evictions': self.evictions,
+            'expirations': self.expirations,
+        }
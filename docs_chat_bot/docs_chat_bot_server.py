@@ -1,17 +1,28 @@
 import argparse
+import asyncio
 import os
-import pickle
+import signal
+import threading
 import time
+import json
+from contextlib import asynccontextmanager
+from dataclasses import dataclass
+from typing import AsyncIterator, Callable, Dict, List, Optional, Tuple
 
+import aiohttp
 import numpy as np
 import openai
 import tiktoken
-from fastapi import FastAPI
+from fastapi import FastAPI, Header, Request
+from fastapi.concurrency import run_in_threadpool
+from fastapi.responses import PlainTextResponse, StreamingResponse
 from fastapi.middleware.cors import CORSMiddleware
 from pydantic import BaseModel
 
 EMBEDDING_MODEL = "text-embedding-ada-002"
 max_prompt_token = 3000
+# connections kept open to the openai api, shared by all requests
+max_http_connections = 100
 
 from pymixin import log
 
@@ -21,17 +32,28 @@ logger.addHandler(log.handler)
 
 gpt_encoding = tiktoken.encoding_for_model("gpt-3.5-turbo")
 
-from .utils import count_tokens, get_embedding, top_n_similarity
+from .embedding_index import EmbeddingIndex
+from .index_registry import IndexRegistry, warm
+from .ivf import default_nprobe
+from .quantization import default_rerank
+from . import metrics, utils
+from .cache import AnswerCache, EmbeddingCache
+from .utils import (aget_query_embedding, context_chunk_ids, count_tokens,
+                    pack_context, prompt_overhead_tokens, search_context)
 
-embeddings = None
+indexes: IndexRegistry = None
+# answer caches of the indexes other than the default one, which uses `utils.answer_cache`
+answer_caches: Dict[str, AnswerCache] = {}
+answer_cache_size = 1000
+answer_cache_threshold = 0.97
+# seconds between checks of the index files for changes, 0 disables it
+reload_interval = 5.0
+# seconds to wait for the embedding of a question before answering from the BM25 index alone
+embedding_timeout = 5.0
+# token expected in the X-Admin-Token header of admin requests, admin requests are refused without it
+admin_token = ''
 
-def query(question):
-    global embeddings
-    logger.info("+++++++question: %s", question)
-    query_embedding = get_embedding(question)
-    query_embedding = np.array(query_embedding)
-    document_similarities = top_n_similarity(query_embedding, embeddings, 4)
-    guide = """
+guide = """
 I want you to act as an AI assistant, adept at analyzing provided text and answering questions based on the given context. When presented with extracted parts of a long document and a question, offer a conversational answer that is accurate and helpful. If the answer cannot be found within the provided context, simply respond with "Hmm, I'm not sure," without adding any speculative or extraneous information. Focus on delivering precise and reliable assistance based on the available information.
 here are some rules to follow:
 1. action name should be less than 12 characters, and only contain the following characters ".12345abcdefghijklmnopqrstuvwxyz"
@@ -44,44 +66,177 @@ def hello():
 "hello" is less then 12 characters, and only contains characters in ".12345abcdefghijklmnopqrstuvwxyz"
 2. reply with the same language of the latest question.
     """
-    token_count = count_tokens(guide)
-
-    tunks = []
-    prompt = ''
-    for similarity, document in document_similarities[:3]:
-        logger.info("similarity: %s, document: %s", similarity, document[:20])
-        if similarity > 0.5:
-            tunks.append(document)
-        content = '\n'.join(tunks)
-        tmp_prompt = f'''
+guide_token_count = count_tokens(guide)
+
+http_session: Optional[aiohttp.ClientSession] = None
+
+@metrics.timer('prompt')
+def generate_prompt(index: EmbeddingIndex, question: str, search_results: List[Tuple[float, int]]) -> Optional[List[Dict[str, str]]]:
+    # the guide is sent twice, as the system message and in the user prompt
+    prompt_tokens = 2 * guide_token_count + count_tokens(question) + prompt_overhead_tokens
+    if prompt_tokens > max_prompt_token:
+        return None
+    positions, _ = pack_context(index, search_results, max_prompt_token - prompt_tokens)
+    tunks = [index.texts[i] for i in positions]
+    for tunk in tunks:
+        logger.info("document: %s", tunk[:20])
+    content = '\n'.join(tunks)
+    prompt = f'''
 {guide}
 ###
 {content}
 ###
 Question: {question}
 Answer:'''
-        tokens_in_prompt = count_tokens(prompt)
-        if token_count + tokens_in_prompt > max_prompt_token:
-            break
-        token_count += tokens_in_prompt
-        prompt = tmp_prompt
-
-    if not prompt:
-        return "Sorry, prompt too long"
 
     context_messages = []
     context_messages.append({"role": "system", "content":  guide})
     context_messages.append({"role": "user", "content": prompt})
-    response = openai.ChatCompletion.create(
-        model="gpt-3.5-turbo",
-        messages=context_messages,
-        timeout=30
-    )
+    return context_messages
+
+def get_answer_cache(index_name: Optional[str]) -> AnswerCache:
+    if not index_name or index_name == indexes.default:
+        return utils.answer_cache
+    cache = answer_caches.get(index_name)
+    if cache is None:
+        cache = answer_caches[index_name] = AnswerCache(answer_cache_size, answer_cache_threshold)
+    return cache
+
+@dataclass
+class PreparedQuery:
+    index: EmbeddingIndex
+    answer_cache: AnswerCache
+    # None when the question was answered from the lexical search alone
+    query_embedding: Optional[np.array]
+    chunk_ids: List[str]
+    answer: Optional[str] = None
+    context_messages: Optional[List[Dict[str, str]]] = None
+
+async def prepare_query(question: str, index_name: Optional[str] = None) -> PreparedQuery:
+    """
+    Embeds the question and retrieves its context from the index named `index_name`, by default
+    the first one. `answer` is set when the question can be answered without a chat completion,
+    otherwise `context_messages` holds the prompt.
+    """
+    logger.info("+++++++question: %s", question)
+    # openai uses the session from this context variable instead of opening a new one per call
+    openai.aiosession.set(http_session)
+    index = indexes.get_loaded(index_name)
+    if index is None:
+        index = await run_in_threadpool(indexes.get, index_name)
+    answer_cache = get_answer_cache(index_name)
+    try:
+        query_embedding = await asyncio.wait_for(aget_query_embedding(question), embedding_timeout)
+    except (openai.error.OpenAIError, asyncio.TimeoutError) as e:
+        # the lexical search keeps answering while the embedding api is slow or down
+        if index.lexical is None:
+            raise
+        logger.info("embedding failed: %r, searching the question terms only", e)
+        query_embedding = None
+    search_results = await run_in_threadpool(search_context, index, query_embedding, question)
+    prepared = PreparedQuery(index, answer_cache, query_embedding, context_chunk_ids(index, search_results))
+    if query_embedding is not None:
+        prepared.answer = answer_cache.get(query_embedding, prepared.chunk_ids, index.version)
+    if prepared.answer is not None:
+        logger.info("+++++++cached answer")
+        return prepared
+
+    prepared.context_messages = await run_in_threadpool(generate_prompt, index, question, search_results)
+    if not prepared.context_messages:
+        prepared.answer = "Sorry, prompt too long"
+    return prepared
+
+async def query(question, index_name: Optional[str] = None):
+    prepared = await prepare_query(question, index_name)
+    if prepared.answer is not None:
+        return prepared.answer
+    with metrics.timer('completion'):
+        response = await openai.ChatCompletion.acreate(
+            model="gpt-3.5-turbo",
+            messages=prepared.context_messages,
+            request_timeout=30
+        )
     ret = response['choices'][0]['message']['content']
     # logger.info("+++++++++ret: %s", ret)
+    if ret and prepared.query_embedding is not None:
+        prepared.answer_cache.put(prepared.query_embedding, prepared.chunk_ids, prepared.index.version, ret)
     return ret
 
-app = FastAPI()
+async def query_stream(question, index_name: Optional[str] = None) -> AsyncIterator[str]:
+    """
+    Yields the answer as the completion tokens arrive. Closing the generator closes the upstream
+    completion, so no more tokens are consumed for an abandoned request.
+    """
+    prepared = await prepare_query(question, index_name)
+    if prepared.answer is not None:
+        yield prepared.answer
+        return
+    start = time.perf_counter()
+    response = await openai.ChatCompletion.acreate(
+        model="gpt-3.5-turbo",
+        messages=prepared.context_messages,
+        stream=True,
+        request_timeout=30
+    )
+    pieces: List[str] = []
+    try:
+        async for event in response:
+            delta = event['choices'][0]['delta']
+            if 'content' in delta:
+                if not pieces:
+                    metrics.observe('first_token', time.perf_counter() - start)
+                pieces.append(delta['content'])
+                yield delta['content']
+    finally:
+        await response.aclose()
+    metrics.observe('completion', time.perf_counter() - start)
+    ret = ''.join(pieces)
+    if ret and prepared.query_embedding is not None:
+        prepared.answer_cache.put(prepared.query_embedding, prepared.chunk_ids, prepared.index.version, ret)
+
+async def reload_indexes(names: Optional[List[str]] = None) -> List[str]:
+    """
+    Reloads the named indexes, by default every loaded one, in a worker thread while the
+    current indexes keep answering. Returns the names of the reloaded indexes.
+    """
+    if names is None:
+        names = list(indexes.loaded)
+    reloaded = []
+    for name in names:
+        if await run_in_threadpool(indexes.reload, name):
+            reloaded.append(name)
+    return reloaded
+
+async def watch_indexes():
+    while True:
+        await asyncio.sleep(reload_interval)
+        try:
+            changed = await run_in_threadpool(indexes.changed)
+            if changed:
+                logger.info("index files changed: %s", changed)
+                await reload_indexes(changed)
+        except Exception as e:
+            logger.exception(e)
+
+@asynccontextmanager
+async def lifespan(app: FastAPI):
+    global http_session
+    http_session = aiohttp.ClientSession(connector=aiohttp.TCPConnector(limit=max_http_connections))
+    watcher = None
+    if indexes and reload_interval > 0:
+        watcher = asyncio.create_task(watch_indexes())
+    # signal handlers can only be set from the main thread, not when the app runs in a test client
+    if indexes and hasattr(signal, 'SIGHUP') and threading.current_thread() is threading.main_thread():
+        asyncio.get_running_loop().add_signal_handler(signal.SIGHUP, lambda: asyncio.create_task(reload_indexes()))
+    try:
+        yield
+    finally:
+        if watcher:
+            watcher.cancel()
+        await http_session.close()
+        http_session = None
+
+app = FastAPI(lifespan=lifespan)
 
 # Add CORS middleware
 app.add_middleware(
@@ -94,19 +249,31 @@ app.add_middleware(
 
 class MessageInput(BaseModel):
     message: str
+    # name of the index to answer from, the default index when not given
+    index: Optional[str] = None
+
+def check_message(data: MessageInput) -> Optional[Dict[str, str]]:
+    if len(data.message) > 1024:
+        return {
+            "status": "error",
+            "received_message": 'sorry, the message is too long'
+        }
+    if data.index and data.index not in indexes:
+        return {
+            "status": "error",
+            "received_message": f'unknown index: {data.index}'
+        }
+    return None
 
 @app.post("/chat")
 async def receive_message(data: MessageInput):
     message = data.message
     logger.info("message: %s", message)
-    if len(message) > 1024:
-        response = {
-            "status": "error",
-            "received_message": 'sorry, the message is too long'
-        }
+    response = check_message(data)
+    if response:
         return response
     try:
-        ret = query(message)
+        ret = await query(message, data.index)
         response = {
             "status": "success",
             "received_message": ret
@@ -116,8 +283,152 @@ async def receive_message(data: MessageInput):
         logger.exception(e)
     return 'oops!'
 
+def server_sent_event(data) -> str:
+    return f'data: {json.dumps(data)}\n\n'
+
+async def stream_events(request: Request, message: str, index_name: Optional[str] = None):
+    upstream = query_stream(message, index_name)
+    try:
+        async for delta in upstream:
+            if await request.is_disconnected():
+                logger.info("client disconnected, stop streaming")
+                return
+            yield server_sent_event({"delta": delta})
+        yield 'data: [DONE]\n\n'
+    except Exception as e:
+        logger.exception(e)
+        yield server_sent_event({"error": "oops!"})
+    finally:
+        await upstream.aclose()
+
+@app.post("/chat/stream")
+async def receive_message_stream(data: MessageInput, request: Request):
+    """
+    Streams the answer as server-sent events: `data: {"delta": "..."}` for every piece of text,
+    `data: {"error": "..."}` on failure and `data: [DONE]` at the end.
+    """
+    message = data.message
+    logger.info("message: %s", message)
+    response = check_message(data)
+    if response:
+        return response
+    headers = {
+        "Cache-Control": "no-cache",
+        # stop reverse proxies such as nginx from buffering the events
+        "X-Accel-Buffering": "no",
+    }
+    return StreamingResponse(stream_events(request, message, data.index), media_type="text/event-stream", headers=headers)
+
+@app.get("/stats")
+async def stats():
+    return {
+        "query_embedding_cache": utils.query_embedding_cache.stats(),
+        "answer_cache": utils.answer_cache.stats(),
+        "answer_caches": {name: cache.stats() for name, cache in answer_caches.items()},
+        "indexes": indexes.stats(),
+    }
+
+@app.get("/metrics")
+async def get_metrics():
+    return PlainTextResponse(metrics.render(), media_type=metrics.CONTENT_TYPE)
+
+class ReloadInput(BaseModel):
+    # the index to reload, every loaded index when not given
+    index: Optional[str] = None
+
+@app.post("/admin/reload")
+async def reload(data: ReloadInput, x_admin_token: str = Header('')):
+    if not admin_token or x_admin_token != admin_token:
+        return {"status": "error", "received_message": "forbidden"}
+    if data.index and data.index not in indexes:
+        return {"status": "error", "received_message": f'unknown index: {data.index}'}
+    reloaded = await reload_indexes([data.index] if data.index else None)
+    return {"status": "success", "reloaded": reloaded}
+
+@app.get("/indexes")
+async def list_indexes():
+    return {
+        "default": indexes.default,
+        "indexes": list(indexes.paths),
+    }
+
+def run_workers(config, workers: int, setup: Callable[[], None]):
+    """
+    Serves `config.app` from `workers` processes forked after the listening socket was opened
+    and the indexes loaded, so the workers share the pages of the memory-mapped index files
+    instead of each reading its own copy, and the kernel spreads the connections over them.
+    `setup` runs in every worker after the fork, for the state that cannot be shared, such as
+    SQLite connections. Workers that exit are restarted, SIGINT and SIGTERM stop the workers
+    and SIGHUP is passed on to them, each worker reloading its indexes.
+    """
+    import uvicorn
+    sock = config.bind_socket()
+    # pid -> start time
+    children: Dict[int, float] = {}
+    stopping = False
+
+    def spawn():
+        pid = os.fork()
+        if pid == 0:
+            for signum in (signal.SIGINT, signal.SIGTERM, signal.SIGHUP):
+                signal.signal(signum, signal.SIG_DFL)
+            status = 1
+            try:
+                setup()
+                uvicorn.Server(config).run(sockets=[sock])
+                status = 0
+            except BaseException as e:
+                logger.exception(e)
+            finally:
+                os._exit(status)
+        children[pid] = time.monotonic()
+
+    def stop(signum, frame):
+        nonlocal stopping
+        stopping = True
+        for pid in list(children):
+            os.kill(pid, signal.SIGTERM)
+
+    def forward(signum, frame):
+        for pid in list(children):
+            os.kill(pid, signum)
+
+    for _ in range(workers):
+        spawn()
+    signal.signal(signal.SIGINT, stop)
+    signal.signal(signal.SIGTERM, stop)
+    signal.signal(signal.SIGHUP, forward)
+    logger.info("started %s workers: %s", workers, list(children))
+    while children:
+        try:
+            pid, status = os.wait()
+        except ChildProcessError:
+            break
+        started = children.pop(pid, None)
+        if stopping or started is None:
+            continue
+        logger.info("worker %s exited with status %s, restarting it", pid, status)
+        # a worker failing at startup is not restarted in a busy loop
+        if time.monotonic() - started < 1.0:
+            time.sleep(1.0)
+        spawn()
+    sock.close()
+
+def parse_index_paths(values: List[str]) -> Dict[str, str]:
+    """
+    Parses `name=path` values, a bare path is named after its file without the extension.
+    """
+    paths = {}
+    for value in values:
+        name, sep, path = value.partition('=')
+        if not sep:
+            path = value
+            name = os.path.splitext(os.path.basename(value))[0]
+        paths[name] = path
+    return paths
+
 def main():
-    global embeddings
+    global indexes, answer_cache_size, answer_cache_threshold, reload_interval, admin_token, embedding_timeout
     import uvicorn
     parser = argparse.ArgumentParser(description="Chat-bot server")
     parser.add_argument(
@@ -144,8 +455,37 @@ def main():
     parser.add_argument(
         "--indexed-docs",
         type=str,
-        default='indexed_docs.pickle',
-        help="The file path to save the indexed output"
+        nargs='+',
+        default=['indexed_docs.index'],
+        help="The index files to serve, as `name=path` or a path named after the file, the first one is the default index, default to indexed_docs.index"
+    )
+
+    parser.add_argument(
+        "--index-dir",
+        type=str,
+        default='',
+        help="Serve every `.index` file in this directory instead, named after the file"
+    )
+
+    parser.add_argument(
+        "--default-index",
+        type=str,
+        default='',
+        help="The index used by requests not naming one, default to the first index"
+    )
+
+    parser.add_argument(
+        "--index-memory",
+        type=int,
+        default=0,
+        help="The total size in MB of the index files kept loaded, least recently used indexes are unloaded above it, default to 0 for no limit"
+    )
+
+    parser.add_argument(
+        "--workers",
+        type=int,
+        default=1,
+        help="The number of server processes, forked after the indexes are loaded so they share their memory, default to 1"
     )
 
     parser.add_argument(
@@ -162,6 +502,76 @@ def main():
         help="ssl cert file"
     )
 
+    parser.add_argument(
+        "--embedding-cache-size",
+        type=int,
+        default=10000,
+        help="The maximum number of question embeddings kept in memory, default to 10000"
+    )
+
+    parser.add_argument(
+        "--embedding-cache-ttl",
+        type=float,
+        default=24 * 3600,
+        help="The number of seconds a question embedding is cached, default to 86400"
+    )
+
+    parser.add_argument(
+        "--embedding-cache-db",
+        type=str,
+        default='',
+        help="SQLite file to persist the question embeddings across restarts"
+    )
+
+    parser.add_argument(
+        "--embedding-timeout",
+        type=float,
+        default=embedding_timeout,
+        help=f"Seconds to wait for the embedding of a question before answering from the BM25 index only, default to {embedding_timeout:g}"
+    )
+
+    parser.add_argument(
+        "--answer-cache-size",
+        type=int,
+        default=1000,
+        help="The maximum number of cached answers, 0 disables the answer cache, default to 1000"
+    )
+
+    parser.add_argument(
+        "--answer-cache-threshold",
+        type=float,
+        default=0.97,
+        help="The minimum cosine similarity between two questions to reuse a cached answer, default to 0.97"
+    )
+
+    parser.add_argument(
+        "--nprobe",
+        type=int,
+        default=default_nprobe,
+        help=f"The number of IVF lists searched per question when the index has an IVF index, more is slower and more accurate, default to {default_nprobe}"
+    )
+
+    parser.add_argument(
+        "--rerank",
+        type=int,
+        default=default_rerank,
+        help=f"The number of candidates found with the compressed vectors scored again with the float vectors, 0 disables it, default to {default_rerank}"
+    )
+
+    parser.add_argument(
+        "--reload-interval",
+        type=float,
+        default=reload_interval,
+        help=f"Seconds between checks of the index files, a changed index is reloaded without a restart, 0 disables it, default to {reload_interval:g}"
+    )
+
+    parser.add_argument(
+        "--admin-token",
+        type=str,
+        default='',
+        help="Enables `POST /admin/reload` for requests with this token in the X-Admin-Token header"
+    )
+
     args = parser.parse_args()
     host = args.host
     port = args.port
@@ -173,9 +583,29 @@ def main():
             raise ValueError('Please provide the openai api key')
     openai.api_key = api_key
 
-    with open(args.indexed_docs, 'rb') as f:
-        embeddings = pickle.load(f)
+    options = dict(default=args.default_index or None, max_bytes=args.index_memory * 1024 * 1024, nprobe=args.nprobe, rerank=args.rerank)
+    if args.index_dir:
+        indexes = IndexRegistry.from_dir(args.index_dir, **options)
+    else:
+        indexes = IndexRegistry(parse_index_paths(args.indexed_docs), **options)
+    # load the default index now, so the first question does not wait for it
+    # and forked workers share it
+    warm(indexes.get())
+    reload_interval = args.reload_interval
+    admin_token = args.admin_token
+    embedding_timeout = args.embedding_timeout
+    answer_cache_size = args.answer_cache_size
+    answer_cache_threshold = args.answer_cache_threshold
+
+    def setup():
+        utils.query_embedding_cache = EmbeddingCache(args.embedding_cache_size, args.embedding_cache_ttl, args.embedding_cache_db or None)
+        utils.answer_cache = AnswerCache(answer_cache_size, answer_cache_threshold)
 
+    if args.workers > 1:
+        config = uvicorn.Config(app, host=host, port=port, ssl_keyfile=args.ssl_keyfile or None, ssl_certfile=args.ssl_certfile or None)
+        run_workers(config, args.workers, setup)
+        return
+    setup()
     uvicorn.run(app, host=host, port=port, ssl_keyfile=args.ssl_keyfile, ssl_certfile=args.ssl_certfile)
 
 if __name__ == "__main__":
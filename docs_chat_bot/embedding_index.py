@@ -0,0 +1,491 @@
+import argparse
+import hashlib
+import json
+import os
+import pickle
+import struct
+from typing import Dict, List, Optional, Sequence, Tuple, Union
+
+import numpy as np
+from pymixin import log
+
+from .bm25 import BM25Index
+from .ivf import IVFIndex, default_nlist, default_nprobe
+from .quantization import (ProductQuantizer, ScalarQuantizer, default_pq_subspaces,
+                           default_rerank, train_quantizer)
+
+logger = log.get_logger(__name__)
+logger.addHandler(log.handler)
+
+# On-disk layout:
+#   MAGIC | uint32 format version | uint32 header size | header json | sections
+# Every section starts on an ALIGNMENT boundary, the header json holds their
+# [offset, size] under "sections":
+#   vectors       count x dim matrix of float32 or float16
+#   ids           count fixed size ascii chunk ids
+#   text_offsets  count + 1 uint64 offsets into `texts`
+#   texts         utf-8 encoded chunk texts
+#   token_counts  count uint32 token counts of the texts, optional
+#   source_offsets, sources
+#                 `path#anchor` each chunk was taken from, encoded like the texts, optional
+#   ivf_centroids, ivf_offsets, ivf_positions
+#                 nlist x dim float32 centroids, nlist + 1 uint64 list offsets and
+#                 count uint32 positions grouped by list of the IVF index, optional
+#   sq_scale, sq_offset, sq_codes
+#                 dim float32 scales and offsets and count x dim int8 codes of the
+#                 scalar quantized vectors, optional
+#   pq_codebooks, pq_codes
+#                 subspaces x 256 x (dim / subspaces) float32 centroids and
+#                 subspaces x count uint8 codes of the product quantized vectors, optional
+#   bm25_term_offsets, bm25_terms, bm25_offsets, bm25_positions, bm25_weights
+#                 sorted vocabulary encoded like the texts, terms + 1 uint64 postings offsets,
+#                 uint32 chunk positions and float32 term weights of the BM25 index, optional
+# Readers skip sections they do not know, FORMAT_VERSION only changes when
+# existing sections change.
+MAGIC = b'DCBINDEX'
+FORMAT_VERSION = 1
+ALIGNMENT = 64
+ID_SIZE = 40
+# bytes of an array copied at a time when it is written or hashed
+_SLICE_BYTES = 16 * 1024 * 1024
+
+_prefix = struct.Struct('<8sII')
+
+
+def chunk_id(text: str) -> str:
+    return hashlib.sha1(text.encode()).hexdigest()
+
+
+class TextBlock(Sequence):
+    """
+    Read-only list of strings backed by a utf-8 blob and an offsets array, decoded on access.
+    """
+
+    def __init__(self, offsets: np.ndarray, blob: np.ndarray):
+        self.offsets = offsets
+        self.blob = blob
+
+    def __len__(self):
+        return len(self.offsets) - 1
+
+    def __getitem__(self, i):
+        if isinstance(i, slice):
+            return [self[j] for j in range(*i.indices(len(self)))]
+        if i < 0:
+            i += len(self)
+        if not 0 <= i < len(self):
+            raise IndexError(i)
+        return self.blob[self.offsets[i]:self.offsets[i + 1]].tobytes().decode()
+
+
+class IdBlock(Sequence):
+    def __init__(self, ids: np.ndarray):
+        self.ids = ids
+
+    def __len__(self):
+        return len(self.ids)
+
+    def __getitem__(self, i):
+        if isinstance(i, slice):
+            return [self[j] for j in range(*i.indices(len(self)))]
+        return self.ids[i].decode()
+
+
+class EmbeddingIndex:
+    """
+    Keeps all document vectors in one contiguous float32 matrix, with the chunk ids
+    and texts in parallel lists, so a query is scored with a single matrix-vector product.
+    """
+
+    def __init__(self, vectors: np.ndarray, texts: Sequence[str], ids: Optional[Sequence[str]] = None, version: Optional[str] = None, token_counts: Optional[np.ndarray] = None, sources: Optional[Sequence[str]] = None):
+        if len(vectors) != len(texts):
+            raise ValueError("vectors and texts must have the same length")
+        self.vectors = vectors
+        self.texts = texts
+        if ids is None:
+            ids = [chunk_id(text) for text in texts]
+        self.ids = ids
+        self._version = version
+        # number of tokens of every text, precomputed at indexing time
+        self.token_counts = token_counts
+        # source file and heading anchor of every text
+        self.sources = sources
+        # approximate search over the vectors, exact search when None
+        self.ivf: Optional[IVFIndex] = None
+        self.nprobe = default_nprobe
+        # compressed copy of the vectors searched instead of them, the best `rerank`
+        # candidates are scored again with the float vectors
+        self.quantizer: Optional[Union[ScalarQuantizer, ProductQuantizer]] = None
+        self.rerank = default_rerank
+        # BM25 index of the texts fused with the vector search by `utils.search_context`
+        self.lexical: Optional[BM25Index] = None
+
+    @classmethod
+    def from_embeddings(cls, embeddings: Dict[str, np.array]) -> 'EmbeddingIndex':
+        texts = list(embeddings.keys())
+        if not texts:
+            return cls(np.zeros((0, 0), dtype=np.float32), texts)
+        vectors = np.array([embeddings[text] for text in texts], dtype=np.float32)
+        return cls(np.ascontiguousarray(vectors), texts)
+
+    @classmethod
+    def load(cls, path: str, mmap: bool = True) -> 'EmbeddingIndex':
+        """
+        Loads an index saved by `save`. The vector and text blocks are memory-mapped unless
+        `mmap` is False, so processes loading the same file share its pages.
+        Indexes pickled by older versions are still accepted.
+        """
+        with open(path, 'rb') as f:
+            prefix = f.read(_prefix.size)
+            if not prefix.startswith(MAGIC):
+                f.seek(0)
+                embeddings = pickle.load(f)
+                index = cls.from_embeddings(embeddings)
+                logger.info("loaded %s chunks from pickled index %s, convert it with `convert_indexed_docs`", len(index), path)
+                return index
+            magic, format_version, header_size = _prefix.unpack(prefix)
+            if format_version > FORMAT_VERSION:
+                raise ValueError(f"unsupported index format version {format_version} in {path}")
+            header = json.loads(f.read(header_size))
+
+        sections = header['sections']
+        count = header['count']
+
+        def section(name, dtype, shape=None):
+            offset, size = sections[name]
+            if mmap:
+                if size == 0:
+                    return np.zeros(shape or 0, dtype=dtype)
+                return np.memmap(path, dtype=dtype, mode='r', offset=offset, shape=shape or (size // np.dtype(dtype).itemsize,))
+            with open(path, 'rb') as f:
+                f.seek(offset)
+                data = np.frombuffer(f.read(size), dtype=dtype)
+            return data.reshape(shape) if shape else data
+
+        vectors = section('vectors', header['dtype'], (count, header['dim']))
+        ids = IdBlock(section('ids', f'S{ID_SIZE}'))
+        texts = TextBlock(section('text_offsets', np.uint64), section('texts', np.uint8))
+        token_counts = None
+        if 'token_counts' in sections:
+            token_counts = section('token_counts', np.uint32)
+        sources = None
+        if 'sources' in sections:
+            sources = TextBlock(section('source_offsets', np.uint64), section('sources', np.uint8))
+        index = cls(vectors, texts, ids, header['version'], token_counts, sources)
+        if 'ivf_centroids' in sections:
+            nlist = header['ivf_lists']
+            index.ivf = IVFIndex(
+                section('ivf_centroids', np.float32, (nlist, header['dim'])),
+                section('ivf_offsets', np.uint64),
+                section('ivf_positions', np.uint32)
+            )
+        compression = header.get('compression')
+        if compression and compression['kind'] == 'int8':
+            index.quantizer = ScalarQuantizer(
+                section('sq_scale', np.float32),
+                section('sq_offset', np.float32),
+                section('sq_codes', np.int8, (count, header['dim']))
+            )
+        elif compression and compression['kind'] == 'pq':
+            subspaces = compression['subspaces']
+            index.quantizer = ProductQuantizer(
+                section('pq_codebooks', np.float32, (subspaces, compression['centroids'], header['dim'] // subspaces)),
+                section('pq_codes', np.uint8, (subspaces, count))
+            )
+        if 'bm25_terms' in sections:
+            index.lexical = BM25Index(
+                section('bm25_term_offsets', np.uint64),
+                section('bm25_terms', np.uint8),
+                section('bm25_offsets', np.uint64),
+                section('bm25_positions', np.uint32),
+                section('bm25_weights', np.float32),
+                count
+            )
+        logger.info("loaded %s chunks from %s", len(index), path)
+        return index
+
+    def save(self, path: str, dtype: str = 'float32'):
+        """
+        Writes the index in the memory-mappable format read by `load`, replacing `path` atomically.
+        """
+        if dtype not in ('float32', 'float16'):
+            raise ValueError(f"unsupported vector dtype: {dtype}")
+        if isinstance(self.ids, IdBlock):
+            ids = _ArrayBlock(self.ids.ids)
+        else:
+            ids = np.array([id.encode() for id in self.ids], dtype=f'S{ID_SIZE}').tobytes()
+        offsets, texts = _encode_texts(self.texts)
+
+        blocks = [
+            ('vectors', _ArrayBlock(self.vectors, dtype)),
+            ('ids', ids),
+            ('text_offsets', offsets),
+            ('texts', texts),
+        ]
+        if self.token_counts is not None:
+            blocks.append(('token_counts', _ArrayBlock(np.asarray(self.token_counts), np.uint32)))
+        if self.sources is not None:
+            offsets, sources = _encode_texts(self.sources)
+            blocks.append(('source_offsets', offsets))
+            blocks.append(('sources', sources))
+        if self.ivf is not None:
+            blocks.append(('ivf_centroids', np.ascontiguousarray(self.ivf.centroids, dtype=np.float32).tobytes()))
+            blocks.append(('ivf_offsets', np.asarray(self.ivf.offsets, dtype=np.uint64).tobytes()))
+            blocks.append(('ivf_positions', np.asarray(self.ivf.positions, dtype=np.uint32).tobytes()))
+        compression = None
+        if self.quantizer is not None:
+            blocks.extend(self.quantizer.blocks())
+            compression = {'kind': self.quantizer.kind}
+            if self.quantizer.kind == 'pq':
+                compression['subspaces'] = self.quantizer.subspaces
+                compression['centroids'] = self.quantizer.codebooks.shape[1]
+        if self.lexical is not None:
+            blocks.extend(self.lexical.blocks())
+        header = {
+            'dim': self.dim,
+            'count': len(self),
+            'dtype': dtype,
+            'version': self.version,
+            'ivf_lists': self.ivf.nlist if self.ivf is not None else 0,
+            'compression': compression,
+            'sections': {},
+        }
+        # section offsets depend on the header size, reserve room for their digits
+        header_size = len(json.dumps(header)) + len(blocks) * 96
+        offset = _align(_prefix.size + header_size)
+        for name, data in blocks:
+            size = data.nbytes if isinstance(data, _ArrayBlock) else len(data)
+            header['sections'][name] = [offset, size]
+            offset = _align(offset + size)
+        encoded_header = json.dumps(header).encode().ljust(header_size)
+
+        tmp = path + '.tmp'
+        with open(tmp, 'wb') as f:
+            f.write(_prefix.pack(MAGIC, FORMAT_VERSION, header_size))
+            f.write(encoded_header)
+            for name, data in blocks:
+                f.seek(header['sections'][name][0])
+                if isinstance(data, _ArrayBlock):
+                    data.write(f)
+                else:
+                    f.write(data)
+        os.replace(tmp, path)
+
+    def __len__(self):
+        return len(self.texts)
+
+    @property
+    def dim(self) -> int:
+        return self.vectors.shape[1]
+
+    @property
+    def version(self) -> str:
+        """
+        Identifies the content of the index, it changes whenever a chunk is added, removed or re-embedded.
+        """
+        if self._version is None:
+            h = hashlib.sha1()
+            for id in self.ids:
+                h.update(id.encode())
+            for vectors in _slices(self.vectors):
+                h.update(vectors.tobytes())
+            self._version = h.hexdigest()
+        return self._version
+
+    def scores(self, query_embedding: np.array) -> np.ndarray:
+        query_embedding = np.asarray(query_embedding, dtype=np.float32)
+        return self.vectors @ query_embedding
+
+    def build_ivf(self, nlist: int = 0):
+        """
+        Builds the IVF index searched instead of all vectors, `nlist` defaults to about 4 * sqrt(len(self)).
+        """
+        if len(self):
+            self.ivf = IVFIndex.build(self.vectors, nlist or default_nlist(len(self)))
+
+    def compress(self, kind: str, pq_subspaces: int = default_pq_subspaces):
+        """
+        Builds the `int8` scalar quantized or `pq` product quantized copy of the vectors searched instead of them.
+        """
+        if len(self):
+            self.quantizer = train_quantizer(self.vectors, kind, pq_subspaces)
+
+    def build_lexical(self):
+        """
+        Builds the BM25 index of the texts.
+        """
+        self.lexical = BM25Index.build(self.texts)
+
+    def search(self, query_embedding: np.array, n: int) -> List[Tuple[float, int]]:
+        """
+        Returns the `n` most similar chunks as (similarity, position) pairs, most similar first.
+        With an IVF index only the vectors in its `nprobe` closest lists are scored, and fewer
+        than `n` chunks may be returned. With a quantizer the compressed vectors are scored and
+        the best `rerank` candidates are scored again with the float vectors, `rerank` 0 returns
+        the approximate similarities.
+        """
+        if n > len(self):
+            raise Exception("n is larger than the length of the list")
+        if n <= 0:
+            return []
+        query_embedding = np.asarray(query_embedding, dtype=np.float32)
+        candidates = None
+        if self.ivf is not None and self.nprobe < self.ivf.nlist:
+            candidates = self.ivf.candidates(query_embedding, self.nprobe)
+        if self.quantizer is None:
+            if candidates is None:
+                return _top(self.scores(query_embedding), n)
+            return _top(self.vectors[candidates] @ query_embedding, n, candidates)
+        scores = self.quantizer.scores(query_embedding, candidates)
+        if not self.rerank:
+            return _top(scores, n, candidates)
+        positions = np.array([i for _, i in _top(scores, max(n, self.rerank), candidates)])
+        return _top(self.vectors[positions] @ query_embedding, n, positions)
+
+
+def _top(scores: np.ndarray, n: int, positions: Optional[np.ndarray] = None) -> List[Tuple[float, int]]:
+    """
+    Returns the `n` highest scores with the positions they belong to, `scores[i]` belongs to `positions[i]`.
+    """
+    n = min(n, len(scores))
+    if n <= 0:
+        return []
+    if n < len(scores):
+        top = np.argpartition(scores, -n)[-n:]
+    else:
+        top = np.arange(len(scores))
+    top = top[np.argsort(scores[top])[::-1]]
+    if positions is None:
+        return [(float(scores[i]), int(i)) for i in top]
+    return [(float(scores[i]), int(positions[i])) for i in top]
+
+
+class IndexWriter:
+    """
+    Appends chunks and their vectors to files in `directory`, so an index is built without holding
+    its chunks in memory. `finish` returns the chunks written as an index over the memory-mapped files,
+    which `save` copies to the index file a slice at a time.
+    """
+
+    def __init__(self, directory: str):
+        self.directory = directory
+        self.files = {name: open(os.path.join(directory, name), 'wb') for name in _writer_files}
+        # bytes written to `texts` and `sources`
+        self.sizes = {'texts': 0, 'sources': 0}
+        self.files['text_offsets'].write(np.uint64(0).tobytes())
+        self.files['source_offsets'].write(np.uint64(0).tobytes())
+        self.count = 0
+        self.dim = 0
+
+    def add(self, id: str, text: str, source: str, token_count: int, vector: np.ndarray):
+        vector = np.asarray(vector, dtype=np.float32)
+        if not self.count:
+            self.dim = len(vector)
+        elif len(vector) != self.dim:
+            raise ValueError(f"vector of dimension {len(vector)} added to an index of dimension {self.dim}")
+        self.files['vectors'].write(vector.tobytes())
+        self.files['ids'].write(np.array(id.encode(), dtype=f'S{ID_SIZE}').tobytes())
+        self._append('texts', 'text_offsets', text)
+        self._append('sources', 'source_offsets', source)
+        self.files['token_counts'].write(np.uint32(token_count).tobytes())
+        self.count += 1
+
+    def _append(self, name: str, offsets: str, text: str):
+        data = text.encode()
+        self.files[name].write(data)
+        self.sizes[name] += len(data)
+        self.files[offsets].write(np.uint64(self.sizes[name]).tobytes())
+
+    def finish(self) -> 'EmbeddingIndex':
+        for f in self.files.values():
+            f.close()
+
+        def section(name, dtype, shape=None):
+            path = os.path.join(self.directory, name)
+            if os.path.getsize(path) == 0:
+                return np.zeros(shape or 0, dtype=dtype)
+            return np.memmap(path, dtype=dtype, mode='r', shape=shape)
+
+        return EmbeddingIndex(
+            section('vectors', np.float32, (self.count, self.dim)),
+            TextBlock(section('text_offsets', np.uint64), section('texts', np.uint8)),
+            IdBlock(section('ids', f'S{ID_SIZE}')),
+            token_counts=section('token_counts', np.uint32),
+            sources=TextBlock(section('source_offsets', np.uint64), section('sources', np.uint8))
+        )
+
+
+_writer_files = ('vectors', 'ids', 'text_offsets', 'texts', 'token_counts', 'source_offsets', 'sources')
+
+
+class _ArrayBlock:
+    """
+    A section written from an array a slice at a time, converted to `dtype`, so a memory-mapped
+    array is not copied into memory whole.
+    """
+
+    def __init__(self, array: np.ndarray, dtype=None):
+        self.array = array
+        self.dtype = np.dtype(dtype or array.dtype)
+        self.nbytes = array.size * self.dtype.itemsize
+
+    def write(self, f):
+        for data in _slices(self.array, self.dtype):
+            f.write(data.tobytes())
+
+
+def _slices(array: np.ndarray, dtype=None):
+    """
+    Yields contiguous copies of consecutive slices of rows of `array` of about _SLICE_BYTES.
+    """
+    row_bytes = max(array[:1].nbytes, 1)
+    rows = max(_SLICE_BYTES // row_bytes, 1)
+    for start in range(0, len(array), rows):
+        yield np.ascontiguousarray(array[start:start + rows], dtype=dtype)
+
+
+def _encode_texts(texts: Sequence[str]) -> Tuple[Union[bytes, _ArrayBlock], Union[bytes, _ArrayBlock]]:
+    if isinstance(texts, TextBlock):
+        return _ArrayBlock(texts.offsets, np.uint64), _ArrayBlock(texts.blob)
+    encoded = [text.encode() for text in texts]
+    offsets = np.zeros(len(encoded) + 1, dtype=np.uint64)
+    np.cumsum([len(text) for text in encoded], out=offsets[1:])
+    return offsets.tobytes(), b''.join(encoded)
+
+
+def _align(offset: int) -> int:
+    return (offset + ALIGNMENT - 1) // ALIGNMENT * ALIGNMENT
+
+
+def convert_main():
+    parser = argparse.ArgumentParser(description="Convert a pickled index to the memory-mapped index format")
+
+    parser.add_argument(
+        "input",
+        type=str,
+        help="The pickled index file"
+    )
+
+    parser.add_argument(
+        "--output",
+        type=str,
+        default="",
+        help="The converted index file, default to the input file with the `.index` extension"
+    )
+
+    parser.add_argument(
+        "--float16",
+        action="store_true",
+        help="Store the vectors as float16 to halve the index size"
+    )
+
+    args = parser.parse_args()
+    output = args.output
+    if not output:
+        output = os.path.splitext(args.input)[0] + '.index'
+    index = EmbeddingIndex.load(args.input)
+    index.save(output, 'float16' if args.float16 else 'float32')
+    print(f'converted {len(index)} chunks to {output}')
+
+if __name__ == "__main__":
+    convert_main()
@@ -0,0 +1,176 @@
+import os
+import threading
+from collections import OrderedDict
+from typing import Dict, List, Optional, Tuple
+
+import numpy as np
+from pymixin import log
+
+from .embedding_index import EmbeddingIndex
+from .ivf import default_nprobe
+from .quantization import default_rerank
+
+logger = log.get_logger(__name__)
+logger.addHandler(log.handler)
+
+
+def file_signature(path: str) -> Optional[Tuple[int, int, int]]:
+    """
+    Changes whenever the file is rewritten, indexes are saved to a new file moved over the old one.
+    """
+    try:
+        stat = os.stat(path)
+    except FileNotFoundError:
+        return None
+    return stat.st_ino, stat.st_mtime_ns, stat.st_size
+
+
+def warm(index: EmbeddingIndex):
+    """
+    Reads the arrays scored by every search once, so the first questions after a reload
+    do not wait for their pages to be read from disk.
+    """
+    data = index.vectors if index.quantizer is None else index.quantizer.codes
+    for start in range(0, len(data), 65536):
+        np.asarray(data[start:start + 65536]).max(initial=0)
+
+
+class IndexRegistry:
+    """
+    Named indexes served by one process. An index is loaded on first use, and the least
+    recently used indexes are unloaded when the files of the loaded indexes add up to more
+    than `max_bytes`, 0 meaning no limit. Queries holding an unloaded index keep using it
+    until they finish, its memory is released with the last reference.
+    `reload` swaps a loaded index for the current content of its file the same way.
+    """
+
+    def __init__(self, paths: Dict[str, str], default: Optional[str] = None, max_bytes: int = 0, nprobe: int = default_nprobe, rerank: int = default_rerank):
+        if not paths:
+            raise ValueError("no index to serve")
+        self.paths = paths
+        self.default = default or next(iter(paths))
+        if self.default not in paths:
+            raise ValueError(f"unknown default index: {self.default}")
+        self.max_bytes = max_bytes
+        self.nprobe = nprobe
+        self.rerank = rerank
+        # name -> (index, size, file signature), least recently used first
+        self.loaded: OrderedDict = OrderedDict()
+        self.loaded_bytes = 0
+        self.loads = 0
+        self.unloads = 0
+        self.reloads = 0
+        self.lock = threading.Lock()
+        # an index is loaded without holding `lock`, its own lock keeps it from being loaded twice
+        self.load_locks = {name: threading.Lock() for name in paths}
+
+    @classmethod
+    def from_dir(cls, dir: str, **kwargs) -> 'IndexRegistry':
+        """
+        Serves every `.index` file in `dir`, named after the file without the extension.
+        """
+        paths = {}
+        for file in sorted(os.listdir(dir)):
+            if file.endswith('.index'):
+                paths[file[:-len('.index')]] = os.path.join(dir, file)
+        return cls(paths, **kwargs)
+
+    def __contains__(self, name: str):
+        return name in self.paths
+
+    def get_loaded(self, name: Optional[str] = None) -> Optional[EmbeddingIndex]:
+        """
+        Returns the index if it is loaded, without blocking on a load.
+        """
+        name = name or self.default
+        with self.lock:
+            entry = self.loaded.get(name)
+            if entry is None:
+                return None
+            self.loaded.move_to_end(name)
+            return entry[0]
+
+    def get(self, name: Optional[str] = None) -> EmbeddingIndex:
+        """
+        Returns the index, loading it first if needed. Raises KeyError for an unknown name.
+        """
+        name = name or self.default
+        path = self.paths[name]
+        index = self.get_loaded(name)
+        if index is not None:
+            return index
+        with self.load_locks[name]:
+            # another thread may have loaded it in the meantime
+            index = self.get_loaded(name)
+            if index is not None:
+                return index
+            entry = self._load(path)
+            with self.lock:
+                self.loaded[name] = entry
+                self.loaded_bytes += entry[1]
+                self.loads += 1
+                self._evict()
+            return entry[0]
+
+    def _load(self, path: str) -> Tuple[EmbeddingIndex, int, Optional[Tuple[int, int, int]]]:
+        signature = file_signature(path)
+        index = EmbeddingIndex.load(path)
+        index.nprobe = self.nprobe
+        index.rerank = self.rerank
+        return index, os.path.getsize(path), signature
+
+    def changed(self) -> List[str]:
+        """
+        Returns the loaded indexes whose file changed since they were loaded.
+        """
+        with self.lock:
+            loaded = [(name, entry[2]) for name, entry in self.loaded.items()]
+        return [name for name, signature in loaded if file_signature(self.paths[name]) not in (None, signature)]
+
+    def reload(self, name: Optional[str] = None) -> bool:
+        """
+        Loads the index file again and swaps it in, queries already running finish with the
+        index they started with. Indexes not loaded are left to be loaded on first use.
+        Returns False when the index is not loaded or its file cannot be loaded.
+        """
+        name = name or self.default
+        path = self.paths[name]
+        with self.lock:
+            if name not in self.loaded:
+                return False
+        try:
+            # the old index keeps serving while the new one is loaded
+            entry = self._load(path)
+            warm(entry[0])
+        except Exception as e:
+            logger.exception(e)
+            return False
+        with self.lock:
+            old = self.loaded.get(name)
+            if old is None:
+                return False
+            self.loaded[name] = entry
+            self.loaded_bytes += entry[1] - old[1]
+            self.reloads += 1
+            self._evict()
+        logger.info("reloaded index %s with %s chunks", name, len(entry[0]))
+        return True
+
+    def _evict(self):
+        while self.max_bytes and self.loaded_bytes > self.max_bytes and len(self.loaded) > 1:
+            name, (_, size, _) = self.loaded.popitem(last=False)
+            self.loaded_bytes -= size
+            self.unloads += 1
+            logger.info("unloaded index %s", name)
+
+    def stats(self) -> Dict[str, object]:
+        with self.lock:
+            return {
+                'indexes': len(self.paths),
+                'loaded': list(self.loaded),
+                'loaded_bytes': self.loaded_bytes,
+                'max_bytes': self.max_bytes,
+                'loads': self.loads,
+                'unloads': self.unloads,
+                'reloads': self.reloads,
+            }
@@ -1,54 +1,352 @@
 import argparse
+import asyncio
+import itertools
+import json
 import os
-import pickle
+import random
+import tempfile
 import time
+from collections import deque
+from concurrent.futures import ProcessPoolExecutor
+from typing import Any, Dict, Iterator, List, Optional, Tuple
 
 import numpy as np
 import openai
 
 EMBEDDING_MODEL = "text-embedding-ada-002"
 
+max_batch_size = 256
+max_batch_tokens = 50000
+max_concurrency = 4
+max_retries = 6
+# processes reading and chunking the files
+max_jobs = os.cpu_count() or 1
+# files waiting between two stages of the indexer
+pipeline_queue_size = 64
+
+MANIFEST_VERSION = 1
+
 from pymixin import log
 
+from .cache import ChunkEmbeddingStore
+from .chunker import Chunk, chunk_overlap_tokens, iter_chunks, max_chunk_tokens
+from .embedding_index import EmbeddingIndex, IndexWriter, chunk_id
+from .quantization import default_pq_subspaces
+
 logger = log.get_logger(__name__)
 logger.addHandler(log.handler)
 
-def get_embedding(text: str, model: str=EMBEDDING_MODEL) -> list[float]:
-    result = openai.Embedding.create(
+async def aget_embeddings(texts: List[str], model: str=EMBEDDING_MODEL) -> List[List[float]]:
+    result = await openai.Embedding.acreate(
       model=model,
-      input=text
+      input=texts
     )
-    return result["data"][0]["embedding"]
+    data = sorted(result["data"], key=lambda item: item["index"])
+    return [item["embedding"] for item in data]
 
-def indexing_document(dir, output):
-    trunks = []
+async def embed_batch(texts: List[str], retries: int=max_retries) -> List[List[float]]:
+    delay = 1.0
+    for attempt in range(retries + 1):
+        try:
+            return await aget_embeddings(texts)
+        except (openai.error.RateLimitError, openai.error.ServiceUnavailableError, openai.error.Timeout) as e:
+            if attempt == retries:
+                raise
+            wait = delay * (1 + random.random())
+            logger.info("embedding request failed: %s, retry in %.1fs", e, wait)
+            await asyncio.sleep(wait)
+            delay = min(delay * 2, 60.0)
+
+def iter_document_files(dir):
     for root, dirs, files in os.walk(dir):
         for file in files:
-            if file.endswith('.codon'):
-                with open(os.path.join(root, file), 'r') as f:
-                    code = f.read()
-                    trunks.append(code)
-            elif file.endswith('.md'):
-                with open(os.path.join(root, file), 'r') as f:
-                    code = f.read()
-                    pieces = code.split(' '*100+'\n')
-                    for piece in pieces:
-                        trunks.append(piece.strip())
-
-    embeddings = {}
-    progress = 0
-    start = time.time()
-    for tunk in trunks:
-        progress += 1
-        if time.time() - start > 1:
-            start = time.time()
-            print(f'progress: %.2f%%' % (progress / len(trunks) * 100), end='\r')
-        embedding = get_embedding(tunk)
-        embeddings[tunk] = np.array(embedding)
-
-    with open(output, 'wb') as f:
-        pickle.dump(embeddings, f)
-    print('progress: 100.00%')
+            if file.endswith('.codon') or file.endswith('.md'):
+                yield os.path.join(root, file)
+
+def manifest_path(output):
+    return output + '.manifest.json'
+
+def load_manifest(output, chunking: List[int]) -> Dict[str, Any]:
+    try:
+        with open(manifest_path(output), 'r') as f:
+            manifest = json.load(f)
+    except FileNotFoundError:
+        return {}
+    # files chunked with other settings have to be chunked again
+    if manifest.get('version') != MANIFEST_VERSION or manifest.get('chunking') != chunking:
+        return {}
+    return manifest
+
+def write_atomic(path, data: bytes):
+    tmp = path + '.tmp'
+    with open(tmp, 'wb') as f:
+        f.write(data)
+    os.replace(tmp, path)
+
+class StageProgress:
+    """
+    Counts the items that went through each stage of the indexer and prints the count and
+    throughput of every stage at most once per `interval` seconds, on one line.
+    """
+
+    def __init__(self, stages: List[Tuple[str, str]], interval: float=1.0):
+        # stage -> unit
+        self.units = dict(stages)
+        self.counts = {stage: 0 for stage, _ in stages}
+        self.interval = interval
+        self.start = time.monotonic()
+        self.last = self.start
+
+    def add(self, stage: str, n: int=1):
+        self.counts[stage] += n
+        now = time.monotonic()
+        if now - self.last >= self.interval:
+            self.last = now
+            print(self.line(now), end='\r')
+
+    def line(self, now: Optional[float]=None) -> str:
+        elapsed = max((now or time.monotonic()) - self.start, 1e-9)
+        return ' | '.join(f'{stage} {count} {self.units[stage]} {count / elapsed:.1f}/s' for stage, count in self.counts.items())
+
+    def finish(self):
+        print(self.line())
+
+def walk_document_files(dir) -> Iterator[Tuple[str, str, os.stat_result]]:
+    """
+    Yields the path, the path relative to `dir` and the stat of every document under `dir`.
+    """
+    for path in iter_document_files(dir):
+        yield path, os.path.relpath(path, dir), os.stat(path)
+
+def chunk_file(path: str, name: str, chunk_tokens: int, chunk_overlap: int) -> List[Tuple[str, Chunk]]:
+    """
+    Reads and chunks one file, run by the processes of the chunking pool.
+    """
+    return [(chunk_id(chunk.text), chunk) for chunk in iter_chunks(path, name, chunk_tokens, chunk_overlap)]
+
+class IndexingPipeline:
+    """
+    Indexes the documents under `dir` with concurrent stages connected by bounded queues:
+    the tree is walked in a thread, files are read and chunked by `jobs` processes, batches
+    of new chunks are embedded `concurrency` requests at a time, and the chunks are appended
+    to `writer` in the order of the files as their vectors arrive. Only the chunks waiting in
+    the queues are held in memory, whatever the size of the corpus.
+
+    Chunks of `old_index` are written with their old vector, and files whose mtime and size
+    match their entry in `old_files` are taken from it without being read again. Other chunks
+    are looked up in `store` before they are embedded, and the new embeddings are added to it.
+    """
+
+    def __init__(self, dir: str, writer: IndexWriter, chunk_tokens: int=max_chunk_tokens, chunk_overlap: int=chunk_overlap_tokens, batch_size: int=max_batch_size, batch_tokens: int=max_batch_tokens, concurrency: int=max_concurrency, jobs: int=max_jobs, old_index: Optional[EmbeddingIndex]=None, old_files: Optional[Dict[str, Any]]=None, store: Optional[ChunkEmbeddingStore]=None):
+        self.dir = dir
+        self.writer = writer
+        self.chunk_tokens = chunk_tokens
+        self.chunk_overlap = chunk_overlap
+        self.batch_size = batch_size
+        self.batch_tokens = batch_tokens
+        self.concurrency = concurrency
+        self.jobs = max(jobs, 1)
+        self.old_index = old_index
+        self.old_files = old_files or {}
+        self.store = store
+        # chunk id -> position in the old index
+        self.known: Dict[str, int] = {}
+        if old_index is not None:
+            self.known = {id: i for i, id in enumerate(old_index.ids)}
+        # manifest entries of the indexed files
+        self.files: Dict[str, Any] = {}
+        # ids of the chunks already sent to the writer, duplicated chunks are embedded and written once
+        self.seen = set()
+        self.reused_files = 0
+        self.reused_chunks = 0
+        self.embedded_chunks = 0
+        self.progress = StageProgress([('discovered', 'files'), ('chunked', 'files'), ('embedded', 'chunks'), ('written', 'chunks')])
+
+    def run(self):
+        asyncio.run(self.arun())
+        self.progress.finish()
+        logger.info("%s files unchanged, %s chunks reused, %s chunks embedded, %s chunks dropped",
+            self.reused_files, self.reused_chunks, self.embedded_chunks, sum(1 for id in self.known if id not in self.seen))
+        if self.store is not None:
+            logger.info("%s chunks found in the embedding store", self.store.hits)
+
+    async def arun(self):
+        paths = asyncio.Queue(pipeline_queue_size)
+        chunked = asyncio.Queue(pipeline_queue_size)
+        batches = asyncio.Queue(self.concurrency * 2)
+        with ProcessPoolExecutor(self.jobs) as pool:
+            # the first task starts the chunking processes, before the discovery thread
+            # since forking a process running threads is unsafe
+            await asyncio.get_running_loop().run_in_executor(pool, os.getpid)
+            await asyncio.gather(self.discover(paths), self.chunk(pool, paths, chunked), self.embed(chunked, batches), self.write(batches))
+
+    async def discover(self, paths: asyncio.Queue):
+        loop = asyncio.get_running_loop()
+        walker = walk_document_files(self.dir)
+        while True:
+            found = await loop.run_in_executor(None, list, itertools.islice(walker, 256))
+            for item in found:
+                self.progress.add('discovered')
+                await paths.put(item)
+            if not found:
+                break
+        await paths.put(None)
+
+    async def chunk(self, pool: ProcessPoolExecutor, paths: asyncio.Queue, chunked: asyncio.Queue):
+        loop = asyncio.get_running_loop()
+        # files being chunked, in the order they were found
+        pending = deque()
+
+        async def emit():
+            name, stat, chunks = pending.popleft()
+            if not isinstance(chunks, list):
+                chunks = await chunks
+            self.files[name] = {'mtime': stat.st_mtime, 'size': stat.st_size, 'chunks': [id for id, _ in chunks]}
+            self.progress.add('chunked')
+            await chunked.put(chunks)
+
+        while True:
+            item = await paths.get()
+            if item is None:
+                break
+            path, name, stat = item
+            entry = self.old_files.get(name)
+            if entry and entry['mtime'] == stat.st_mtime and entry['size'] == stat.st_size \
+                    and all(id in self.known for id in entry['chunks']):
+                self.reused_files += 1
+                chunks = [(id, self.old_chunk(self.known[id])) for id in entry['chunks']]
+            else:
+                chunks = loop.run_in_executor(pool, chunk_file, path, name, self.chunk_tokens, self.chunk_overlap)
+            pending.append((name, stat, chunks))
+            if len(pending) >= self.jobs * 2:
+                await emit()
+        while pending:
+            await emit()
+        await chunked.put(None)
+
+    def old_vector(self, id: str) -> Optional[np.ndarray]:
+        position = self.known.get(id)
+        if position is None:
+            return None
+        self.reused_chunks += 1
+        return self.old_index.vectors[position]
+
+    def old_chunk(self, position: int) -> Chunk:
+        source, _, anchor = self.old_index.sources[position].partition('#')
+        return Chunk(self.old_index.texts[position], source, anchor, int(self.old_index.token_counts[position]))
+
+    async def embed(self, chunked: asyncio.Queue, batches: asyncio.Queue):
+        semaphore = asyncio.Semaphore(self.concurrency)
+        # (id, chunk, vector) of the chunks of the next batch, whose vector is None, and of the
+        # chunks with a known vector between them, written in this order
+        rows = []
+        texts = []
+        tokens = 0
+
+        async def request(texts: List[str]) -> List[List[float]]:
+            try:
+                vectors = await embed_batch(texts)
+            finally:
+                semaphore.release()
+            if self.store is not None:
+                self.store.put_many(texts, vectors)
+            self.embedded_chunks += len(texts)
+            self.progress.add('embedded', len(texts))
+            return vectors
+
+        async def flush():
+            nonlocal rows, texts, tokens
+            vectors = None
+            if texts:
+                await semaphore.acquire()
+                vectors = asyncio.ensure_future(request(texts))
+            await batches.put((rows, vectors))
+            rows, texts, tokens = [], [], 0
+
+        while True:
+            chunks = await chunked.get()
+            if chunks is None:
+                break
+            new_chunks = []
+            for id, chunk in chunks:
+                if id not in self.seen:
+                    self.seen.add(id)
+                    new_chunks.append((id, chunk))
+            chunks = new_chunks
+            vectors = [self.old_vector(id) for id, _ in chunks]
+            if self.store is not None:
+                missing = [i for i, vector in enumerate(vectors) if vector is None]
+                for i, vector in zip(missing, self.store.get_many([chunks[i][1].text for i in missing])):
+                    vectors[i] = vector
+            for (id, chunk), vector in zip(chunks, vectors):
+                if vector is None and texts and (len(texts) >= self.batch_size or tokens + chunk.tokens > self.batch_tokens):
+                    await flush()
+                rows.append((id, chunk, vector))
+                if vector is None:
+                    texts.append(chunk.text)
+                    tokens += chunk.tokens
+                elif len(rows) >= self.batch_size:
+                    await flush()
+        if rows:
+            await flush()
+        await batches.put(None)
+
+    async def write(self, batches: asyncio.Queue):
+        while True:
+            batch = await batches.get()
+            if batch is None:
+                break
+            rows, vectors = batch
+            vectors = iter(await vectors if vectors is not None else ())
+            for id, chunk, vector in rows:
+                if vector is None:
+                    vector = next(vectors)
+                self.writer.add(id, chunk.text, chunk.location, chunk.tokens, vector)
+            self.progress.add('written', len(rows))
+
+def indexing_document(dir, output, batch_size: int=max_batch_size, batch_tokens: int=max_batch_tokens, concurrency: int=max_concurrency, incremental: bool=False, dtype: str='float32', chunk_tokens: int=max_chunk_tokens, chunk_overlap: int=chunk_overlap_tokens, ivf_lists: Optional[int]=None, compression: Optional[str]=None, pq_subspaces: int=default_pq_subspaces, jobs: int=max_jobs, embedding_store: Optional[str]=None):
+    """
+    Splits every document under `dir` into chunks of at most `chunk_tokens` tokens, embeds them
+    and writes the index to `output`, together with a manifest recording the mtime, size and
+    chunk hashes of each source file. A BM25 index of the chunk texts is stored with the vectors.
+    The files are chunked by `jobs` processes while earlier chunks are embedded, see `IndexingPipeline`.
+
+    With `incremental`, files whose mtime and size match the manifest are not read again,
+    and only chunks whose hash is not in the existing index are sent to the embedding API.
+    With `embedding_store`, the path of a SQLite database shared by several indexes, chunks
+    embedded for any of them are taken from it, see `ChunkEmbeddingStore`.
+
+    With `ivf_lists`, an IVF index with that many lists (0 picks the number from the corpus size)
+    is built for approximate search. With `compression` ('int8' or 'pq'), a compressed copy
+    of the vectors is stored and searched instead of them.
+    """
+    chunking = [chunk_tokens, chunk_overlap]
+    manifest = {}
+    old_index = None
+    if incremental and os.path.exists(output):
+        old_index = EmbeddingIndex.load(output)
+        # indexes written before chunks recorded their source are chunked again
+        if old_index.sources is not None and old_index.token_counts is not None:
+            manifest = load_manifest(output, chunking)
+
+    # the chunks are written next to the output, the index built from them replaces it at the end
+    with tempfile.TemporaryDirectory(prefix=os.path.basename(output) + '.', dir=os.path.dirname(os.path.abspath(output))) as spill:
+        store = ChunkEmbeddingStore(embedding_store, EMBEDDING_MODEL) if embedding_store else None
+        pipeline = IndexingPipeline(dir, IndexWriter(spill), chunk_tokens, chunk_overlap, batch_size, batch_tokens, concurrency, jobs, old_index, manifest.get('files', {}), store)
+        try:
+            pipeline.run()
+        finally:
+            if store is not None:
+                store.close()
+        index = pipeline.writer.finish()
+        index.build_lexical()
+        if ivf_lists is not None:
+            index.build_ivf(ivf_lists)
+        if compression:
+            index.compress(compression, pq_subspaces)
+        index.save(output, dtype)
+        del index
+    write_atomic(manifest_path(output), json.dumps({'version': MANIFEST_VERSION, 'chunking': chunking, 'files': pipeline.files}).encode())
 
 def indexing_main():
     parser = argparse.ArgumentParser(description="Chat-bot indexer")
@@ -63,7 +361,7 @@ def indexing_main():
     parser.add_argument(
         "--output",
         type=str,
-        default="indexed_docs.pickle",
+        default="indexed_docs.index",
         help="The file path to save the indexed output"
     )
 
@@ -74,6 +372,95 @@ def indexing_main():
         help="The file path to save the indexed output"
     )
 
+    parser.add_argument(
+        "--batch-size",
+        type=int,
+        default=max_batch_size,
+        help=f"The maximum number of chunks sent in one embedding request, default to {max_batch_size}"
+    )
+
+    parser.add_argument(
+        "--batch-tokens",
+        type=int,
+        default=max_batch_tokens,
+        help=f"The maximum number of tokens sent in one embedding request, default to {max_batch_tokens}"
+    )
+
+    parser.add_argument(
+        "--concurrency",
+        type=int,
+        default=max_concurrency,
+        help=f"The number of embedding requests running at the same time, default to {max_concurrency}"
+    )
+
+    parser.add_argument(
+        "--incremental",
+        action="store_true",
+        help="Only embed chunks that changed since the last run, based on the manifest saved next to the output"
+    )
+
+    parser.add_argument(
+        "--chunk-tokens",
+        type=int,
+        default=max_chunk_tokens,
+        help=f"The maximum number of tokens of a document chunk, default to {max_chunk_tokens}"
+    )
+
+    parser.add_argument(
+        "--chunk-overlap",
+        type=int,
+        default=chunk_overlap_tokens,
+        help=f"The number of tokens shared by consecutive chunks of a section, default to {chunk_overlap_tokens}"
+    )
+
+    parser.add_argument(
+        "--ivf",
+        action="store_true",
+        help="Build an IVF index for approximate search over large corpora"
+    )
+
+    parser.add_argument(
+        "--ivf-lists",
+        type=int,
+        default=0,
+        help="The number of IVF lists, default to about 4 * sqrt(number of chunks)"
+    )
+
+    parser.add_argument(
+        "--compression",
+        type=str,
+        choices=['int8', 'pq'],
+        default=None,
+        help="Also store the vectors compressed to int8 (4x smaller) or with product quantization (32x smaller with 192 subspaces), searched instead of the float vectors"
+    )
+
+    parser.add_argument(
+        "--pq-subspaces",
+        type=int,
+        default=default_pq_subspaces,
+        help=f"The number of bytes per vector with `--compression pq`, must divide the embedding dimension, default to {default_pq_subspaces}"
+    )
+
+    parser.add_argument(
+        "--jobs",
+        type=int,
+        default=max_jobs,
+        help="The number of processes reading and chunking the documents, default to the number of cores"
+    )
+
+    parser.add_argument(
+        "--embedding-store",
+        type=str,
+        default='',
+        help="SQLite file of chunk embeddings shared by several indexes, chunks already embedded for any of them are not sent to the API again"
+    )
+
+    parser.add_argument(
+        "--float16",
+        action="store_true",
+        help="Store the vectors as float16 to halve the index size"
+    )
+
     args = parser.parse_args()
     
     api_key = args.api_key
@@ -86,7 +473,7 @@ def indexing_main():
     openai.api_key = api_key
     document_dir = args.dir
     indexed_file = args.output
-    indexing_document(document_dir, indexed_file)
+    indexing_document(document_dir, indexed_file, args.batch_size, args.batch_tokens, args.concurrency, args.incremental, 'float16' if args.float16 else 'float32', args.chunk_tokens, args.chunk_overlap, args.ivf_lists if args.ivf else None, args.compression, args.pq_subspaces, args.jobs, args.embedding_store or None)
 
 if __name__ == "__main__":
     indexing_main()
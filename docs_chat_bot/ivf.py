@@ -0,0 +1,99 @@
+import numpy as np
+from pymixin import log
+
+logger = log.get_logger(__name__)
+logger.addHandler(log.handler)
+
+kmeans_iterations = 10
+# centroids are trained on a sample of this many vectors per list
+training_sample_per_list = 256
+default_nprobe = 32
+
+
+def kmeans(vectors: np.ndarray, k: int, iterations: int = kmeans_iterations, seed: int = 0, spherical: bool = True) -> np.ndarray:
+    """
+    Spherical k-means by default: vectors are assigned to the centroid with the largest dot product,
+    which is the cosine similarity for the normalized openai embeddings.
+    Without `spherical`, vectors are assigned to the nearest centroid and centroids are not normalized.
+    """
+    rng = np.random.default_rng(seed)
+    vectors = np.asarray(vectors, dtype=np.float32)
+    centroids = vectors[rng.choice(len(vectors), k, replace=False)].copy()
+    for _ in range(iterations):
+        assignments = assign(vectors, centroids, spherical)
+        counts = np.bincount(assignments, minlength=k)
+        order = np.argsort(assignments, kind='stable')
+        starts = np.cumsum(counts) - counts
+        sums = np.zeros_like(centroids)
+        filled = counts > 0
+        sums[filled] = np.add.reduceat(vectors[order], starts[filled], axis=0)
+        # restart empty lists from random vectors
+        empty = counts == 0
+        sums[empty] = vectors[rng.choice(len(vectors), int(empty.sum()))]
+        if spherical:
+            centroids = sums / np.maximum(np.linalg.norm(sums, axis=1, keepdims=True), 1e-12)
+        else:
+            centroids = sums / np.maximum(counts, 1)[:, None]
+    return centroids.astype(np.float32)
+
+
+def assign(vectors: np.ndarray, centroids: np.ndarray, spherical: bool = True, batch_size: int = 65536) -> np.ndarray:
+    assignments = np.empty(len(vectors), dtype=np.int64)
+    # the nearest centroid maximizes x.c - |c|^2 / 2
+    bias = 0 if spherical else (centroids * centroids).sum(axis=1) / 2
+    for start in range(0, len(vectors), batch_size):
+        batch = np.asarray(vectors[start:start + batch_size], dtype=np.float32)
+        assignments[start:start + batch_size] = np.argmax(batch @ centroids.T - bias, axis=1)
+    return assignments
+
+
+class IVFIndex:
+    """
+    Inverted file index: the vectors are grouped into `nlist` lists around k-means centroids,
+    and a query only scores the vectors in the `nprobe` lists closest to it.
+    Raising `nprobe` trades latency for recall, `nprobe == nlist` is an exact search.
+    """
+
+    def __init__(self, centroids: np.ndarray, offsets: np.ndarray, positions: np.ndarray):
+        self.centroids = centroids
+        # positions of the vectors of list i are positions[offsets[i]:offsets[i + 1]]
+        self.offsets = offsets
+        self.positions = positions
+
+    @classmethod
+    def build(cls, vectors: np.ndarray, nlist: int, iterations: int = kmeans_iterations, seed: int = 0) -> 'IVFIndex':
+        nlist = min(nlist, len(vectors))
+        rng = np.random.default_rng(seed)
+        sample_size = min(len(vectors), nlist * training_sample_per_list)
+        sample = np.asarray(vectors[np.sort(rng.choice(len(vectors), sample_size, replace=False))], dtype=np.float32)
+        centroids = kmeans(sample, nlist, iterations, seed)
+        assignments = assign(vectors, centroids)
+        positions = np.argsort(assignments, kind='stable').astype(np.uint32)
+        offsets = np.zeros(nlist + 1, dtype=np.uint64)
+        np.cumsum(np.bincount(assignments, minlength=nlist), out=offsets[1:])
+        logger.info("built %s inverted lists for %s vectors", nlist, len(vectors))
+        return cls(centroids, offsets, positions)
+
+    @property
+    def nlist(self) -> int:
+        return len(self.centroids)
+
+    def candidates(self, query_embedding: np.ndarray, nprobe: int) -> np.ndarray:
+        """
+        Returns the positions of the vectors in the `nprobe` lists closest to the query.
+        """
+        nprobe = min(nprobe, self.nlist)
+        scores = self.centroids @ query_embedding
+        if nprobe < self.nlist:
+            lists = np.argpartition(scores, -nprobe)[-nprobe:]
+        else:
+            lists = np.arange(self.nlist)
+        return np.concatenate([self.positions[self.offsets[i]:self.offsets[i + 1]] for i in lists])
+
+
+def default_nlist(count: int) -> int:
+    """
+    The usual rule of thumb of about 4 * sqrt(count) lists.
+    """
+    return max(1, int(4 * np.sqrt(count)))
+
@@ -39,12 +39,17 @@
           chatInput.value = '';
         }
         
+        if (mkdocs_chat_plugin['docs_chat_stream_endpoint']) {
+          await chatDialogPlugin.streamReply(inputMessage, chatBody);
+          return;
+        }
+
         let ret = await fetch(mkdocs_chat_plugin['docs_chat_endpoint'], {
           method: 'POST',
           headers: {
             'Content-Type': 'application/json',
           },
-          body: JSON.stringify({ message: inputMessage}),
+          body: JSON.stringify({ message: inputMessage, index: mkdocs_chat_plugin['docs_chat_index']}),
         });
         ret = await ret.json();
         console.log("+++++++ret:", ret);
@@ -58,6 +63,56 @@
         chatBody.appendChild(message);
         chatBody.scrollTop = chatBody.scrollHeight;
       },
+
+      // read the server-sent events of the stream endpoint and show the text as it arrives
+      streamReply: async function (inputMessage, chatBody) {
+        const message = document.createElement('div');
+        message.style.whiteSpace = 'pre-wrap';
+        message.classList.add('message');
+        chatBody.appendChild(message);
+
+        const ret = await fetch(mkdocs_chat_plugin['docs_chat_stream_endpoint'], {
+          method: 'POST',
+          headers: {
+            'Content-Type': 'application/json',
+          },
+          body: JSON.stringify({ message: inputMessage, index: mkdocs_chat_plugin['docs_chat_index']}),
+        });
+        if (!ret.ok) {
+          message.innerText = 'oops! the server answered ' + ret.status;
+          return;
+        }
+        if (!(ret.headers.get('Content-Type') || '').startsWith('text/event-stream')) {
+          const data = await ret.json();
+          message.innerText = data.received_message;
+          return;
+        }
+
+        const reader = ret.body.getReader();
+        const decoder = new TextDecoder();
+        let buffer = '';
+        while (true) {
+          const { done, value } = await reader.read();
+          if (done) {
+            break;
+          }
+          buffer += decoder.decode(value, { stream: true });
+          const events = buffer.split('\n\n');
+          buffer = events.pop();
+          for (const event of events) {
+            if (!event.startsWith('data: ')) {
+              continue;
+            }
+            const data = event.slice(6);
+            if (data === '[DONE]') {
+              return;
+            }
+            const parsed = JSON.parse(data);
+            message.innerText += parsed.delta !== undefined ? parsed.delta : parsed.error;
+            chatBody.scrollTop = chatBody.scrollHeight;
+          }
+        }
+      },
     };
   
     window.chatDialogPlugin = chatDialogPlugin;
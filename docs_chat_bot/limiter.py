@@ -0,0 +1,131 @@
+import asyncio
+import time
+from collections import deque
+from contextlib import asynccontextmanager
+from typing import Deque, Optional, Tuple
+
+from pymixin import log
+
+logger = log.get_logger(__name__)
+logger.addHandler(log.handler)
+
+# budgets are counted over a sliding window of this many seconds
+window_seconds = 60.0
+# weight of the latest sample in the latency moving average
+latency_alpha = 0.2
+max_backoff_seconds = 60.0
+
+
+class KeyLimiter:
+    """
+    Admits requests made with one api key as long as the number of requests in flight,
+    the requests per minute and the tokens per minute stay within their budgets.
+    Waiting requests are admitted as soon as capacity frees up instead of one at a time.
+    """
+
+    def __init__(self, max_in_flight: int = 8, requests_per_minute: int = 3500, tokens_per_minute: int = 90000):
+        self.max_in_flight = max_in_flight
+        self.requests_per_minute = requests_per_minute
+        self.tokens_per_minute = tokens_per_minute
+        self.in_flight = 0
+        self.waiting = 0
+        # (timestamp, tokens) of the requests admitted inside the window
+        self.history: Deque[Tuple[float, int]] = deque()
+        self.tokens_in_window = 0
+        self.condition = asyncio.Condition()
+        self.latency = 1.0
+        self.backoff = 0.0
+        self.backoff_until = 0.0
+
+    def _prune(self, now: float):
+        while self.history and now - self.history[0][0] > window_seconds:
+            _, tokens = self.history.popleft()
+            self.tokens_in_window -= tokens
+
+    def _delay(self, tokens: int, now: float) -> Optional[float]:
+        """
+        Returns 0 when a request of `tokens` can be admitted now, otherwise the number of seconds
+        until the window frees enough budget, or None when it has to wait for a release.
+        """
+        if self.in_flight >= self.max_in_flight:
+            return None
+        delay = self.backoff_until - now
+        if len(self.history) >= self.requests_per_minute:
+            delay = max(delay, self.history[len(self.history) - self.requests_per_minute][0] + window_seconds - now)
+        # a request larger than the whole budget is admitted once the window is empty
+        excess = self.tokens_in_window + tokens - self.tokens_per_minute
+        if excess > 0 and self.history:
+            freed = 0
+            for timestamp, used in self.history:
+                freed += used
+                if freed >= excess:
+                    break
+            delay = max(delay, timestamp + window_seconds - now)
+        return max(delay, 0.0)
+
+    @property
+    def standby(self) -> bool:
+        """
+        True while backing off after a rate limit error.
+        """
+        return time.time() < self.backoff_until
+
+    def record_latency(self, seconds: float):
+        self.latency += latency_alpha * (seconds - self.latency)
+        self.backoff = 0.0
+
+    def record_rate_limit(self):
+        self.backoff = min(max(self.backoff * 2, 1.0), max_backoff_seconds)
+        self.backoff_until = time.time() + self.backoff
+        logger.info("rate limited, standby for %.1fs", self.backoff)
+
+    def expected_wait(self, tokens: int = 0) -> float:
+        """
+        Estimates how long a new request would take to complete with this key,
+        used to route each request to the key with the most available capacity.
+        """
+        now = time.time()
+        self._prune(now)
+        delay = self._delay(tokens, now)
+        wait = self.latency * (1 + (self.in_flight + self.waiting) / self.max_in_flight)
+        if delay is not None:
+            wait += delay
+        return wait
+
+    def available(self, tokens: int = 0) -> bool:
+        now = time.time()
+        self._prune(now)
+        return self._delay(tokens, now) == 0.0
+
+    async def acquire(self, tokens: int = 0):
+        async with self.condition:
+            self.waiting += 1
+            try:
+                while True:
+                    now = time.time()
+                    self._prune(now)
+                    delay = self._delay(tokens, now)
+                    if delay == 0.0:
+                        break
+                    try:
+                        await asyncio.wait_for(self.condition.wait(), delay)
+                    except asyncio.TimeoutError:
+                        pass
+            finally:
+                self.waiting -= 1
+            self.in_flight += 1
+            self.history.append((now, tokens))
+            self.tokens_in_window += tokens
+
+    async def release(self):
+        async with self.condition:
+            self.in_flight -= 1
+            self.condition.notify_all()
+
+    @asynccontextmanager
+    async def slot(self, tokens: int = 0):
+        await self.acquire(tokens)
+        try:
+            yield
+        finally:
+            await self.release()
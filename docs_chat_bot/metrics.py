@@ -0,0 +1,147 @@
+import threading
+import time
+from bisect import bisect_left
+from contextlib import contextmanager
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+from typing import Dict, List, Sequence, Tuple
+
+from pymixin import log
+
+logger = log.get_logger(__name__)
+logger.addHandler(log.handler)
+
+# upper bounds in seconds of the latency buckets, from a cached embedding to a long completion
+latency_buckets = (0.001, 0.0025, 0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1.0, 2.5, 5.0, 10.0, 30.0, 60.0)
+CONTENT_TYPE = 'text/plain; version=0.0.4; charset=utf-8'
+
+
+def _format(value: float) -> str:
+    if value == float('inf'):
+        return '+Inf'
+    return repr(float(value))
+
+
+class Histogram:
+    """
+    Counts observations per value of one label in cumulative buckets, rendered in the
+    Prometheus text format.
+    """
+
+    def __init__(self, name: str, help: str, label: str, buckets: Sequence[float] = latency_buckets):
+        self.name = name
+        self.help = help
+        self.label = label
+        self.buckets = tuple(buckets)
+        # label value -> (per bucket counts, the last one for values above every bound, sum)
+        self.series: Dict[str, Tuple[List[int], List[float]]] = {}
+        self.lock = threading.Lock()
+
+    def observe(self, label_value: str, value: float):
+        i = bisect_left(self.buckets, value)
+        with self.lock:
+            series = self.series.get(label_value)
+            if series is None:
+                series = self.series[label_value] = ([0] * (len(self.buckets) + 1), [0.0])
+            series[0][i] += 1
+            series[1][0] += value
+
+    def count(self, label_value: str) -> int:
+        with self.lock:
+            series = self.series.get(label_value)
+            return sum(series[0]) if series else 0
+
+    def render(self) -> List[str]:
+        lines = [f'# HELP {self.name} {self.help}', f'# TYPE {self.name} histogram']
+        with self.lock:
+            series = [(value, list(counts), total[0]) for value, (counts, total) in sorted(self.series.items())]
+        for value, counts, total in series:
+            cumulative = 0
+            for bound, count in zip(self.buckets + (float('inf'),), counts):
+                cumulative += count
+                lines.append(f'{self.name}_bucket{{{self.label}="{value}",le="{_format(bound)}"}} {cumulative}')
+            lines.append(f'{self.name}_sum{{{self.label}="{value}"}} {_format(total)}')
+            lines.append(f'{self.name}_count{{{self.label}="{value}"}} {cumulative}')
+        return lines
+
+
+class Gauge:
+    def __init__(self, name: str, help: str):
+        self.name = name
+        self.help = help
+        self.value = 0.0
+
+    def set(self, value: float):
+        self.value = float(value)
+
+    def render(self) -> List[str]:
+        return [f'# HELP {self.name} {self.help}', f'# TYPE {self.name} gauge', f'{self.name} {_format(self.value)}']
+
+
+stage_seconds = Histogram(
+    'docs_chat_bot_stage_seconds',
+    'Seconds spent in each stage of answering a question: embedding, retrieval, prompt, first_token, completion, mixin_send',
+    'stage'
+)
+top_similarity = Gauge(
+    'docs_chat_bot_retrieval_top_similarity',
+    'Similarity of the best chunk retrieved for the last question'
+)
+context_chunks = Gauge(
+    'docs_chat_bot_retrieval_context_chunks',
+    'Number of chunks retrieved for the last question above the similarity threshold'
+)
+registry = [stage_seconds, top_similarity, context_chunks]
+
+
+def observe(stage: str, seconds: float):
+    stage_seconds.observe(stage, seconds)
+
+
+@contextmanager
+def timer(stage: str):
+    """
+    Records the time spent in the block as one observation of `stage`, failures included.
+    """
+    start = time.perf_counter()
+    try:
+        yield
+    finally:
+        observe(stage, time.perf_counter() - start)
+
+
+def record_retrieval(similarities: Sequence[float], threshold: float):
+    top_similarity.set(max(similarities, default=0.0))
+    context_chunks.set(sum(1 for similarity in similarities if similarity > threshold))
+
+
+def render() -> str:
+    lines = []
+    for metric in registry:
+        lines.extend(metric.render())
+    return '\n'.join(lines) + '\n'
+
+
+class MetricsHandler(BaseHTTPRequestHandler):
+    def do_GET(self):
+        if self.path.split('?')[0] != '/metrics':
+            self.send_error(404)
+            return
+        body = render().encode()
+        self.send_response(200)
+        self.send_header('Content-Type', CONTENT_TYPE)
+        self.send_header('Content-Length', str(len(body)))
+        self.end_headers()
+        self.wfile.write(body)
+
+    def log_message(self, format, *args):
+        pass
+
+
+def start_http_server(port: int, host: str = '127.0.0.1') -> ThreadingHTTPServer:
+    """
+    Serves `GET /metrics` from a daemon thread, for processes without a web server like the Mixin bot.
+    """
+    server = ThreadingHTTPServer((host, port), MetricsHandler)
+    threading.Thread(target=server.serve_forever, daemon=True).start()
+    logger.info("serving metrics at http://%s:%s/metrics", host, server.server_address[1])
+    return server
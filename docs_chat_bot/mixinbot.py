@@ -3,14 +3,12 @@
 import argparse
 import asyncio
 import base64
-import pickle
 import signal
 import sys
 import time
 import traceback
 from dataclasses import dataclass
-from datetime import datetime
-from typing import Any, Dict, List, Optional, Set, Union
+from typing import List, Optional
 
 import httpx
 import websockets
@@ -18,6 +16,10 @@ import yaml
 from pymixin import log, utils
 from pymixin.mixin_ws_api import MessageView, MixinWSApi
 
+from . import metrics
+from .index_registry import file_signature, warm
+from .question_queue import QuestionQueue, SavedQuestion
+
 logger = log.get_logger(__name__)
 logger.addHandler(log.handler)
 
@@ -27,12 +29,6 @@ class AnswerRequestTask:
     user_id: str
     task: asyncio.Task
 
-@dataclass
-class SavedQuestion:
-    conversation_id: str
-    user_id: str
-    data: str
-
 sayhi = {
     'hi': '''
 Hello, this is an Q&A robot about Python Smart Contracts Development. Is there anything I can help you with?
@@ -53,14 +49,50 @@ class MixinBot(MixinWSApi):
         config = yaml.safe_load(f)
         super().__init__(config['bot_config'], on_message=self.on_message)
         self.openai_api_keys = config['openai_api_keys']
-
-        with open(config['indexed_docs'], 'rb') as f:
-            self.indexed_docs = pickle.load(f)
+        self.openai_limits = config.get('openai_limits', {})
+        # how streamed answers are grouped into messages, see StreamCoalescer
+        self.stream_coalescing = config.get('stream_coalescing', {})
+        from .conversations import (ConversationStore, default_conversation_ttl,
+                                    default_max_conversations)
+        # shared by the bots, so a user has one rate limit whichever key answers
+        self.conversations = ConversationStore(
+            config.get('max_conversations', default_max_conversations),
+            config.get('conversation_ttl', default_conversation_ttl)
+        )
+
+        from . import utils as chat_utils
+        from .cache import AnswerCache, EmbeddingCache
+        from .ivf import default_nprobe
+        from .quantization import default_rerank
+        self.indexed_docs_path = config['indexed_docs']
+        self.nprobe = config.get('nprobe', default_nprobe)
+        self.rerank = config.get('rerank', default_rerank)
+        # seconds between checks of the index file for changes, 0 disables it
+        self.index_reload_interval = config.get('index_reload_interval', 5)
+        self.indexed_docs_signature = file_signature(self.indexed_docs_path)
+        self.indexed_docs = self.load_index()
+        cache_config = config.get('embedding_cache', {})
+        chat_utils.query_embedding_cache = EmbeddingCache(
+            cache_config.get('size', 10000),
+            cache_config.get('ttl', 24 * 3600),
+            cache_config.get('db')
+        )
+        answer_cache_config = config.get('answer_cache', {})
+        chat_utils.answer_cache = AnswerCache(
+            answer_cache_config.get('size', 1000),
+            answer_cache_config.get('threshold', 0.97),
+            answer_cache_config.get('ttl', 24 * 3600)
+        )
 
         self.client_id = config['bot_config']['client_id']
 
         self.tasks: List[SavedQuestion] = []
-        self.saved_questions: Dict[str, SavedQuestion] = {}
+        # questions that could not be answered right away, optionally kept across restarts
+        self.question_queue = QuestionQueue(config.get('pending_questions_file'))
+        self.question_deadline = config.get('question_deadline', 600)
+        # port of the prometheus `/metrics` endpoint, 0 disables it
+        self.metrics_port = config.get('metrics_port', 0)
+        self.metrics_host = config.get('metrics_host', '127.0.0.1')
 
         self.developer_conversation_id = None
         self.developer_user_id = None
@@ -88,7 +120,12 @@ class MixinBot(MixinWSApi):
         if self.openai_api_keys:
             from .chatgpt import ChatGPTBot
             for key in self.openai_api_keys:
-                bot = ChatGPTBot(key, self.indexed_docs)
+                # an entry is either the api key or a mapping with the key and its own limits
+                limits = dict(self.openai_limits)
+                if isinstance(key, dict):
+                    limits.update(key)
+                    key = limits.pop('key')
+                bot = ChatGPTBot(key, self.indexed_docs, coalescing=self.stream_coalescing, conversations=self.conversations, **limits)
                 await bot.init()
                 self.bots.append(bot)
         
@@ -97,6 +134,47 @@ class MixinBot(MixinWSApi):
         loop = asyncio.get_running_loop()
         loop.add_signal_handler(signal.SIGINT, lambda: asyncio.create_task(self.handle_signal(signal.SIGINT)))
         loop.add_signal_handler(signal.SIGTERM, lambda: asyncio.create_task(self.handle_signal(signal.SIGTERM)))
+        loop.add_signal_handler(signal.SIGHUP, lambda: asyncio.create_task(self.reload_index()))
+        if self.index_reload_interval > 0:
+            asyncio.create_task(self.watch_index())
+        if self.metrics_port:
+            metrics.start_http_server(self.metrics_port, self.metrics_host)
+
+    async def sendUserText(self, *args, **kwargs):
+        with metrics.timer('mixin_send'):
+            return await super().sendUserText(*args, **kwargs)
+
+    def load_index(self):
+        from .embedding_index import EmbeddingIndex
+        index = EmbeddingIndex.load(self.indexed_docs_path)
+        index.nprobe = self.nprobe
+        index.rerank = self.rerank
+        return index
+
+    async def reload_index(self):
+        """
+        Loads the index file again in a worker thread and hands it to every bot,
+        questions already being answered finish with the index they started with.
+        """
+        signature = file_signature(self.indexed_docs_path)
+        try:
+            index = await asyncio.to_thread(self.load_index)
+            await asyncio.to_thread(warm, index)
+        except Exception as e:
+            logger.exception(e)
+            return
+        self.indexed_docs = index
+        self.indexed_docs_signature = signature
+        for bot in self.bots:
+            bot.embedding_docs = index
+        logger.info("reloaded index with %s chunks", len(index))
+
+    async def watch_index(self):
+        while True:
+            await asyncio.sleep(self.index_reload_interval)
+            signature = file_signature(self.indexed_docs_path)
+            if signature is not None and signature != self.indexed_docs_signature:
+                await self.reload_index()
 
     async def handle_signal(self, signum):
         logger.info("+++++++handle signal: %s", signum)
@@ -110,25 +188,27 @@ class MixinBot(MixinWSApi):
         # os.kill(os.getpid(), signal.SIGINT)
 
     def choose_bot(self, user_id):
-        bots = []
+        """
+        Returns the bot whose api key is expected to answer soonest, judging by its requests
+        in flight, its recent latency and its remaining budget. Keys backing off after a
+        rate limit error are skipped until their backoff ends.
+        """
+        best = None
+        best_wait = 0.0
         for bot in self.bots:
             if bot.standby:
                 continue
-            bots.append(bot)
-
-        for bot in bots:
-            if user_id in bot.users:
-                return bot
-
-        bot_index = 0
-        user_counts = [len(bot.users) for bot in bots]
-        try:
-            bot_index = user_counts.index(min(user_counts))
-            return bots[bot_index]
-        except ValueError:
-            return None
+            wait = bot.limiter.expected_wait()
+            if best is None or wait < best_wait:
+                best = bot
+                best_wait = wait
+        return best
 
     async def send_message_to_chat_gpt(self, conversation_id: str, user_id: str, message: str):
+        if self.question_queue.has_pending(user_id):
+            # answer after the questions the user asked before
+            self.save_question(conversation_id, user_id, message)
+            return False
         bot = self.choose_bot(user_id)
         if not bot:
             logger.info('no available bot')
@@ -142,10 +222,13 @@ class MixinBot(MixinWSApi):
             return True
         except Exception as e:
             logger.exception(e)
-        self.save_question(conversation_id, user_id, message)
+        self.save_question(conversation_id, user_id, message, failed=True)
         return False
 
     async def send_message_to_chat_gpt2(self, conversation_id, user_id, message):
+        if self.question_queue.has_pending(user_id):
+            self.save_question(conversation_id, user_id, message)
+            return False
         bot = self.choose_bot(user_id)
         if not bot:
             logger.info('no available bot')
@@ -160,27 +243,45 @@ class MixinBot(MixinWSApi):
             return True
         except Exception as e:
             logger.exception(e)
-        self.save_question(conversation_id, user_id, message)
+        self.save_question(conversation_id, user_id, message, failed=True)
         return False
 
     async def handle_questions(self):
         while True:
-            await asyncio.sleep(15.0)
-            handled_question = []
-            saved_questions = self.saved_questions.copy()
-            for user_id, question in saved_questions.items():
-                try:
-                    logger.info("++++++++handle question: %s", question.data)
-                    if await self.send_message_to_chat_gpt2(question.conversation_id, question.user_id, question.data):
-                        handled_question.append(user_id)
-                except Exception as e:
-                    logger.info("%s", str(e))
-                    continue
-            for question in handled_question:
-                del self.saved_questions[question]
+            question = await self.question_queue.get()
+            if time.time() > question.deadline:
+                logger.info("++++++++give up question: %s", question.data)
+                self.question_queue.done(question)
+                asyncio.create_task(self.sendUserText(question.conversation_id, question.user_id, 'Sorry, I am not available now, please try again later.\n[END]'))
+                continue
+            bot = self.choose_bot(question.user_id)
+            if not bot:
+                # every key is backing off, wake up when the first one is back
+                wait = min(standby_bot.limiter.backoff_until for standby_bot in self.bots) - time.time()
+                self.question_queue.retry(question, max(wait, 0.1))
+                continue
+            asyncio.create_task(self.answer_saved_question(bot, question))
 
-    def save_question(self, conversation_id, user_id, data):
-        self.saved_questions[user_id] = SavedQuestion(conversation_id, user_id, data)
+    async def answer_saved_question(self, bot, question: SavedQuestion):
+        logger.info("++++++++handle question: %s", question.data)
+        msgs: List[str] = []
+        try:
+            async for msg in bot.send_message(question.user_id, question.data):
+                msgs.append(msg)
+            await self.sendUserText(question.conversation_id, question.user_id, ''.join(msgs) + '\n[END]')
+        except Exception as e:
+            logger.exception(e)
+            self.question_queue.retry(question)
+            return
+        self.question_queue.done(question)
+
+    def save_question(self, conversation_id, user_id, data, failed=False):
+        now = time.time()
+        question = SavedQuestion(conversation_id, user_id, data, deadline=now + self.question_deadline, ready_at=now)
+        if failed:
+            question.attempts = 1
+            question.ready_at = now + 2.0
+        self.question_queue.put(question)
 
     async def handle_message(self, conversation_id, user_id, message):
         try:
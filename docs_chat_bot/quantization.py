@@ -0,0 +1,149 @@
+from typing import List, Optional, Tuple
+
+import numpy as np
+from pymixin import log
+
+from .ivf import kmeans
+
+logger = log.get_logger(__name__)
+logger.addHandler(log.handler)
+
+default_pq_subspaces = 192
+# number of approximate candidates scored again with the float vectors
+default_rerank = 100
+pq_centroids = 256
+# product quantizer codebooks are trained on at most this many vectors
+pq_training_sample = 32768
+# vectors are encoded in blocks of this many rows to bound the temporary memory
+encode_block_size = 65536
+# codes are converted to float in blocks of this many rows, small enough to stay in the cpu cache
+score_block_size = 1024
+
+
+class ScalarQuantizer:
+    """
+    Stores every dimension as an int8 code in the range of that dimension, 4x smaller than float32.
+    A vector is approximated by (code + 128) * scale + offset, so the query is compared with
+    the codes directly: x.q = code.(scale * q) + (128 * scale + offset).q
+    """
+
+    kind = 'int8'
+
+    def __init__(self, scale: np.ndarray, offset: np.ndarray, codes: np.ndarray):
+        self.scale = scale
+        self.offset = offset
+        self.codes = codes
+
+    @classmethod
+    def train(cls, vectors: np.ndarray) -> 'ScalarQuantizer':
+        low = np.full(vectors.shape[1], np.inf, dtype=np.float32)
+        high = np.full(vectors.shape[1], -np.inf, dtype=np.float32)
+        for start in range(0, len(vectors), encode_block_size):
+            block = np.asarray(vectors[start:start + encode_block_size], dtype=np.float32)
+            low = np.minimum(low, block.min(axis=0))
+            high = np.maximum(high, block.max(axis=0))
+        scale = np.maximum(high - low, 1e-12) / 255
+        return cls(scale.astype(np.float32), low.astype(np.float32), np.zeros((0, vectors.shape[1]), dtype=np.int8))
+
+    def encode(self, vectors: np.ndarray):
+        codes = np.empty(vectors.shape, dtype=np.int8)
+        for start in range(0, len(vectors), encode_block_size):
+            block = np.asarray(vectors[start:start + encode_block_size], dtype=np.float32)
+            codes[start:start + encode_block_size] = np.clip(np.rint((block - self.offset) / self.scale), 0, 255) - 128
+        self.codes = codes
+
+    def scores(self, query_embedding: np.ndarray, positions: Optional[np.ndarray] = None) -> np.ndarray:
+        scaled = self.scale * query_embedding
+        bias = float((128 * self.scale + self.offset) @ query_embedding)
+        count = len(self.codes) if positions is None else len(positions)
+        scores = np.empty(count, dtype=np.float32)
+        for start in range(0, count, score_block_size):
+            if positions is None:
+                block = self.codes[start:start + score_block_size]
+            else:
+                block = self.codes[positions[start:start + score_block_size]]
+            scores[start:start + score_block_size] = block.astype(np.float32) @ scaled
+        return scores + bias
+
+    def blocks(self) -> List[Tuple[str, bytes]]:
+        return [
+            ('sq_scale', self.scale.tobytes()),
+            ('sq_offset', self.offset.tobytes()),
+            ('sq_codes', np.ascontiguousarray(self.codes).tobytes()),
+        ]
+
+
+class ProductQuantizer:
+    """
+    Splits the vectors into `subspaces` slices and stores each slice as the uint8 number of its
+    nearest of 256 centroids, `subspaces` bytes per vector.
+    A query is scored with asymmetric distance computation: the dot products between every
+    query slice and the centroids of that slice are computed once, then summed over the codes.
+    The codes of one subspace are contiguous, so each step of the sum reads sequential memory.
+    """
+
+    kind = 'pq'
+
+    def __init__(self, codebooks: np.ndarray, codes: np.ndarray):
+        # subspaces x 256 x (dim / subspaces)
+        self.codebooks = codebooks
+        # subspaces x count
+        self.codes = codes
+
+    @property
+    def subspaces(self) -> int:
+        return len(self.codebooks)
+
+    @classmethod
+    def train(cls, vectors: np.ndarray, subspaces: int = default_pq_subspaces, seed: int = 0) -> 'ProductQuantizer':
+        dim = vectors.shape[1]
+        if dim % subspaces:
+            raise ValueError(f"the dimension {dim} is not a multiple of {subspaces} subspaces")
+        rng = np.random.default_rng(seed)
+        sample_size = min(len(vectors), pq_training_sample)
+        sample = np.asarray(vectors[np.sort(rng.choice(len(vectors), sample_size, replace=False))], dtype=np.float32)
+        k = min(pq_centroids, len(sample))
+        sub_dim = dim // subspaces
+        codebooks = np.zeros((subspaces, pq_centroids, sub_dim), dtype=np.float32)
+        for i in range(subspaces):
+            codebooks[i, :k] = kmeans(sample[:, i * sub_dim:(i + 1) * sub_dim], k, seed=seed, spherical=False)
+        logger.info("trained %s product quantizer codebooks on %s vectors", subspaces, sample_size)
+        return cls(codebooks, np.zeros((subspaces, 0), dtype=np.uint8))
+
+    def encode(self, vectors: np.ndarray):
+        sub_dim = self.codebooks.shape[2]
+        codes = np.empty((self.subspaces, len(vectors)), dtype=np.uint8)
+        norms = (self.codebooks * self.codebooks).sum(axis=2) / 2
+        for start in range(0, len(vectors), encode_block_size):
+            block = np.asarray(vectors[start:start + encode_block_size], dtype=np.float32)
+            for i in range(self.subspaces):
+                products = block[:, i * sub_dim:(i + 1) * sub_dim] @ self.codebooks[i].T
+                codes[i, start:start + encode_block_size] = np.argmax(products - norms[i], axis=1)
+        self.codes = codes
+
+    def scores(self, query_embedding: np.ndarray, positions: Optional[np.ndarray] = None) -> np.ndarray:
+        sub_dim = self.codebooks.shape[2]
+        # subspaces x 256 dot products between the query slices and the centroids
+        table = np.einsum('skd,sd->sk', self.codebooks, query_embedding.reshape(self.subspaces, sub_dim))
+        codes = self.codes if positions is None else self.codes[:, positions]
+        scores = np.zeros(codes.shape[1], dtype=np.float32)
+        for i in range(self.subspaces):
+            scores += table[i].take(codes[i])
+        return scores
+
+    def blocks(self) -> List[Tuple[str, bytes]]:
+        return [
+            ('pq_codebooks', np.ascontiguousarray(self.codebooks, dtype=np.float32).tobytes()),
+            ('pq_codes', np.ascontiguousarray(self.codes).tobytes()),
+        ]
+
+
+def train_quantizer(vectors: np.ndarray, kind: str, pq_subspaces: int = default_pq_subspaces):
+    if kind == 'int8':
+        quantizer = ScalarQuantizer.train(vectors)
+    elif kind == 'pq':
+        quantizer = ProductQuantizer.train(vectors, pq_subspaces)
+    else:
+        raise ValueError(f"unsupported compression: {kind}")
+    quantizer.encode(vectors)
+    return quantizer
@@ -0,0 +1,116 @@
+import asyncio
+import heapq
+import json
+import os
+import time
+from collections import deque
+from dataclasses import asdict, dataclass
+from typing import Deque, Dict, List, Optional, Tuple
+
+from pymixin import log
+
+logger = log.get_logger(__name__)
+logger.addHandler(log.handler)
+
+max_retry_delay = 60.0
+
+
+@dataclass
+class SavedQuestion:
+    conversation_id: str
+    user_id: str
+    data: str
+    attempts: int = 0
+    # time after which the question is given up
+    deadline: float = 0.0
+    # time at which the question is handed out again
+    ready_at: float = 0.0
+
+
+class QuestionQueue:
+    """
+    Questions waiting for an answer, handed out by `get` in the order they become ready.
+    Questions of one user are answered one after another in the order they were asked:
+    only the oldest pending question of a user is in the priority queue, the next one
+    enters it when `done` is called.
+    With `path`, pending questions are saved to that file and loaded again on restart.
+    """
+
+    def __init__(self, path: Optional[str] = None):
+        self.path = path
+        self.pending: Dict[str, Deque[SavedQuestion]] = {}
+        self.heap: List[Tuple[float, int, str]] = []
+        self.counter = 0
+        self.changed = asyncio.Event()
+        if path and os.path.exists(path):
+            with open(path, 'r') as f:
+                for item in json.load(f):
+                    self.put(SavedQuestion(**item), save=False)
+            logger.info("loaded %s pending questions from %s", len(self), path)
+
+    def __len__(self):
+        return sum(len(questions) for questions in self.pending.values())
+
+    def has_pending(self, user_id: str) -> bool:
+        return user_id in self.pending
+
+    def _schedule(self, question: SavedQuestion):
+        self.counter += 1
+        heapq.heappush(self.heap, (question.ready_at, self.counter, question.user_id))
+        self.changed.set()
+
+    def put(self, question: SavedQuestion, save: bool = True):
+        questions = self.pending.setdefault(question.user_id, deque())
+        questions.append(question)
+        if len(questions) == 1:
+            self._schedule(question)
+        if save:
+            self.save()
+
+    async def get(self) -> SavedQuestion:
+        """
+        Waits until the question with the earliest `ready_at` is due and returns it.
+        It stays pending until `done` or `retry` is called.
+        """
+        while True:
+            self.changed.clear()
+            timeout = None
+            if self.heap:
+                timeout = self.heap[0][0] - time.time()
+                if timeout <= 0:
+                    _, _, user_id = heapq.heappop(self.heap)
+                    return self.pending[user_id][0]
+            try:
+                await asyncio.wait_for(self.changed.wait(), timeout)
+            except asyncio.TimeoutError:
+                pass
+
+    def done(self, question: SavedQuestion):
+        questions = self.pending[question.user_id]
+        questions.popleft()
+        if questions:
+            self._schedule(questions[0])
+        else:
+            del self.pending[question.user_id]
+        self.save()
+
+    def retry(self, question: SavedQuestion, delay: Optional[float] = None):
+        """
+        Hands the question out again after `delay` seconds, by default an exponential backoff
+        on the number of attempts.
+        """
+        if delay is None:
+            question.attempts += 1
+            delay = min(2.0 ** question.attempts, max_retry_delay)
+        question.ready_at = time.time() + delay
+        self._schedule(question)
+        self.save()
+
+    def save(self):
+        if not self.path:
+            return
+        questions = [asdict(question) for user_questions in self.pending.values() for question in user_questions]
+        tmp = self.path + '.tmp'
+        with open(tmp, 'w') as f:
+            json.dump(questions, f)
+        os.replace(tmp, self.path)
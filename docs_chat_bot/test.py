@@ -1,8 +1,12 @@
+import asyncio
 import pickle
 import numpy as np
 import random
 import heapq
-from docs_chat_bot import indexing, utils
+import time
+import pytest
+from docs_chat_bot import chunker, indexing, utils
+from docs_chat_bot.embedding_index import EmbeddingIndex
 
 def largest_n_numbers(lst, n):
     if n > len(lst):
@@ -56,16 +60,920 @@ def test_top_find():
     print("+++duration:", time.time() - start)
     print(ret)
 
-def test_indexing():
+class FakeEmbeddingBackend:
+    """
+    Local stand-in for `indexing.aget_embeddings`, answering each request after `latency` seconds.
+    """
+    def __init__(self, dim: int=10, latency: float=0.0):
+        self.dim = dim
+        self.latency = latency
+        self.requests = 0
+
+    async def __call__(self, texts, model: str=''):
+        self.requests += 1
+        await asyncio.sleep(self.latency)
+        return [[random.random() for x in range(self.dim)] for text in texts]
+
+def get_embedding(text: str, model: str='') -> list[float]:
+    return [random.random() for x in range(10)]
+
+def test_indexing(tmp_path, monkeypatch):
     print("test_indexing")
-    def get_embedding(text: str, model: str='') -> list[float]:
-        return [random.random() for x in range(10)]
-    indexing.get_embedding = get_embedding
-    indexing.indexing_document('.', 'test_indexing.pickle')
+    monkeypatch.setattr(indexing, 'aget_embeddings', FakeEmbeddingBackend())
+    output = str(tmp_path / 'test_indexing.index')
+    indexing.indexing_document('.', output)
 
     query_embedding = get_embedding('hello')
     query_embedding = np.array(query_embedding)
-    with open('test_indexing.pickle', 'rb') as f:
-        embeddings = pickle.load(f)
+    embeddings = EmbeddingIndex.load(output)
     document_similarities = utils.top_n_similarity(query_embedding, embeddings, 4)
     print(document_similarities)
+
+def test_embedding_index():
+    embeddings = {f'doc{i}': np.random.rand(16) for i in range(1000)}
+    query_embedding = np.random.rand(16)
+
+    expected = sorted(((np.dot(query_embedding, v), k) for k, v in embeddings.items()), reverse=True)[:4]
+    index = EmbeddingIndex.from_embeddings(embeddings)
+    result = utils.top_n_similarity(query_embedding, index, 4)
+    assert [key for _, key in result] == [key for _, key in expected]
+    assert np.allclose([s for s, _ in result], [s for s, _ in expected], atol=1e-4)
+
+def test_indexing_throughput(tmp_path, monkeypatch):
+    from docs_chat_bot.embedding_index import IndexWriter
+    docs = tmp_path / 'docs'
+    docs.mkdir()
+    separator = ' '*100 + '\n'
+    for i in range(20):
+        (docs / f'{i}.md').write_text(separator.join(f'chunk {i} {j}' for j in range(100)))
+    (tmp_path / 'spill').mkdir()
+    backend = FakeEmbeddingBackend(latency=0.2)
+    monkeypatch.setattr(indexing, 'aget_embeddings', backend)
+
+    start = time.time()
+    pipeline = indexing.IndexingPipeline(str(docs), IndexWriter(str(tmp_path / 'spill')), batch_size=100, concurrency=4, jobs=1)
+    pipeline.run()
+    duration = time.time() - start
+    print('+++duration:', duration, 'chunks/s:', pipeline.embedded_chunks / duration)
+    assert pipeline.embedded_chunks == 2000
+    assert len(pipeline.writer.finish()) == 2000
+    assert backend.requests == 20
+    # 20 requests of 200ms take 4s one at a time, 1s 4 at a time
+    assert duration < 20 * 0.2 / 2
+
+def test_incremental_indexing(tmp_path, monkeypatch):
+    docs = tmp_path / 'docs'
+    docs.mkdir()
+    separator = ' '*100 + '\n'
+    (docs / 'a.md').write_text(separator.join(['hello, world1', 'hello, world2']))
+    (docs / 'b.md').write_text('hello, world3')
+    (docs / 'c.md').write_text('hello, world4')
+    output = str(tmp_path / 'indexed_docs.index')
+
+    backend = FakeEmbeddingBackend()
+    monkeypatch.setattr(indexing, 'aget_embeddings', backend)
+    indexing.indexing_document(str(docs), output)
+    index = EmbeddingIndex.load(output)
+    first = dict(zip(index.texts, index.vectors))
+    assert len(first) == 4
+
+    (docs / 'b.md').write_text('hello, world3 changed')
+    (docs / 'c.md').unlink()
+    backend = FakeEmbeddingBackend()
+    monkeypatch.setattr(indexing, 'aget_embeddings', backend)
+    indexing.indexing_document(str(docs), output, incremental=True)
+    index = EmbeddingIndex.load(output)
+    second = dict(zip(index.texts, index.vectors))
+
+    assert backend.requests == 1
+    assert len(index.token_counts) == 3
+    assert set(second) == {'hello, world1', 'hello, world2', 'hello, world3 changed'}
+    assert np.allclose(second['hello, world1'], first['hello, world1'])
+    assert sorted(index.sources) == ['a.md', 'a.md', 'b.md']
+
+def test_indexing_pipeline(tmp_path, monkeypatch):
+    docs = tmp_path / 'docs'
+    (docs / 'sub').mkdir(parents=True)
+    separator = ' '*100 + '\n'
+    (docs / 'a.md').write_text(separator.join(['hello, world1', 'shared']))
+    (docs / 'sub' / 'b.md').write_text(separator.join(['shared', 'hello, world2']))
+    output = str(tmp_path / 'indexed_docs.index')
+
+    backend = FakeEmbeddingBackend()
+    monkeypatch.setattr(indexing, 'aget_embeddings', backend)
+    indexing.indexing_document(str(docs), output, batch_size=1, jobs=2)
+    index = EmbeddingIndex.load(output)
+    # chunks are written in the order of the files, a duplicated chunk once
+    assert list(index.texts) == ['hello, world1', 'shared', 'hello, world2']
+    assert list(index.sources) == ['a.md', 'a.md', 'sub/b.md']
+    assert backend.requests == 3
+    assert index.lexical.search('world2', 1)[0][1] == 2
+
+def test_chunk_embedding_store(tmp_path, monkeypatch):
+    separator = ' '*100 + '\n'
+    for version, texts in [('v1', ['license', 'install', 'hello, v1']), ('v2', ['license', 'install', 'hello, v2'])]:
+        docs = tmp_path / version
+        docs.mkdir()
+        (docs / 'index.md').write_text(separator.join(texts))
+    store = str(tmp_path / 'embeddings.db')
+
+    backend = FakeEmbeddingBackend()
+    monkeypatch.setattr(indexing, 'aget_embeddings', backend)
+    indexing.indexing_document(str(tmp_path / 'v1'), str(tmp_path / 'v1.index'), embedding_store=store)
+    v1 = EmbeddingIndex.load(str(tmp_path / 'v1.index'))
+    indexing.indexing_document(str(tmp_path / 'v2'), str(tmp_path / 'v2.index'), batch_size=1, embedding_store=store)
+    v2 = EmbeddingIndex.load(str(tmp_path / 'v2.index'))
+    # only 'hello, v2' is embedded for v2
+    assert backend.requests == 2
+    assert np.array_equal(v1.vectors[:2], v2.vectors[:2])
+
+    from docs_chat_bot.cache import ChunkEmbeddingStore
+    db = ChunkEmbeddingStore(store, indexing.EMBEDDING_MODEL)
+    assert len(db) == 4
+    assert db.get_many(['license', 'unknown'])[1] is None
+    assert db.get_many(['install', 'install', 'unknown'])[1] is not None
+    assert db.stats()['hits'] == 3 and db.stats()['misses'] == 2
+    assert ChunkEmbeddingStore(store, 'other-model').get_many(['license']) == [None]
+
+def test_index_file(tmp_path):
+    embeddings = {f'doc{i} 文档': np.random.rand(16) for i in range(100)}
+    pickled = str(tmp_path / 'indexed_docs.pickle')
+    with open(pickled, 'wb') as f:
+        pickle.dump(embeddings, f)
+
+    index = EmbeddingIndex.load(pickled)
+    output = str(tmp_path / 'indexed_docs.index')
+    index.save(output)
+    loaded = EmbeddingIndex.load(output)
+    assert len(loaded) == 100
+    assert loaded.version == index.version
+    assert list(loaded.ids) == list(index.ids)
+    assert list(loaded.texts) == list(embeddings)
+    assert np.array_equal(loaded.vectors, index.vectors)
+
+    index.save(output, 'float16')
+    loaded = EmbeddingIndex.load(output, mmap=False)
+    assert loaded.vectors.dtype == np.float16
+    query_embedding = np.random.rand(16)
+    assert loaded.search(query_embedding, 1)[0][1] == index.search(query_embedding, 1)[0][1]
+
+def test_embedding_cache(tmp_path):
+    from docs_chat_bot.cache import EmbeddingCache
+    db = str(tmp_path / 'embeddings.db')
+    cache = EmbeddingCache(max_size=2, ttl=60, path=db)
+    cache.put('How do I install?', np.ones(4))
+    cache.put('hi', np.zeros(4))
+    assert np.array_equal(cache.get('  how do i   INSTALL? '), np.ones(4))
+    cache.put('hello', np.zeros(4))
+    # 'hi' was the least recently used entry
+    assert 'hi' not in cache.entries
+    assert cache.get('unknown') is None
+    assert cache.stats()['hits'] == 1
+    assert cache.stats()['misses'] == 1
+    cache.close()
+
+    cache = EmbeddingCache(max_size=2, ttl=60, path=db)
+    assert np.array_equal(cache.get('hi'), np.zeros(4))
+
+    cache = EmbeddingCache(ttl=0.01)
+    cache.put('hi', np.zeros(4))
+    time.sleep(0.02)
+    assert cache.get('hi') is None
+
+def test_embedding_cache_db(tmp_path):
+    from docs_chat_bot.cache import EmbeddingCache
+    db = str(tmp_path / 'embeddings.db')
+    cache = EmbeddingCache(max_size=0, ttl=60, path=db)
+    cache.put('hello', np.ones(4))
+    # served from the database, nothing is kept in memory
+    assert np.array_equal(cache.get('hello'), np.ones(4))
+    assert len(cache.entries) == 0
+
+    cache.db.execute("INSERT OR REPLACE INTO embeddings VALUES (?, ?, ?)", ('old', time.time() - 120, np.ones(4, dtype=np.float32).tobytes()))
+    cache.db.commit()
+    assert cache.get('old') is None
+    # the expired row is deleted when it is read
+    assert cache.db.execute("SELECT COUNT(*) FROM embeddings WHERE question = 'old'").fetchone()[0] == 0
+    cache.close()
+
+    # an expired row read into a cache with room for it
+    cache = EmbeddingCache(max_size=10, ttl=60, path=db)
+    cache.db.execute("INSERT OR REPLACE INTO embeddings VALUES (?, ?, ?)", ('old', time.time() - 120, np.ones(4, dtype=np.float32).tobytes()))
+    cache.db.commit()
+    assert cache.get('old') is None
+    assert 'old' not in cache.entries
+    assert np.array_equal(cache.get('hello'), np.ones(4))
+    cache.close()
+
+def test_answer_cache():
+    from docs_chat_bot.cache import AnswerCache
+    cache = AnswerCache(max_size=2, threshold=0.95)
+    question = np.array([1.0, 0.0, 0.0])
+    near = np.array([0.99, 0.1, 0.0])
+    near /= np.linalg.norm(near)
+    cache.put(question, ['a', 'b'], 'v1', 'answer')
+    assert cache.get(near, ['a', 'b'], 'v1') == 'answer'
+    assert cache.get(near, ['a'], 'v1') is None
+    assert cache.get(np.array([0.0, 1.0, 0.0]), ['a', 'b'], 'v1') is None
+    # a new index version drops every entry
+    assert cache.get(question, ['a', 'b'], 'v2') is None
+    assert len(cache) == 0
+
+def test_chatgpt_answer_cache(monkeypatch):
+    from docs_chat_bot import chatgpt
+    from docs_chat_bot.cache import AnswerCache, EmbeddingCache
+    monkeypatch.setattr(utils, 'query_embedding_cache', EmbeddingCache())
+    monkeypatch.setattr(utils, 'answer_cache', AnswerCache())
+    async def aget_embedding(text, model=''):
+        return [1.0, 0.0]
+    monkeypatch.setattr(utils, 'aget_embedding', aget_embedding)
+    index = EmbeddingIndex.from_embeddings({'doc1': np.array([1.0, 0.0]), 'doc2': np.array([0.8, 0.6]), 'doc3': np.array([0.0, 1.0]), 'doc4': np.array([0.6, 0.8])})
+
+    calls = []
+    async def acreate(**kwargs):
+        calls.append(kwargs)
+        return {'choices': [{'message': {'content': 'first paragraph\n\nsecond paragraph'}}]}
+    monkeypatch.setattr(chatgpt.openai.ChatCompletion, 'acreate', acreate)
+    bot = chatgpt.ChatGPTBot('', index, stream=False)
+
+    async def ask(bot, question):
+        return [msg async for msg in bot.send_message('user', question)]
+
+    assert asyncio.run(ask(bot, 'hello')) == ['[BEGIN]', 'first paragraph\n\nsecond paragraph']
+    bot.stream = True
+    assert asyncio.run(ask(bot, 'Hello ')) == ['[BEGIN]', 'first paragraph', 'second paragraph']
+    assert len(calls) == 1
+
+class FakeChatCompletion:
+    """
+    Local stand-in for `openai.ChatCompletion.acreate`, answering `pieces` joined, or one
+    event per piece with `stream`, then raising `error` when it is set.
+    """
+    def __init__(self, pieces=('Install it', ' with pip.')):
+        self.pieces = list(pieces)
+        self.requests = []
+        self.error = None
+        # number of streams closed before their end
+        self.closed = 0
+
+    async def __call__(self, stream=False, **kwargs):
+        self.requests.append(kwargs)
+        if stream:
+            return self.events()
+        return {'choices': [{'message': {'content': ''.join(self.pieces)}}]}
+
+    async def events(self):
+        finished = False
+        try:
+            for piece in self.pieces:
+                yield {'choices': [{'delta': {'content': piece}}]}
+            if self.error:
+                raise self.error
+            yield {'choices': [{'delta': {}}]}
+            finished = True
+        finally:
+            if not finished:
+                self.closed += 1
+
+@pytest.fixture
+def server(tmp_path, monkeypatch):
+    """
+    The chat server serving the indexes `docs` (the default) and `v2` from a directory,
+    with the embedding and chat completion APIs stubbed.
+    """
+    from fastapi.testclient import TestClient
+    from docs_chat_bot import docs_chat_bot_server
+    from docs_chat_bot.cache import AnswerCache, EmbeddingCache
+    from docs_chat_bot.index_registry import IndexRegistry
+    for name in ('docs', 'v2'):
+        index = EmbeddingIndex(np.eye(4, dtype=np.float32)[:3], ['install the chain', 'deploy a contract', 'query a table'])
+        index.build_lexical()
+        index.save(str(tmp_path / f'{name}.index'))
+    monkeypatch.setattr(docs_chat_bot_server, 'indexes', IndexRegistry.from_dir(str(tmp_path)))
+    monkeypatch.setattr(docs_chat_bot_server, 'answer_caches', {})
+    monkeypatch.setattr(docs_chat_bot_server, 'reload_interval', 0)
+    monkeypatch.setattr(docs_chat_bot_server, 'admin_token', 'secret')
+    monkeypatch.setattr(utils, 'query_embedding_cache', EmbeddingCache())
+    monkeypatch.setattr(utils, 'answer_cache', AnswerCache())
+
+    embedded = []
+    async def aget_embedding(text, model=''):
+        embedded.append(text)
+        return [1.0, 0.0, 0.0, 0.0]
+    monkeypatch.setattr(utils, 'aget_embedding', aget_embedding)
+    completion = FakeChatCompletion()
+    monkeypatch.setattr(docs_chat_bot_server.openai.ChatCompletion, 'acreate', completion)
+    with TestClient(docs_chat_bot_server.app) as client:
+        client.embedded = embedded
+        client.completion = completion
+        yield client
+
+def test_server_chat(server):
+    response = server.post('/chat', json={'message': 'how to install?'})
+    assert response.json() == {'status': 'success', 'received_message': 'Install it with pip.'}
+    prompt = server.completion.requests[0]['messages'][1]['content']
+    assert 'install the chain' in prompt
+
+    # the same question is answered from the caches
+    response = server.post('/chat', json={'message': 'How to install? '})
+    assert response.json()['received_message'] == 'Install it with pip.'
+    assert len(server.completion.requests) == 1
+    assert server.embedded == ['how to install?']
+
+    # every index has its own answer cache
+    response = server.post('/chat', json={'message': 'how to install?', 'index': 'v2'})
+    assert response.json()['status'] == 'success'
+    assert len(server.completion.requests) == 2
+
+    response = server.post('/chat', json={'message': 'how to install?', 'index': 'v3'})
+    assert response.json() == {'status': 'error', 'received_message': 'unknown index: v3'}
+    response = server.post('/chat', json={'message': 'x' * 1025})
+    assert response.json()['status'] == 'error'
+    assert len(server.completion.requests) == 2
+
+    stats = server.get('/stats').json()
+    assert stats['answer_cache']['hits'] == 1
+    assert stats['query_embedding_cache']['hits'] == 2
+    assert list(stats['answer_caches']) == ['v2']
+    assert sorted(stats['indexes']['loaded']) == ['docs', 'v2']
+
+    response = server.get('/metrics')
+    assert response.headers['content-type'].startswith('text/plain')
+    assert 'docs_chat_bot_stage_seconds_count{stage="retrieval"}' in response.text
+
+def test_server_chat_stream(server):
+    response = server.post('/chat/stream', json={'message': 'how to install?'})
+    assert response.headers['content-type'].startswith('text/event-stream')
+    assert response.text == 'data: {"delta": "Install it"}\n\ndata: {"delta": " with pip."}\n\ndata: [DONE]\n\n'
+
+    # a cached answer is sent as one event
+    response = server.post('/chat/stream', json={'message': 'how to install?'})
+    assert response.text == 'data: {"delta": "Install it with pip."}\n\ndata: [DONE]\n\n'
+    assert len(server.completion.requests) == 1
+
+    response = server.post('/chat/stream', json={'message': 'how to install?', 'index': 'v3'})
+    assert response.headers['content-type'] == 'application/json'
+    assert response.json()['status'] == 'error'
+
+    server.completion.error = RuntimeError('upstream failed')
+    response = server.post('/chat/stream', json={'message': 'how to install?', 'index': 'v2'})
+    assert response.text == 'data: {"delta": "Install it"}\n\ndata: {"delta": " with pip."}\n\ndata: {"error": "oops!"}\n\n'
+
+def test_server_stream_disconnect(server):
+    from docs_chat_bot import docs_chat_bot_server
+
+    class Request:
+        """
+        A client disconnecting after the first event.
+        """
+        def __init__(self):
+            self.checks = 0
+
+        async def is_disconnected(self):
+            self.checks += 1
+            return self.checks > 1
+
+    async def receive():
+        events = [event async for event in docs_chat_bot_server.stream_events(Request(), 'how to install?')]
+        # checked before asyncio.run finalizes the generators left open
+        return events, server.completion.closed
+
+    # the upstream completion is closed and the partial answer is not cached
+    assert asyncio.run(receive()) == (['data: {"delta": "Install it"}\n\n'], 1)
+    assert len(utils.answer_cache) == 0
+
+def test_server_admin(server):
+    assert server.get('/indexes').json() == {'default': 'docs', 'indexes': ['docs', 'v2']}
+
+    assert server.post('/admin/reload', json={}).json()['status'] == 'error'
+    response = server.post('/admin/reload', json={}, headers={'X-Admin-Token': 'wrong'})
+    assert response.json() == {'status': 'error', 'received_message': 'forbidden'}
+    response = server.post('/admin/reload', json={'index': 'v3'}, headers={'X-Admin-Token': 'secret'})
+    assert response.json() == {'status': 'error', 'received_message': 'unknown index: v3'}
+
+    # only loaded indexes are reloaded, an index is loaded by its first question
+    response = server.post('/admin/reload', json={}, headers={'X-Admin-Token': 'secret'})
+    assert response.json() == {'status': 'success', 'reloaded': []}
+    server.post('/chat', json={'message': 'how to install?'})
+    response = server.post('/admin/reload', json={}, headers={'X-Admin-Token': 'secret'})
+    assert response.json() == {'status': 'success', 'reloaded': ['docs']}
+    server.post('/chat', json={'message': 'how to install?', 'index': 'v2'})
+    response = server.post('/admin/reload', json={'index': 'v2'}, headers={'X-Admin-Token': 'secret'})
+    assert response.json() == {'status': 'success', 'reloaded': ['v2']}
+
+def test_parse_index_paths():
+    from docs_chat_bot.docs_chat_bot_server import parse_index_paths
+    assert parse_index_paths(['docs/v1.index', 'latest=docs/v2.index', 'indexed_docs']) == {
+        'v1': 'docs/v1.index',
+        'latest': 'docs/v2.index',
+        'indexed_docs': 'indexed_docs',
+    }
+    # a later value replaces an index of the same name
+    assert parse_index_paths(['a/docs.index', 'b/docs.index']) == {'docs': 'b/docs.index'}
+
+def test_run_workers(tmp_path):
+    import multiprocessing
+    import os
+    import signal
+    import socket
+    import uvicorn
+    from docs_chat_bot.docs_chat_bot_server import run_workers
+
+    async def app(scope, receive, send):
+        if scope['type'] != 'http':
+            return
+        await send({'type': 'http.response.start', 'status': 200, 'headers': []})
+        await send({'type': 'http.response.body', 'body': str(os.getpid()).encode()})
+
+    started = tmp_path / 'started'
+    def setup():
+        with open(started, 'a') as f:
+            f.write(f'{os.getpid()}\n')
+
+    def worker_pids(count):
+        deadline = time.time() + 10
+        while time.time() < deadline:
+            pids = started.read_text().split() if started.exists() else []
+            if len(pids) >= count:
+                return [int(pid) for pid in pids]
+            time.sleep(0.05)
+        raise TimeoutError(count)
+
+    with socket.socket() as s:
+        s.bind(('127.0.0.1', 0))
+        port = s.getsockname()[1]
+    config = uvicorn.Config(app, host='127.0.0.1', port=port, log_level='warning')
+    supervisor = multiprocessing.get_context('fork').Process(target=run_workers, args=(config, 2, setup))
+    supervisor.start()
+    try:
+        pids = worker_pids(2)
+        import httpx
+        deadline = time.time() + 10
+        while True:
+            try:
+                assert int(httpx.get(f'http://127.0.0.1:{port}/').text) in pids
+                break
+            except httpx.TransportError:
+                assert time.time() < deadline
+                time.sleep(0.05)
+
+        # a worker that dies is replaced
+        os.kill(pids[0], signal.SIGKILL)
+        pids = worker_pids(3)
+        os.kill(supervisor.pid, signal.SIGTERM)
+        supervisor.join(10)
+        assert supervisor.exitcode == 0
+        for pid in pids:
+            with pytest.raises(ProcessLookupError):
+                os.kill(pid, 0)
+    finally:
+        if supervisor.is_alive():
+            supervisor.kill()
+
+def test_key_limiter():
+    from docs_chat_bot.limiter import KeyLimiter
+
+    async def run():
+        limiter = KeyLimiter(max_in_flight=3, requests_per_minute=100, tokens_per_minute=1000)
+        active = 0
+        peak = 0
+
+        async def request():
+            nonlocal active, peak
+            async with limiter.slot(10):
+                active += 1
+                peak = max(peak, active)
+                await asyncio.sleep(0.05)
+                active -= 1
+
+        start = time.time()
+        await asyncio.gather(*[request() for _ in range(9)])
+        # three requests at a time instead of one
+        assert peak == 3
+        assert time.time() - start < 9 * 0.05
+
+        assert limiter.available(900)
+        assert not limiter.available(1000)
+
+    asyncio.run(run())
+
+def test_key_limiter_backoff():
+    from docs_chat_bot.limiter import KeyLimiter
+    limiter = KeyLimiter(max_in_flight=3, requests_per_minute=2, tokens_per_minute=1000)
+    now = time.time()
+    # the rpm window frees a request in 1s, the key backs off for 30s after a 429
+    limiter.history.extend([(now - 59.0, 10), (now - 30.0, 10)])
+    limiter.tokens_in_window = 20
+    limiter.backoff_until = now + 30.0
+    assert limiter._delay(10, now) == pytest.approx(30.0)
+    assert not limiter.available(10)
+    # the rpm window decides when it frees later than the backoff ends
+    limiter.backoff_until = now + 0.5
+    assert limiter._delay(10, now) == pytest.approx(1.0)
+
+def test_choose_bot():
+    from types import SimpleNamespace
+    from docs_chat_bot.limiter import KeyLimiter
+    from docs_chat_bot.mixinbot import MixinBot
+
+    def make_bot():
+        limiter = KeyLimiter(max_in_flight=4)
+        return SimpleNamespace(limiter=limiter, standby=False)
+
+    bots = [make_bot(), make_bot(), make_bot()]
+    mixin = SimpleNamespace(bots=bots)
+    bots[0].limiter.in_flight = 2
+    bots[1].limiter.record_latency(5.0)
+    assert MixinBot.choose_bot(mixin, 'user') is bots[2]
+
+    bots[2].limiter.record_rate_limit()
+    assert bots[2].limiter.standby
+    bots[2].standby = bots[2].limiter.standby
+    assert MixinBot.choose_bot(mixin, 'user') is bots[0]
+
+def test_question_queue(tmp_path):
+    from docs_chat_bot.question_queue import QuestionQueue, SavedQuestion
+    path = str(tmp_path / 'questions.json')
+
+    async def run():
+        queue = QuestionQueue(path)
+        queue.put(SavedQuestion('c1', 'user1', 'first'))
+        queue.put(SavedQuestion('c1', 'user1', 'second'))
+        queue.put(SavedQuestion('c2', 'user2', 'other'))
+
+        question = await queue.get()
+        assert question.data == 'first'
+        question = await queue.get()
+        assert question.data == 'other'
+        queue.done(question)
+
+        # 'second' waits for 'first', which is retried shortly
+        queue.retry(queue.pending['user1'][0], 0.05)
+        start = time.time()
+        question = await queue.get()
+        assert question.data == 'first'
+        assert time.time() - start >= 0.04
+        queue.done(question)
+        assert (await queue.get()).data == 'second'
+
+        restored = QuestionQueue(path)
+        assert [q.data for q in restored.pending['user1']] == ['second']
+
+    asyncio.run(run())
+
+def test_pack_context():
+    vectors = np.eye(4, dtype=np.float32)
+    index = EmbeddingIndex(vectors, ['a', 'b', 'c', 'd'], token_counts=np.array([50, 500, 30, 10], dtype=np.uint32))
+    results = [(0.9, 0), (0.8, 1), (0.7, 2), (0.4, 3)]
+    positions, used = utils.pack_context(index, results, 100)
+    # 'b' does not fit and 'd' is not similar enough
+    assert positions == [0, 2]
+    assert used == 82
+
+def test_chunker(tmp_path):
+    doc = tmp_path / 'guide.md'
+    doc.write_text('\n'.join([
+        'intro',
+        '# Getting Started',
+        ' '.join(['hello'] * 59 + ['first']),
+        '',
+        ' '.join(['world'] * 60),
+        '',
+        '```python',
+        '# not a heading',
+        'print(1)',
+        '```',
+        '## Install it!',
+        'pip install docs-chat-bot',
+    ]))
+    chunks = list(chunker.iter_chunks(str(doc), 'guide.md', max_tokens=100, overlap=10))
+    for chunk in chunks:
+        assert chunk.tokens <= 100
+        assert chunk.tokens == utils.count_tokens(chunk.text)
+    assert [chunk.location for chunk in chunks] == [
+        'guide.md',
+        'guide.md#getting-started',
+        'guide.md#getting-started',
+        'guide.md#install-it',
+    ]
+    # the second chunk of a section starts with the end of the first one
+    assert chunks[2].text.startswith('hello')
+    assert 'first\n\nworld' in chunks[2].text
+    assert chunks[2].text.endswith('print(1)\n```')
+    assert chunks[3].text == '## Install it!\n\npip install docs-chat-bot'
+
+    large = list(chunker.iter_chunks(str(doc), 'guide.md', max_tokens=40, overlap=0))
+    assert all(chunk.tokens <= 40 for chunk in large)
+    assert len(large) > 4
+
+    assert chunker.slugify('Install - Linux') == 'install-linux'
+    assert chunker.slugify('Déjà vu: a café') == 'deja-vu-a-cafe'
+
+def test_ivf_index(tmp_path):
+    rng = np.random.default_rng(0)
+    centers = rng.standard_normal((20, 32)).astype(np.float32)
+    vectors = centers[rng.integers(0, 20, 2000)] + rng.standard_normal((2000, 32)).astype(np.float32) * 0.1
+    vectors /= np.linalg.norm(vectors, axis=1, keepdims=True)
+    texts = [str(i) for i in range(len(vectors))]
+    index = EmbeddingIndex(vectors, texts)
+    queries = vectors[:50]
+    exact = [utils.top_n_similarity(query, index, 10) for query in queries]
+
+    index.build_ivf(40)
+    output = str(tmp_path / 'ivf.index')
+    index.save(output)
+    index = EmbeddingIndex.load(output)
+    assert index.ivf.nlist == 40
+    assert sorted(index.ivf.positions) == list(range(len(vectors)))
+
+    index.nprobe = 40
+    assert [utils.top_n_similarity(query, index, 10) for query in queries] == exact
+
+    index.nprobe = 4
+    found = 0
+    for query, expected in zip(queries, exact):
+        found += len({text for _, text in expected} & {text for _, text in utils.top_n_similarity(query, index, 10)})
+    assert found / (len(queries) * 10) > 0.9
+
+def test_compressed_index(tmp_path):
+    rng = np.random.default_rng(0)
+    centers = rng.standard_normal((20, 32)).astype(np.float32)
+    vectors = centers[rng.integers(0, 20, 2000)] + rng.standard_normal((2000, 32)).astype(np.float32) * 0.3
+    vectors /= np.linalg.norm(vectors, axis=1, keepdims=True)
+    index = EmbeddingIndex(vectors, [str(i) for i in range(len(vectors))])
+    queries = vectors[:50]
+    exact = [{text for _, text in utils.top_n_similarity(query, index, 10)} for query in queries]
+
+    for kind in ['int8', 'pq']:
+        index.compress(kind, 16)
+        output = str(tmp_path / f'{kind}.index')
+        index.save(output)
+        loaded = EmbeddingIndex.load(output)
+        assert loaded.quantizer.kind == kind
+        assert np.array_equal(loaded.quantizer.codes, index.quantizer.codes)
+        for rerank, min_recall in [(0, 0.5 if kind == 'pq' else 0.9), (100, 0.95)]:
+            loaded.rerank = rerank
+            found = 0
+            for query, expected in zip(queries, exact):
+                found += len(expected & {text for _, text in utils.top_n_similarity(query, loaded, 10)})
+            assert found / (len(queries) * 10) >= min_recall, (kind, rerank)
+
+def test_index_registry(tmp_path):
+    import os
+    import pytest
+    from docs_chat_bot.index_registry import IndexRegistry
+    paths = {}
+    for name in ['a', 'b', 'c']:
+        paths[name] = str(tmp_path / f'{name}.index')
+        EmbeddingIndex(np.random.rand(100, 16).astype(np.float32), [f'{name}{i}' for i in range(100)]).save(paths[name])
+    size = os.path.getsize(paths['a'])
+    registry = IndexRegistry.from_dir(str(tmp_path), max_bytes=2 * size, nprobe=4)
+    assert registry.default == 'a'
+    assert registry.get_loaded('a') is None
+
+    a = registry.get()
+    assert a.texts[0] == 'a0' and a.nprobe == 4
+    assert registry.get('a') is a
+    registry.get('b')
+    registry.get('a')
+    # 'b' is the least recently used index when 'c' does not fit
+    registry.get('c')
+    assert list(registry.loaded) == ['a', 'c']
+    assert registry.stats()['unloads'] == 1
+    # an unloaded index is loaded again on demand
+    assert registry.get('b').texts[0] == 'b0'
+    assert registry.stats()['loads'] == 4
+    with pytest.raises(KeyError):
+        registry.get('d')
+
+def test_index_registry_slow_load(tmp_path, monkeypatch):
+    import threading
+    from docs_chat_bot.index_registry import IndexRegistry
+    for name in ['a', 'b']:
+        EmbeddingIndex(np.random.rand(10, 4).astype(np.float32), [f'{name}{i}' for i in range(10)]).save(str(tmp_path / f'{name}.index'))
+    registry = IndexRegistry.from_dir(str(tmp_path))
+    a = registry.get('a')
+
+    release = threading.Event()
+    loading = []
+    load = registry._load
+    def slow_load(path):
+        loading.append(path)
+        release.wait(5)
+        return load(path)
+    monkeypatch.setattr(registry, '_load', slow_load)
+    threads = [threading.Thread(target=registry.get, args=('b',)) for _ in range(2)]
+    for thread in threads:
+        thread.start()
+    while not loading:
+        time.sleep(0.01)
+    # the loaded index is served while 'b' is loading
+    start = time.monotonic()
+    assert registry.get_loaded('a') is a
+    assert registry.stats()['loaded'] == ['a']
+    assert time.monotonic() - start < 0.1
+    release.set()
+    for thread in threads:
+        thread.join()
+    # both threads got the index of a single load
+    assert len(loading) == 1
+    assert registry.get_loaded('b').texts[0] == 'b0'
+    assert registry.stats()['loads'] == 2
+
+def test_index_reload(tmp_path):
+    from docs_chat_bot.cache import AnswerCache
+    from docs_chat_bot.index_registry import IndexRegistry
+    path = str(tmp_path / 'docs.index')
+    EmbeddingIndex(np.eye(2, dtype=np.float32), ['old1', 'old2']).save(path)
+    registry = IndexRegistry({'docs': path})
+    old = registry.get()
+    assert registry.changed() == []
+
+    EmbeddingIndex(np.eye(3, dtype=np.float32), ['new1', 'new2', 'new3']).save(path)
+    assert registry.changed() == ['docs']
+    assert registry.reload()
+    assert registry.changed() == []
+    new = registry.get()
+    assert list(new.texts) == ['new1', 'new2', 'new3']
+    # a question started before the reload finishes with the old index
+    assert list(old.texts) == ['old1', 'old2']
+
+    cache = AnswerCache()
+    assert cache.get(np.array([1.0, 0.0, 0.0]), ['a'], new.version) is None
+    # answers generated from the old index are not cached
+    cache.put(np.array([1.0, 0.0]), ['a'], old.version, 'stale')
+    cache.put(np.array([1.0, 0.0, 0.0]), ['a'], new.version, 'fresh')
+    assert cache.get(np.array([1.0, 0.0, 0.0]), ['a'], new.version) == 'fresh'
+
+def test_lexical_search(tmp_path):
+    from docs_chat_bot import bm25
+    assert bm25.tokenize('How do I call get_embedding on @action?') == ['call', 'get_embedding', 'get', 'embedding', '@action']
+    assert bm25.tokenize('EmbeddingIndex') == ['embeddingindex', 'embedding', 'index']
+
+    texts = [
+        'the contract stores the balance of every account',
+        'use @action("transfer") to define the transfer action',
+        'get_embedding returns the embedding of a text',
+        'the transfer of tokens between accounts',
+    ]
+    vectors = np.eye(4, dtype=np.float32)
+    index = EmbeddingIndex(vectors, texts)
+    index.build_lexical()
+    output = str(tmp_path / 'lexical.index')
+    index.save(output)
+    loaded = EmbeddingIndex.load(output)
+    assert loaded.lexical.find('get_embedding') == index.lexical.find('get_embedding') >= 0
+    assert loaded.lexical.find('missing') == -1
+    assert [i for _, i in loaded.lexical.search('get_embedding', 4)] == [2]
+    assert [i for _, i in loaded.lexical.search('transfer @action', 4)] == [1, 3]
+    assert loaded.lexical.search('nothing matches', 4) == []
+
+    # the chunk named in the question is fused in even when its vector is far from the query
+    query = np.array([1.0, 0.0, 0.0, 0.0], dtype=np.float32)
+    assert [i for _, i in utils.search_context(loaded, query)][0] == 0
+    results = utils.search_context(loaded, query, 'what does get_embedding return')
+    assert {i for _, i in results[:2]} == {0, 2}
+    assert dict((i, similarity) for similarity, i in results)[2] == 0.0
+    # without an embedding only the chunks containing the question terms are candidates
+    assert utils.search_context(loaded, None, 'get_embedding') == [(utils.lexical_similarity, 2)]
+
+def test_metrics():
+    import urllib.request
+    from docs_chat_bot import metrics
+    histogram = metrics.Histogram('test_seconds', 'Test', 'stage', buckets=(0.1, 1.0))
+    for value in [0.05, 0.1, 0.5, 2.0]:
+        histogram.observe('a', value)
+    assert histogram.render()[2:] == [
+        'test_seconds_bucket{stage="a",le="0.1"} 2',
+        'test_seconds_bucket{stage="a",le="1.0"} 3',
+        'test_seconds_bucket{stage="a",le="+Inf"} 4',
+        'test_seconds_sum{stage="a"} 2.65',
+        'test_seconds_count{stage="a"} 4',
+    ]
+
+    retrievals = metrics.stage_seconds.count('retrieval')
+    index = EmbeddingIndex(np.array([[1.0, 0.0], [0.8, 0.6], [0.0, 1.0]], dtype=np.float32), ['a', 'b', 'c'])
+    utils.search_context(index, np.array([1.0, 0.0], dtype=np.float32))
+    assert metrics.stage_seconds.count('retrieval') == retrievals + 1
+    assert metrics.top_similarity.value == 1.0
+    assert metrics.context_chunks.value == 2
+
+    server = metrics.start_http_server(0)
+    try:
+        with urllib.request.urlopen(f'http://127.0.0.1:{server.server_address[1]}/metrics') as response:
+            text = response.read().decode()
+    finally:
+        server.shutdown()
+    assert 'docs_chat_bot_retrieval_context_chunks 2.0' in text
+    assert 'docs_chat_bot_stage_seconds_count{stage="retrieval"}' in text
+
+def test_stream_coalescer(monkeypatch):
+    from docs_chat_bot.coalescer import StreamCoalescer
+    coalescer = StreamCoalescer(min_interval=2.0, max_latency=0.8, target_bytes=100, max_bytes=40)
+    assert coalescer.push('Hello', 0.0) is None
+    assert coalescer.push(' world', 0.1) is None
+    assert coalescer.push('.', 0.2) is None
+    assert coalescer.push(' Next', 0.3) is None
+    # the oldest piece waited long enough, the message ends at the sentence end
+    assert coalescer.push(' sentence', 0.9) == 'Hello world.'
+    # too soon after the previous message
+    assert coalescer.push(' goes on and on', 1.5) is None
+    # no sentence end, the message ends between two words
+    assert coalescer.push(' without', 3.0) == ' Next sentence goes on and on'
+    assert coalescer.push('x' * 40, 5.5) == ' without' + 'x' * 40
+
+    # newlines inside a code block are not line ends
+    coalescer = StreamCoalescer(min_interval=0.0, max_latency=10.0, target_bytes=5, max_bytes=1000)
+    assert coalescer.push('```', 0.0) is None
+    assert coalescer.push('python\n', 0.1) is None
+    assert coalescer.push('a = 1\n', 0.2) is None
+    assert coalescer.push('```\n', 0.3) == '```python\na = 1\n```\n'
+    assert coalescer.push('end', 0.4) is None
+    assert coalescer.flush() == 'end'
+    assert coalescer.flush() == ''
+
+    # a message is due after `max_latency` without a new piece
+    coalescer = StreamCoalescer(min_interval=1.0, max_latency=0.5, target_bytes=100, max_bytes=1000)
+    assert coalescer.timeout(0.0) is None
+    assert coalescer.push('Hello', 0.0) is None
+    assert coalescer.timeout(0.2) == pytest.approx(0.3)
+    assert coalescer.poll(0.2) is None
+    assert coalescer.poll(0.5) == 'Hello'
+    assert coalescer.push('\n', 0.6) is None
+    # too soon after the previous message
+    assert coalescer.timeout(0.6) == pytest.approx(0.9)
+    # whitespace alone is not sent, it starts the next message with the indentation of the code
+    assert coalescer.poll(1.5) is None
+    assert coalescer.timeout(1.5) is None
+    assert coalescer.push('    return 1', 1.6) is None
+    assert coalescer.poll(2.1) == '\n    return 1'
+
+    from docs_chat_bot import chatgpt
+    from docs_chat_bot.cache import AnswerCache, EmbeddingCache
+    monkeypatch.setattr(utils, 'query_embedding_cache', EmbeddingCache())
+    monkeypatch.setattr(utils, 'answer_cache', AnswerCache())
+    async def aget_embedding(text, model=''):
+        return [1.0, 0.0]
+    monkeypatch.setattr(utils, 'aget_embedding', aget_embedding)
+    index = EmbeddingIndex.from_embeddings({'doc1': np.array([1.0, 0.0]), 'doc2': np.array([0.0, 1.0])})
+
+    async def acreate(**kwargs):
+        async def events():
+            for token in ['First', ' sentence.', ' Second', ' one.\n', '']:
+                yield {'choices': [{'delta': {'content': token} if token else {}}]}
+        return events()
+    monkeypatch.setattr(chatgpt.openai.ChatCompletion, 'acreate', acreate)
+    bot = chatgpt.ChatGPTBot('', index, coalescing={'min_interval': 0.0, 'max_latency': 10.0, 'target_bytes': 10})
+
+    async def ask():
+        return [msg async for msg in bot.send_message('user', 'question')]
+    assert asyncio.run(ask()) == ['[BEGIN]', 'First sentence.', ' Second one.\n']
+
+    # the buffer is sent while the completion stalls
+    monkeypatch.setattr(utils, 'answer_cache', AnswerCache())
+    async def acreate(**kwargs):
+        async def events():
+            for token in ['First', ' part.\n', 'Rest.', '']:
+                if token == 'Rest.':
+                    await asyncio.sleep(0.5)
+                yield {'choices': [{'delta': {'content': token} if token else {}}]}
+        return events()
+    monkeypatch.setattr(chatgpt.openai.ChatCompletion, 'acreate', acreate)
+    bot = chatgpt.ChatGPTBot('', index, coalescing={'min_interval': 0.0, 'max_latency': 0.1, 'target_bytes': 100})
+    async def ask_timed():
+        start = time.monotonic()
+        return [(msg, time.monotonic() - start) async for msg in bot.send_message('user', 'question')]
+    messages = asyncio.run(ask_timed())
+    assert [msg for msg, _ in messages] == ['[BEGIN]', 'First part.\n', 'Rest.']
+    assert messages[1][1] < 0.4
+
+def test_conversation_store():
+    import pytest
+    from docs_chat_bot import chatgpt
+    from docs_chat_bot.conversations import ConversationStore
+    store = ConversationStore(max_size=2, ttl=100)
+    store.get('a', 0).answered = 1.0
+    store.get('b', 10)
+    store.get('a', 20)
+    # 'b' is the least recently seen
+    store.get('c', 30)
+    assert 'b' not in store.entries and store.evictions == 1
+    assert store.get('a', 40).answered == 1.0
+    # 'c' expires when another conversation is added, 'a' when it is accessed
+    store.get('d', 131)
+    assert list(store.entries) == ['a', 'd'] and store.expirations == 1
+    assert store.peek('a', 141) is None
+    assert store.get('a', 141).answered == 0.0
+    assert store.stats() == {'size': 2, 'max_size': 2, 'evictions': 1, 'expirations': 2}
+
+    index = EmbeddingIndex.from_embeddings({'doc1': np.array([1.0, 0.0])})
+    shared = ConversationStore()
+    bots = [chatgpt.ChatGPTBot('', index, conversations=shared) for _ in range(2)]
+    for i in range(chatgpt.rate_limit_size):
+        bots[i % 2].check_rate_limit('user')
+    # the limit holds whichever bot answers
+    with pytest.raises(chatgpt.RateLimitExceededError):
+        bots[1].check_rate_limit('user')
+    shared.entries['user'].requests[0] -= chatgpt.rate_limit_window_seconds + 1
+    bots[0].check_rate_limit('user')
+    assert len(shared.entries['user'].requests) == chatgpt.rate_limit_size
@@ -1,14 +1,27 @@
-from typing import Dict
+from typing import Dict, List, Optional, Tuple, Union
 import numpy as np
 import openai
 import tiktoken
 from pymixin import log
 
+from .bm25 import reciprocal_rank_fusion
+from . import metrics
+from .cache import AnswerCache, EmbeddingCache
+from .embedding_index import EmbeddingIndex
+
 logger = log.get_logger(__name__)
 logger.addHandler(log.handler)
 
 EMBEDDING_MODEL = "text-embedding-ada-002"
 max_prompt_token = 3000
+# candidates retrieved for the context of a prompt, and the similarity they need to be used
+max_context_chunks = 10
+min_context_similarity = 0.5
+# chunks found by the lexical search alone when the question could not be embedded have no
+# similarity, they are reported with this one so `min_context_similarity` keeps them
+lexical_similarity = 1.0
+# tokens of the template around the guide, context and question
+prompt_overhead_tokens = 16
 
 gpt_encoding = tiktoken.encoding_for_model("gpt-3.5-turbo")
 
@@ -24,6 +37,86 @@ def get_embedding(text: str, model: str=EMBEDDING_MODEL) -> list[float]:
     )
     return result["data"][0]["embedding"]
 
+async def aget_embedding(text: str, model: str=EMBEDDING_MODEL) -> list[float]:
+    result = await openai.Embedding.acreate(
+      model=model,
+      input=text,
+      request_timeout=10
+    )
+    return result["data"][0]["embedding"]
+
+query_embedding_cache = EmbeddingCache()
+answer_cache = AnswerCache()
+
+async def aget_query_embedding(question: str) -> np.array:
+    """
+    Returns the embedding of `question`, served from `query_embedding_cache` when it was asked recently.
+    """
+    embedding = query_embedding_cache.get(question)
+    if embedding is None:
+        with metrics.timer('embedding'):
+            embedding = np.array(await aget_embedding(question), dtype=np.float32)
+        query_embedding_cache.put(question, embedding)
+    return embedding
+
+def search_context(index: EmbeddingIndex, query_embedding: Optional[np.array], question: Optional[str] = None) -> List[Tuple[float, int]]:
+    """
+    Returns the context candidates as (similarity, position) pairs, best first.
+    With the question and a BM25 index, the vector and lexical rankings are merged with reciprocal
+    rank fusion, so chunks naming the identifiers of the question are found even when their
+    embedding is not among the closest. Without `query_embedding` only the lexical ranking is used.
+    """
+    with metrics.timer('retrieval'):
+        results = _search_context(index, query_embedding, question)
+    if query_embedding is not None:
+        metrics.record_retrieval([similarity for similarity, _ in results], min_context_similarity)
+    return results
+
+def _search_context(index: EmbeddingIndex, query_embedding: Optional[np.array], question: Optional[str]) -> List[Tuple[float, int]]:
+    n = min(max_context_chunks, len(index))
+    lexical = []
+    if question and index.lexical is not None:
+        lexical = index.lexical.search(question, n)
+    if query_embedding is None:
+        return [(lexical_similarity, i) for _, i in lexical]
+    results = index.search(query_embedding, n)
+    if not lexical:
+        return results
+    similarities = {i: similarity for similarity, i in results}
+    query_embedding = np.asarray(query_embedding, dtype=np.float32)
+    fused = reciprocal_rank_fusion([[i for _, i in results], [i for _, i in lexical]])[:n]
+    return [(similarities[i] if i in similarities else float(index.vectors[i] @ query_embedding), i) for _, i in fused]
+
+def context_chunk_ids(index: EmbeddingIndex, document_similarities: List[Tuple[float, int]]) -> List[str]:
+    """
+    Returns the ids of the retrieved chunks similar enough to be used as context, they are part of the answer cache key.
+    """
+    return [index.ids[i] for similarity, i in document_similarities if similarity > min_context_similarity]
+
+def chunk_token_count(index: EmbeddingIndex, i: int) -> int:
+    if index.token_counts is None:
+        # indexes built by older versions have no token counts
+        return count_tokens(index.texts[i])
+    return int(index.token_counts[i])
+
+def pack_context(index: EmbeddingIndex, document_similarities: List[Tuple[float, int]], budget: int) -> Tuple[List[int], int]:
+    """
+    Greedily picks the best ranked chunks whose token counts fit in `budget`, skipping a chunk
+    that does not fit in favour of smaller ones. Returns their positions and the tokens they use.
+    """
+    positions = []
+    used = 0
+    for similarity, i in document_similarities:
+        # fused rankings are not sorted by similarity
+        if similarity <= min_context_similarity:
+            continue
+        # one more token for the newline joining the chunks
+        tokens = chunk_token_count(index, i) + 1
+        if used + tokens > budget:
+            continue
+        positions.append(i)
+        used += tokens
+    return positions, used
 
 def vector_similarity(x: np.array, y: np.array) -> float:
     """
@@ -35,19 +128,7 @@ def vector_similarity(x: np.array, y: np.array) -> float:
 
 embeddings = None
 
-def top_n_similarity(query_embedding: np.array, embeddings: Dict[str, np.array], n):
-    if n > len(embeddings):
-        raise Exception("n is larger than the length of the list")
-
-    top_n = [(float('-inf'), None)] * n
-
-    for key in embeddings:
-        doc_embedding = embeddings[key]
-        similarity = vector_similarity(query_embedding, doc_embedding)
-        min_value = min(top_n)
-        min_index = top_n.index(min_value)
-
-        if similarity > min_value[0]:
-            top_n[min_index] = (similarity, key)
-
-    return sorted(top_n, reverse=True)
+def top_n_similarity(query_embedding: np.array, embeddings: Union[EmbeddingIndex, Dict[str, np.array]], n):
+    if not isinstance(embeddings, EmbeddingIndex):
+        embeddings = EmbeddingIndex.from_embeddings(embeddings)
+    return [(similarity, embeddings.texts[i]) for similarity, i in embeddings.search(query_embedding, n)]